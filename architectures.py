@@ -20,6 +20,7 @@ from matplotlib.colors import Normalize
 import matplotlib.cm as cm
 
 #Tools:
+import copy
 import datetime
 import sys
 import warnings
@@ -71,6 +72,8 @@ class CNNDecoder(nn.Module):
 
         #Save the dimension of the input and the output features:
         self.dim_features_inp=dim_features_inp
+        #Memory format of weights and inputs (see self.set_channels_last):
+        self.channels_last=False
 
         #-----CREATE LIST OF NON-LINEARITIES----
         if len(non_linearity)==1:
@@ -109,10 +112,19 @@ class CNNDecoder(nn.Module):
             sys.exit("The dimension of covariance estimation must be less or equal to 4.")
         #------------END CONTROL INPUTS--------------
 
+    #Set the memory format of the weights and of the inputs to channels_last (NHWC) or back to contiguous (NCHW):
+    def set_channels_last(self,channels_last=True):
+        self.channels_last=channels_last
+        self.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        return(self)
+
     def forward(self,X):
         '''
         X - torch.tensor - shape (batch_size,self.list_n_channels[0],height,width)
         '''
+        #The output of the encoder is already in channels_last memory format, i.e. this is no copy:
+        if self.channels_last:
+            X=X.contiguous(memory_format=torch.channels_last)
         return(self.decoder(X))
     
     def give_model_dict(self):
@@ -152,6 +164,148 @@ class CNNDecoder(nn.Module):
         return(CNN_Decoder.create_model_from_dict(dictionary))
 
 
+#-----------------------------------------------------
+#A QUANTIZED CONVOLUTIONAL DECODER (INT8 VERSION OF CNNDecoder FOR CPU INFERENCE):
+#------------------------------------------------------
+class QuantizedCNNDecoder(nn.Module):
+    def __init__(self,list_hid_channels,kernel_sizes,dim_cov_est,non_linearity=["ReLU"],dim_features_inp=2,backend='fbgemm'):
+        '''
+        Input: list_hid_channels,kernel_sizes,dim_cov_est,non_linearity,dim_features_inp - see CNNDecoder
+               backend - string - quantized engine: 'fbgemm' (x86) or 'qnnpack' (ARM)
+        -->Creates the stack of CNNDecoder where the hidden (Conv2d,ReLU)-layers are fused and prepared for static int8 quantization.
+        The last convolution (the head giving means and covariance parameters) stays in float.
+        The model has to be calibrated (see self.calibrate) or loaded with quantized parameters (see create_model_from_dict)
+        before it is used. Quantized models only run on the CPU.
+        '''
+        #Initialize:
+        super(QuantizedCNNDecoder, self).__init__()
+        #Create the float decoder (checks the inputs):
+        Float_Decoder=CNNDecoder(list_hid_channels=list_hid_channels,kernel_sizes=kernel_sizes,dim_cov_est=dim_cov_est,
+                                 non_linearity=non_linearity,dim_features_inp=dim_features_inp)
+        #Save the parameters:
+        self.list_n_channels=Float_Decoder.list_n_channels
+        self.kernel_sizes=kernel_sizes
+        self.n_layers=Float_Decoder.n_layers
+        self.dim_cov_est=dim_cov_est
+        self.list_hid_channels=list_hid_channels
+        self.non_linearity=Float_Decoder.non_linearity
+        self.dim_features_inp=dim_features_inp
+        self.backend=backend
+        self.calibrated=False
+
+        #----------CREATE DECODER----------------
+        layers_list=list(Float_Decoder.decoder.children())
+        #Quantized part: (Conv2d,ReLU)-pairs fused to one module:
+        self.quant=torch.quantization.QuantStub()
+        self.body=nn.Sequential(*layers_list[:-1])
+        torch.quantization.fuse_modules(self.body,[[str(2*it),str(2*it+1)] for it in range(self.n_layers-2)],inplace=True)
+        self.dequant=torch.quantization.DeQuantStub()
+        #Float part:
+        self.head=layers_list[-1]
+        #Only the body and the stubs are quantized:
+        qconfig=torch.quantization.get_default_qconfig(backend)
+        self.quant.qconfig=qconfig
+        self.body.qconfig=qconfig
+        self.dequant.qconfig=qconfig
+        torch.quantization.prepare(self,inplace=True)
+        #----------END CREATE DECODER--------------
+
+        #-----------CONTROL INPUTS------------------
+        if backend not in torch.backends.quantized.supported_engines:
+            sys.exit("Quantized engine "+backend+" is not supported on this machine.")
+        #------------END CONTROL INPUTS--------------
+
+    def load_float_decoder(self,Decoder):
+        '''
+        Input: Decoder - instance of CNNDecoder with the same architecture - its weights and biases are copied (before calibration)
+        '''
+        if self.calibrated:
+            sys.exit("Float parameters can only be loaded before calibration.")
+        layers_list=list(Decoder.decoder.children())
+        for it in range(self.n_layers-2):
+            self.body[2*it][0].load_state_dict(layers_list[2*it].state_dict())
+        self.head.load_state_dict(layers_list[-1].state_dict())
+
+    def calibrate(self,calibration_inputs):
+        '''
+        Input: calibration_inputs - list of torch.tensor - shape (batch_size,self.list_n_channels[0],height,width) - inputs of the decoder
+        -->Records the ranges of the activations on the inputs and converts the body to int8.
+        '''
+        if self.calibrated:
+            sys.exit("Decoder is already calibrated.")
+        torch.backends.quantized.engine=self.backend
+        self.eval()
+        with torch.no_grad():
+            for X in calibration_inputs:
+                self(X.cpu())
+        torch.quantization.convert(self,inplace=True)
+        self.calibrated=True
+
+    def forward(self,X):
+        '''
+        X - torch.tensor - shape (batch_size,self.list_n_channels[0],height,width)
+        '''
+        X=self.dequant(self.body(self.quant(X.contiguous())))
+        return(self.head(X))
+
+    #Create a quantized decoder from a (trained) CNNDecoder:
+    def from_CNNDecoder(Decoder,calibration_inputs,backend='fbgemm'):
+        '''
+        Input: Decoder - instance of CNNDecoder
+               calibration_inputs - list of torch.tensor - see self.calibrate
+               backend - string - see __init__
+        Output: instance of QuantizedCNNDecoder (calibrated)
+        '''
+        Q_Decoder=QuantizedCNNDecoder(list_hid_channels=Decoder.list_hid_channels,kernel_sizes=Decoder.kernel_sizes,
+                                      dim_cov_est=Decoder.dim_cov_est,non_linearity=Decoder.non_linearity,
+                                      dim_features_inp=Decoder.dim_features_inp,backend=backend)
+        Q_Decoder.load_float_decoder(Decoder)
+        Q_Decoder.calibrate(calibration_inputs)
+        return(Q_Decoder)
+
+    def give_model_dict(self):
+        if not self.calibrated:
+            sys.exit("Only calibrated decoders can be saved.")
+        dictionary={
+            'list_hid_channels': self.list_hid_channels,
+            'kernel_sizes': self.kernel_sizes,
+            'dim_cov_est': self.dim_cov_est,
+            'non_linearity': self.non_linearity,
+            'dim_features_inp': self.dim_features_inp,
+            'backend': self.backend,
+            'decoder_class': self.__class__.__name__,
+            'decoder_info': self.__str__(),
+            'decoder_par': self.state_dict()
+        }
+        return(dictionary)
+
+    def save_model_dict(self,filename):
+        torch.save(self.give_model_dict(),f=filename)
+
+    def create_model_from_dict(dictionary):
+        '''
+        Input: dictionary - dictionary - gives parameters for decoder (quantized parameters given by give_model_dict)
+        Output: Decoder - instance of QuantizedCNNDecoder (see above)
+        '''
+        Decoder=QuantizedCNNDecoder(list_hid_channels=dictionary['list_hid_channels'],
+                                    kernel_sizes=dictionary['kernel_sizes'],
+                                    dim_cov_est=dictionary['dim_cov_est'],
+                                    non_linearity=dictionary['non_linearity'],
+                                    dim_features_inp=dictionary['dim_features_inp'],
+                                    backend=dictionary['backend'])
+        #Convert without calibration to create the quantized modules, then load the quantized parameters:
+        torch.backends.quantized.engine=Decoder.backend
+        Decoder.eval()
+        torch.quantization.convert(Decoder,inplace=True)
+        Decoder.calibrated=True
+        Decoder.load_state_dict(dictionary['decoder_par'])
+        return(Decoder)
+
+    def load_model_from_dict(filename):
+        dictionary=torch.load(f=filename)
+        return(QuantizedCNNDecoder.create_model_from_dict(dictionary))
+
+
 #-----------------------------------------------------
 #AN EQUIVARIANT DECODER (STACK OF EQUIVARIANT CONVOLUTIONAL LAYERS AND ACTIVATION FUNCTIONS):
 #------------------------------------------------------
@@ -299,6 +453,10 @@ class SteerDecoder(nn.Module):
         Out=self.decoder(X)
         #Return the resulting tensor:
         return(Out.tensor)
+
+    #Export to a plain torch module for inference (see ExportedSteerDecoder):
+    def export(self):
+        return(ExportedSteerDecoder.from_SteerDecoder(self))
     
     #Two functions to save the model in a dictionary:
     #1.Create dictionary with parameters:
@@ -353,3 +511,170 @@ class SteerDecoder(nn.Module):
         '''
         dictionary=torch.load(f=filename)
         return(SteerDecoder.create_model_from_dict(dictionary))
+
+
+#-----------------------------------------------------
+#AN EXPORTED EQUIVARIANT DECODER (PLAIN TORCH VERSION OF SteerDecoder FOR INFERENCE):
+#------------------------------------------------------
+#Plain torch version of the norm-ReLU of e2cnn (G_CNN.NormNonLinearity with function 'n_relu'):
+class NormReLU(nn.Module):
+    def __init__(self,field_of_channel,n_fields,bias=True,eps=1e-10):
+        '''
+        Input: field_of_channel - torch.tensor of ints - shape (n_channels) - index of the field of every channel
+               n_fields - int - number of fields
+               bias - Boolean - indicates whether a (learned) bias is subtracted from the norms
+               eps - float - norms below eps give zero outputs
+        -->Every field x is mapped to x*relu(|x|-exp(log_bias))/|x|.
+        '''
+        super(NormReLU, self).__init__()
+        self.n_fields=n_fields
+        self.eps=eps
+        self.register_buffer('field_of_channel',torch.as_tensor(field_of_channel,dtype=torch.long))
+        self.log_bias=nn.Parameter(torch.zeros(n_fields),requires_grad=False) if bias else None
+
+    #Create from the e2cnn module:
+    def from_norm_nonlinearity(layer):
+        '''
+        Input: layer - instance of G_CNN.NormNonLinearity (with function 'n_relu')
+        Output: instance of NormReLU computing the same function
+        '''
+        sizes=[rep.size for rep in layer.in_type.representations]
+        field_of_channel=torch.cat([torch.full((size,),it,dtype=torch.long) for it,size in enumerate(sizes)])
+        eps=layer.eps.item() if torch.is_tensor(layer.eps) else layer.eps
+        Module=NormReLU(field_of_channel,len(sizes),bias=layer.log_bias is not None,eps=eps)
+        if layer.log_bias is not None:
+            Module.log_bias.data.copy_(layer.log_bias.detach().view(-1))
+        return(Module)
+
+    def forward(self,X):
+        '''
+        Input: X - torch.tensor - shape (batch_size,n_channels,height,width)
+        Output: torch.tensor - shape (batch_size,n_channels,height,width)
+        '''
+        batch_size,_,height,width=X.shape
+        Norms=torch.zeros(batch_size,self.n_fields,height,width,device=X.device,dtype=X.dtype)
+        Norms=Norms.index_add(1,self.field_of_channel,X**2).sqrt()
+        New_Norms=torch.relu(Norms-torch.exp(self.log_bias).view(1,-1,1,1)) if self.log_bias is not None else torch.relu(Norms)
+        Multipliers=New_Norms/Norms.clamp(min=self.eps)
+        Multipliers=Multipliers.masked_fill(Norms<=self.eps,0.)
+        return(X*Multipliers[:,self.field_of_channel])
+
+#Wrapper applying any other equivariant layer without export to plain tensors:
+class GeometricLayer(nn.Module):
+    def __init__(self,layer):
+        super(GeometricLayer, self).__init__()
+        self.layer=layer
+
+    def forward(self,X):
+        return(self.layer(G_CNN.GeometricTensor(X,self.layer.in_type)).tensor)
+
+class ExportedSteerDecoder(nn.Module):
+    def __init__(self,model_dict,layers_list):
+        '''
+        Input: model_dict - dictionary - parameters of the original SteerDecoder (see SteerDecoder.give_model_dict)
+               layers_list - list of nn.Module - plain torch layers (nn.Conv2d, nn.ReLU, NormReLU or GeometricLayer)
+        -->A plain torch version of a SteerDecoder: the steerable convolutions are exported to nn.Conv2d, i.e. the filters are expanded
+        from the equivariant basis once and not in every forward pass. It is created by SteerDecoder.export, computes the same function
+        as the SteerDecoder at the time of the export and is meant for inference only. It is saved as the original SteerDecoder
+        (see self.give_model_dict) or layer by layer (see self.give_layer_specs and inference_artifact.py).
+        '''
+        super(ExportedSteerDecoder, self).__init__()
+        #Save the parameters:
+        self.model_dict=model_dict
+        self.kernel_sizes=model_dict['kernel_sizes']
+        self.dim_cov_est=model_dict['dim_cov_est']
+        self.channels_last=False
+        self.decoder=nn.Sequential(*layers_list)
+        self.eval()
+
+    #Create the exported version of a SteerDecoder:
+    def from_SteerDecoder(Decoder):
+        '''
+        Input: Decoder - instance of SteerDecoder
+        Output: instance of ExportedSteerDecoder
+        '''
+        #The steerable convolutions can only be exported in evaluation mode:
+        training=Decoder.training
+        Decoder.eval()
+        layers_list=[]
+        for layer in Decoder.decoder.children():
+            if isinstance(layer,G_CNN.NormNonLinearity):
+                layers_list.append(NormReLU.from_norm_nonlinearity(layer))
+                continue
+            try:
+                layers_list.append(layer.export())
+            except NotImplementedError:
+                layers_list.append(GeometricLayer(copy.deepcopy(layer)))
+        Decoder.train(training)
+        return(ExportedSteerDecoder(copy.deepcopy(Decoder.give_model_dict()),layers_list))
+
+    #Set the memory format of the weights and of the inputs to channels_last (NHWC) or back to contiguous (NCHW):
+    def set_channels_last(self,channels_last=True):
+        self.channels_last=channels_last
+        self.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+        return(self)
+
+    def forward(self,X):
+        '''
+        Input: X - torch.tensor - shape (batch_size,n_in_channels,m,n)
+        Output: torch.tensor - shape (batch_size,n_out_channels,m,n)
+        '''
+        if self.channels_last:
+            X=X.contiguous(memory_format=torch.channels_last)
+        return(self.decoder(X))
+
+    #Description of the layers such that the decoder can be created without e2cnn (weights are not included):
+    def give_layer_specs(self):
+        '''
+        Output: list of dictionaries - one per layer of self.decoder
+        '''
+        layer_specs=[]
+        for layer in self.decoder.children():
+            if isinstance(layer,nn.Conv2d):
+                layer_specs.append({'type': 'Conv2d','in_channels': layer.in_channels,'out_channels': layer.out_channels,
+                                    'kernel_size': list(layer.kernel_size),'padding': list(layer.padding),'bias': layer.bias is not None})
+            elif isinstance(layer,nn.ReLU):
+                layer_specs.append({'type': 'ReLU'})
+            elif isinstance(layer,NormReLU):
+                layer_specs.append({'type': 'NormReLU','n_channels': layer.field_of_channel.size(0),'n_fields': layer.n_fields,
+                                    'bias': layer.log_bias is not None,'eps': layer.eps})
+            else:
+                sys.exit("Layer "+layer.__class__.__name__+" can not be described without e2cnn.")
+        return(layer_specs)
+
+    #Create the decoder from the layer specs (weights are randomly initialised and have to be loaded afterwards):
+    def create_model_from_layer_specs(model_dict,layer_specs):
+        '''
+        Input: model_dict - dictionary - see __init__ (parameters 'decoder_par' are not used)
+               layer_specs - list of dictionaries - output of give_layer_specs
+        Output: instance of ExportedSteerDecoder
+        '''
+        layers_list=[]
+        for spec in layer_specs:
+            if spec['type']=='Conv2d':
+                layers_list.append(nn.Conv2d(spec['in_channels'],spec['out_channels'],kernel_size=tuple(spec['kernel_size']),
+                                             padding=tuple(spec['padding']),bias=spec['bias']))
+            elif spec['type']=='ReLU':
+                layers_list.append(nn.ReLU(inplace=True))
+            elif spec['type']=='NormReLU':
+                layers_list.append(NormReLU(torch.zeros(spec['n_channels'],dtype=torch.long),spec['n_fields'],bias=spec['bias'],eps=spec['eps']))
+            else:
+                sys.exit("Unknown layer type.")
+        return(ExportedSteerDecoder(model_dict,layers_list))
+
+    def give_model_dict(self):
+        return(self.model_dict)
+
+    def save_model_dict(self,filename):
+        torch.save(self.give_model_dict(),f=filename)
+
+    def create_model_from_dict(dictionary):
+        '''
+        Input: dictionary - dictionary - parameters of a SteerDecoder (see SteerDecoder.give_model_dict)
+        Output: instance of ExportedSteerDecoder
+        '''
+        return(SteerDecoder.create_model_from_dict(dictionary).export())
+
+    def load_model_from_dict(filename):
+        dictionary=torch.load(f=filename)
+        return(ExportedSteerDecoder.create_model_from_dict(dictionary))
@@ -0,0 +1,123 @@
+#LIBRARIES:
+#Tensors:
+import numpy as np
+import torch
+
+#Tools:
+import datetime
+import time
+import json
+import os
+import sys
+import platform
+import warnings
+import argparse
+warnings.filterwarnings("ignore", category=UserWarning)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+#Own files:
+import cnp.cnp_architectures as cnp_architectures
+
+#HYPERPARAMETERS and set seed:
+torch.set_default_dtype(torch.float)
+
+'''
+-------------------------------------------------------------------------
+--------------------------CNP THROUGHPUT BENCHMARK-----------------------
+-------------------------------------------------------------------------
+Compares the throughput (target points per second) of the CNP decoder with the first layer applied to the
+concatenated input (x,r) and with the fused first layer W_x x+(W_r r+b) (see cnp.enc_dec_models.CNPDecoder)
+for the architectures of cnp_architectures.give_cnp_architecture over a grid of (batch_size,n_target).
+Both versions use the same parameters. The results are written to a JSON file.
+'''
+ARCHITECTURES=['paper','double','big','thin']
+
+def give_median_time(func,n_warmup=2,n_repeats=10):
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            func()
+        times=[]
+        for _ in range(n_repeats):
+            start=time.perf_counter()
+            func()
+            times.append(time.perf_counter()-start)
+    return(float(np.median(times)))
+
+def give_list(string,type_func=int):
+    return([type_func(item) for item in string.split(',')])
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        OUTPUT_FILE=None,
+        ARCHITECTURES=','.join(ARCHITECTURES),
+        BATCH_SIZE='1,30',
+        N_CONTEXT=50,
+        N_TARGET='100,1000,10000',
+        N_WARMUP=2,
+        N_REPEATS=10,
+        N_THREADS=None,
+        SEED=1,
+        DEVICE='cpu')
+
+    ap.add_argument("-out", "--OUTPUT_FILE", type=str, required=False,help="JSON file the results are written to")
+    ap.add_argument("-arch", "--ARCHITECTURES", type=str, required=False,help="Comma-separated list of CNP architectures")
+    ap.add_argument("-batch", "--BATCH_SIZE", type=str, required=False,help="Comma-separated list of batch sizes")
+    ap.add_argument("-n_cont", "--N_CONTEXT", type=int, required=False,help="Number of context points")
+    ap.add_argument("-n_target", "--N_TARGET", type=str, required=False,help="Comma-separated list of target set sizes")
+    ap.add_argument("-warmup", "--N_WARMUP", type=int, required=False,help="Number of calls before timing")
+    ap.add_argument("-repeats", "--N_REPEATS", type=int, required=False,help="Number of timed calls")
+    ap.add_argument("-threads", "--N_THREADS", type=int, required=False,help="Number of CPU threads of torch")
+    ap.add_argument("-seed", "--SEED", type=int, required=False,help="Seed")
+    ap.add_argument("-device", "--DEVICE", type=str, required=False,help="Device")
+    ARGS = vars(ap.parse_args())
+
+    ARGS['ARCHITECTURES']=give_list(ARGS['ARCHITECTURES'],str)
+    for key in ['BATCH_SIZE','N_TARGET']:
+        ARGS[key]=give_list(ARGS[key])
+    if ARGS['N_THREADS'] is not None:
+        torch.set_num_threads(ARGS['N_THREADS'])
+    if ARGS['OUTPUT_FILE'] is None:
+        ARGS['OUTPUT_FILE']="Benchmark_CNP_"+datetime.datetime.today().strftime('%Y_%m_%d_%H_%M')+".json"
+
+    torch.manual_seed(ARGS['SEED'])
+    device=torch.device(ARGS['DEVICE'])
+
+    results=[]
+    for name in ARGS['ARCHITECTURES']:
+        CNP=cnp_architectures.give_cnp_architecture(name).to(device)
+        CNP.eval()
+        for batch_size in ARGS['BATCH_SIZE']:
+            x_context=torch.randn(batch_size,ARGS['N_CONTEXT'],2,device=device)
+            y_context=torch.randn(batch_size,ARGS['N_CONTEXT'],2,device=device)
+            for n_target in ARGS['N_TARGET']:
+                x_target=torch.randn(batch_size,n_target,2,device=device)
+                times={}
+                for fused in [False,True]:
+                    CNP.decoder.fused_first_layer=fused
+                    times['fused' if fused else 'concatenated']=give_median_time(lambda: CNP(x_context,y_context,x_target),
+                                                                                 ARGS['N_WARMUP'],ARGS['N_REPEATS'])
+                result={'architecture': name,
+                        'batch_size': batch_size,
+                        'n_target': n_target,
+                        'median_time_concatenated': times['concatenated'],
+                        'median_time_fused': times['fused'],
+                        'targets_per_second_concatenated': batch_size*n_target/times['concatenated'],
+                        'targets_per_second_fused': batch_size*n_target/times['fused'],
+                        'speedup': times['concatenated']/times['fused']}
+                print("%s | batch size: %d | n_target: %d | concatenated: %.0f targets/s | fused: %.0f targets/s | speedup: %.2fx"\
+                      %(name,batch_size,n_target,result['targets_per_second_concatenated'],result['targets_per_second_fused'],result['speedup']))
+                results.append(result)
+
+    output={'meta': {'date': datetime.datetime.today().strftime('%Y-%m-%d %H:%M'),
+                     'torch_version': torch.__version__,
+                     'n_threads': torch.get_num_threads(),
+                     'platform': platform.platform(),
+                     'device': ARGS['DEVICE'],
+                     'args': ARGS},
+            'results': results}
+    with open(ARGS['OUTPUT_FILE'],'w') as f:
+        json.dump(output,f,indent=1)
+    print("Saved results in: ", ARGS['OUTPUT_FILE'])
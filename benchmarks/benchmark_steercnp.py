@@ -0,0 +1,345 @@
+#LIBRARIES:
+#Tensors:
+import numpy as np
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+#Tools:
+import datetime
+import time
+import json
+import os
+import sys
+import platform
+import warnings
+import argparse
+warnings.filterwarnings("ignore", category=UserWarning)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+#Own files:
+import kernel_and_gp_tools as GP
+import my_utils
+import equiv_encoder
+import decoder_models as models
+import steercnp
+import profiling
+from cov_activ_func import cov_activ_func
+
+#HYPERPARAMETERS and set seed:
+torch.set_default_dtype(torch.float)
+
+'''
+-------------------------------------------------------------------------
+--------------------------BENCHMARK SUITE--------------------------------
+-------------------------------------------------------------------------
+Times and memory-profiles the components of the SteerCNP pipeline on synthetic data sampled
+from vec_gp_sampler_2dim over a grid of (batch_size,n_context,n_target,n_x_axis).
+Every component only depends on some of these parameters - for the other ones, it is run only once.
+The results are written to a JSON file which can be compared to another one via compare_benchmarks.py.
+Layouts: the component decoder_layout times the inference decoders (steerable decoders exported to plain convolutions)
+in contiguous (NCHW) and channels_last (NHWC) memory format - the gains per architecture are printed at the end.
+Memory: on a CPU, the resident set size of the process at the end of a call is recorded (see profiling.StageProfiler).
+'''
+
+#Kernel types supported by GP.batch_gram_matrix:
+KERNEL_TYPES=["rbf","dot_product","div_free","curl_free"]
+#Groups of the steerable decoders and the fiber representation of the context features (GP data has no scalar features):
+DECODER_GROUPS={'SO2': (models.get_SO2_Decoder,[1]),
+                'C16': (models.get_C16_Decoder,[1]),
+                'D8': (models.get_D8_Decoder,[[1,1]]),
+                'C8': (models.get_C8_Decoder,[1]),
+                'D4': (models.get_D4_Decoder,[[1,1]]),
+                'C4': (models.get_C4_Decoder,[1])}
+COMPONENTS=['encoder','gram_matrix','kernel_smoother','cov_activ_func','log_ll','decoder','decoder_layout','train_step']
+#Range of the grid of the encoder and of the synthetic data:
+X_RANGE=[-10,10]
+
+def give_decoder(group,name,dim_cov_est=3):
+    '''
+    Input: group - string - 'CNN' or a key of DECODER_GROUPS
+           name - string - name of the architecture (see decoder_models)
+    Output: nn.Module - decoder
+    '''
+    if group=='CNN':
+        return(models.get_CNNDecoder(name,dim_cov_est=dim_cov_est,dim_features_inp=2))
+    elif group in DECODER_GROUPS:
+        get_decoder,context_rep_ids=DECODER_GROUPS[group]
+        return(get_decoder(name,dim_cov_est=dim_cov_est,context_rep_ids=context_rep_ids))
+    else:
+        sys.exit("Unknown decoder group.")
+
+class SyntheticData(object):
+    def __init__(self,l_scale=5.,kernel_type="rbf",n_pool=8):
+        '''
+        Input: l_scale,kernel_type - parameters of the GP the data is sampled from
+               n_pool - int - number of GP samples per grid size (batches are built by repeating them)
+        '''
+        self.l_scale=l_scale
+        self.kernel_type=kernel_type
+        self.n_pool=n_pool
+        #Dictionary of sampled pools (key: number of grid points per axis):
+        self.pools={}
+
+    def give_pool(self,n_grid_points):
+        if n_grid_points not in self.pools:
+            samples=[GP.vec_gp_sampler_2dim(min_x=X_RANGE[0],max_x=X_RANGE[1],n_grid_points=n_grid_points,
+                                            l_scale=self.l_scale,kernel_type=self.kernel_type) for _ in range(self.n_pool)]
+            X=torch.stack([sample[0] for sample in samples],dim=0)
+            Y=torch.stack([sample[1] for sample in samples],dim=0)
+            self.pools[n_grid_points]=(X,Y)
+        return(self.pools[n_grid_points])
+
+    def get_batch(self,batch_size,n_context,n_target):
+        '''
+        Output: X_context,Y_context - torch.Tensor - shape (batch_size,n_context,2)
+                X_target,Y_target - torch.Tensor - shape (batch_size,n_target,2)
+        '''
+        n_points=n_context+n_target
+        X_pool,Y_pool=self.give_pool(int(math.ceil(math.sqrt(n_points))))
+        inds=torch.arange(batch_size)%self.n_pool
+        perms=torch.stack([torch.randperm(X_pool.size(1))[:n_points] for _ in range(batch_size)],dim=0)
+        X=torch.gather(X_pool[inds],1,perms.unsqueeze(2).expand(batch_size,n_points,2))
+        Y=torch.gather(Y_pool[inds],1,perms.unsqueeze(2).expand(batch_size,n_points,2))
+        return(X[:,:n_context],Y[:,:n_context],X[:,n_context:],Y[:,n_context:])
+
+def run_benchmark(component,params,func,device,n_warmup=2,n_repeats=10):
+    '''
+    Input: component - string - name of the benchmark
+           params - dictionary - parameters of the benchmark
+           func - function without arguments - the code to time
+           n_warmup,n_repeats - int - number of calls before and during timing
+    Output: dictionary - result of the benchmark
+    '''
+    for _ in range(n_warmup):
+        func()
+    profiler=profiling.StageProfiler(device)
+    times=[]
+    for _ in range(n_repeats):
+        start=time.perf_counter()
+        with profiler.stage(component):
+            func()
+        times.append(time.perf_counter()-start)
+    record=profiler.summary()[component]
+    result={'component': component,
+            'params': params,
+            'n_repeats': n_repeats,
+            'mean_time': record['mean_time'],
+            'median_time': float(np.median(times)),
+            'min_time': min(times),
+            'max_time': record['max_time'],
+            'peak_memory_MB': record['peak_memory_MB']}
+    print("%s | %s | median time: %.6fs | min time: %.6fs | peak memory: %.1f MB"\
+          %(component,params,result['median_time'],result['min_time'],result['peak_memory_MB']))
+    return(result)
+
+def give_benchmarks(ARGS,data,device):
+    '''
+    Input: ARGS - dictionary - arguments of the script
+           data - instance of SyntheticData
+    Output: list of (component,params,function) - every distinct benchmark of the grid
+    '''
+    benchmarks=[]
+    seen=set()
+    skipped=set()
+    def add(component,params,func):
+        key=(component,tuple(sorted(params.items())))
+        if key not in seen:
+            seen.add(key)
+            benchmarks.append((component,params,func))
+
+    for batch_size in ARGS['BATCH_SIZE']:
+        for n_context in ARGS['N_CONTEXT']:
+            for n_target in ARGS['N_TARGET']:
+                X_c,Y_c,X_t,Y_t=[tensor.to(device) for tensor in data.get_batch(batch_size,n_context,n_target)]
+                for n_x_axis in ARGS['N_X_AXIS']:
+                    grid=my_utils.give_2d_grid(min_x=X_RANGE[0],max_x=X_RANGE[1],n_x_axis=n_x_axis,flatten=True).to(device)
+                    grid=grid.unsqueeze(0).expand(batch_size,n_x_axis**2,2)
+
+                    if 'encoder' in ARGS['COMPONENTS']:
+                        encoder=equiv_encoder.EquivEncoder(x_range=X_RANGE,n_x_axis=n_x_axis,l_scale=ARGS['L_SCALE_ENC']).to(device)
+                        add('encoder',dict(batch_size=batch_size,n_context=n_context,n_x_axis=n_x_axis),
+                            lambda encoder=encoder,X_c=X_c,Y_c=Y_c: encoder(X_c,Y_c))
+
+                    if 'gram_matrix' in ARGS['COMPONENTS']:
+                        for kernel_type in KERNEL_TYPES:
+                            add('gram_matrix_'+kernel_type,dict(batch_size=batch_size,n_context=n_context,n_target=n_target),
+                                lambda kernel_type=kernel_type,X_c=X_c,X_t=X_t: GP.batch_gram_matrix(X_t,X_c,l_scale=ARGS['L_SCALE_ENC'],kernel_type=kernel_type))
+
+                    if 'kernel_smoother' in ARGS['COMPONENTS']:
+                        Y_grid=torch.randn(batch_size,n_x_axis**2,2,device=device)
+                        add('kernel_smoother',dict(batch_size=batch_size,n_target=n_target,n_x_axis=n_x_axis),
+                            lambda grid=grid,Y_grid=Y_grid,X_t=X_t: GP.batch_kernel_smoother_2d(grid,Y_grid,X_t,l_scale=ARGS['L_SCALE_ENC']))
+
+                    if 'cov_activ_func' in ARGS['COMPONENTS']:
+                        for dim_cov_est in [1,2,3,4]:
+                            Pre_Sigma_Grid=torch.randn(batch_size,n_x_axis**2,dim_cov_est,device=device)
+                            add('cov_activ_func_%d'%dim_cov_est,dict(batch_size=batch_size,n_x_axis=n_x_axis),
+                                lambda Pre_Sigma_Grid=Pre_Sigma_Grid,dim_cov_est=dim_cov_est: cov_activ_func(Pre_Sigma_Grid,dim_cov_est))
+
+                    if 'log_ll' in ARGS['COMPONENTS']:
+                        Covs=torch.eye(2,device=device).expand(batch_size,n_target,2,2)
+                        add('log_ll',dict(batch_size=batch_size,n_target=n_target),
+                            lambda Covs=Covs,X_t=X_t,Y_t=Y_t: my_utils.batch_multivar_log_ll(X_t,Covs,Y_t))
+
+                    if 'decoder' in ARGS['COMPONENTS']:
+                        Embedding=torch.randn(batch_size,3,n_x_axis,n_x_axis,device=device)
+                        for group in ARGS['DECODER_GROUPS']:
+                            names=models.LIST_CNN_NAMES if group=='CNN' else models.LIST_NAMES
+                            for name in names:
+                                if ARGS['DECODER_NAMES'] is not None and name not in ARGS['DECODER_NAMES']:
+                                    continue
+                                component='decoder_'+group+'_'+name
+                                params=dict(batch_size=batch_size,n_x_axis=n_x_axis)
+                                if (component,tuple(sorted(params.items()))) in seen or component in skipped:
+                                    continue
+                                try:
+                                    decoder=give_decoder(group,name).to(device)
+                                except SystemExit:
+                                    print("Skipped %s: architecture not defined for group."%component)
+                                    skipped.add(component)
+                                    continue
+                                decoder.eval()
+                                add(component,params,lambda decoder=decoder,Embedding=Embedding: decoder(Embedding))
+
+                    if 'decoder_layout' in ARGS['COMPONENTS']:
+                        #Embedding in the memory format of the output of the encoder (channels_last):
+                        Embedding=torch.randn(batch_size,n_x_axis,n_x_axis,3,device=device).permute(0,3,1,2)
+                        for group in ARGS['DECODER_GROUPS']:
+                            names=models.LIST_CNN_NAMES if group=='CNN' else models.LIST_NAMES
+                            for name in names:
+                                if ARGS['DECODER_NAMES'] is not None and name not in ARGS['DECODER_NAMES']:
+                                    continue
+                                component='decoder_layout_'+group+'_'+name
+                                if component in skipped:
+                                    continue
+                                for layout in ['contiguous','channels_last']:
+                                    params=dict(batch_size=batch_size,n_x_axis=n_x_axis,layout=layout)
+                                    if (component,tuple(sorted(params.items()))) in seen:
+                                        continue
+                                    try:
+                                        decoder=give_decoder(group,name)
+                                    except SystemExit:
+                                        print("Skipped %s: architecture not defined for group."%component)
+                                        skipped.add(component)
+                                        break
+                                    decoder.eval()
+                                    if group!='CNN':
+                                        decoder=decoder.export()
+                                    decoder=decoder.to(device).set_channels_last(layout=='channels_last')
+                                    add(component,params,lambda decoder=decoder,Embedding=Embedding: decoder(Embedding))
+
+                    if 'train_step' in ARGS['COMPONENTS']:
+                        add('train_step',dict(batch_size=batch_size,n_context=n_context,n_target=n_target,n_x_axis=n_x_axis),
+                            give_train_step(ARGS,n_x_axis,X_c,Y_c,X_t,Y_t,device))
+    return(benchmarks)
+
+def give_train_step(ARGS,n_x_axis,X_c,Y_c,X_t,Y_t,device):
+    '''
+    Output: function without arguments performing one optimization step of a SteerCNP
+    '''
+    encoder=equiv_encoder.EquivEncoder(x_range=X_RANGE,n_x_axis=n_x_axis,l_scale=ARGS['L_SCALE_ENC'])
+    decoder=give_decoder(ARGS['TRAIN_GROUP'],ARGS['TRAIN_ARCHITECTURE'])
+    CNP=steercnp.SteerCNP(encoder,decoder,dim_cov_est=3,dim_context_feat=2,l_scale=ARGS['L_SCALE_ENC']).to(device)
+    optimizer=torch.optim.Adam(CNP.parameters(),lr=1e-4)
+    def train_step():
+        Means,Covs=CNP(X_c,Y_c,X_t)
+        loss,log_ll=CNP.loss(Y_t,Means,Covs)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    return(train_step)
+
+#Print the speedup of channels_last over contiguous memory format per decoder architecture:
+def print_layout_gains(results):
+    times={}
+    for result in results:
+        if result['component'].startswith('decoder_layout_'):
+            params=dict(result['params'])
+            layout=params.pop('layout')
+            times.setdefault((result['component'],tuple(sorted(params.items()))),{})[layout]=result['median_time']
+    for (component,params),layout_times in sorted(times.items()):
+        if len(layout_times)==2:
+            print("%s | %s | channels_last speedup: %.2fx"%(component,dict(params),layout_times['contiguous']/layout_times['channels_last']))
+
+def give_list(string,type_func=int):
+    return([type_func(item) for item in string.split(',')])
+
+'''
+-------------------------------------------------------------------------
+--------------------------RUN BENCHMARKS---------------------------------
+-------------------------------------------------------------------------
+'''
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        OUTPUT_FILE=None,
+        BATCH_SIZE='1,8',
+        N_CONTEXT='10,50',
+        N_TARGET='50,200',
+        N_X_AXIS='20,30',
+        COMPONENTS=','.join(COMPONENTS),
+        DECODER_GROUPS='C4,CNN',
+        DECODER_NAMES=None,
+        TRAIN_GROUP='C4',
+        TRAIN_ARCHITECTURE='regular_little',
+        L_SCALE_ENC=5.,
+        N_WARMUP=2,
+        N_REPEATS=10,
+        N_THREADS=None,
+        SEED=1,
+        DEVICE='cpu')
+
+    ap.add_argument("-out", "--OUTPUT_FILE", type=str, required=False,help="JSON file the results are written to")
+    ap.add_argument("-batch", "--BATCH_SIZE", type=str, required=False,help="Comma-separated list of batch sizes")
+    ap.add_argument("-n_cont", "--N_CONTEXT", type=str, required=False,help="Comma-separated list of context set sizes")
+    ap.add_argument("-n_target", "--N_TARGET", type=str, required=False,help="Comma-separated list of target set sizes")
+    ap.add_argument("-n_x_axis", "--N_X_AXIS", type=str, required=False,help="Comma-separated list of grid sizes of the encoder")
+    ap.add_argument("-comp", "--COMPONENTS", type=str, required=False,help="Comma-separated list of components out of "+','.join(COMPONENTS))
+    ap.add_argument("-groups", "--DECODER_GROUPS", type=str, required=False,help="Comma-separated list of decoder groups (CNN,"+','.join(DECODER_GROUPS)+")")
+    ap.add_argument("-names", "--DECODER_NAMES", type=str, required=False,help="Comma-separated list of decoder names (default: all)")
+    ap.add_argument("-train_group", "--TRAIN_GROUP", type=str, required=False,help="Decoder group of the model of the train step")
+    ap.add_argument("-train_arch", "--TRAIN_ARCHITECTURE", type=str, required=False,help="Decoder name of the model of the train step")
+    ap.add_argument("-l", "--L_SCALE_ENC", type=float, required=False,help="Length scale of encoder, smoother and synthetic data")
+    ap.add_argument("-warmup", "--N_WARMUP", type=int, required=False,help="Number of calls before timing")
+    ap.add_argument("-repeats", "--N_REPEATS", type=int, required=False,help="Number of timed calls")
+    ap.add_argument("-threads", "--N_THREADS", type=int, required=False,help="Number of CPU threads of torch")
+    ap.add_argument("-seed", "--SEED", type=int, required=False,help="Seed for the synthetic data")
+    ap.add_argument("-device", "--DEVICE", type=str, required=False,help="Device")
+    ARGS = vars(ap.parse_args())
+
+    for key in ['BATCH_SIZE','N_CONTEXT','N_TARGET','N_X_AXIS']:
+        ARGS[key]=give_list(ARGS[key])
+    for key in ['COMPONENTS','DECODER_GROUPS','DECODER_NAMES']:
+        if ARGS[key] is not None:
+            ARGS[key]=give_list(ARGS[key],str)
+    if any(component not in COMPONENTS for component in ARGS['COMPONENTS']):
+        sys.exit("Unknown component.")
+    if ARGS['N_THREADS'] is not None:
+        torch.set_num_threads(ARGS['N_THREADS'])
+    if ARGS['OUTPUT_FILE'] is None:
+        ARGS['OUTPUT_FILE']="Benchmark_"+datetime.datetime.today().strftime('%Y_%m_%d_%H_%M')+".json"
+
+    torch.manual_seed(ARGS['SEED'])
+    np.random.seed(ARGS['SEED'])
+    device=torch.device(ARGS['DEVICE'])
+
+    data=SyntheticData(l_scale=ARGS['L_SCALE_ENC'])
+    results=[]
+    for component,params,func in give_benchmarks(ARGS,data,device):
+        results.append(run_benchmark(component,params,func,device,n_warmup=ARGS['N_WARMUP'],n_repeats=ARGS['N_REPEATS']))
+    print_layout_gains(results)
+
+    output={'meta': {'date': datetime.datetime.today().strftime('%Y-%m-%d %H:%M'),
+                     'torch_version': torch.__version__,
+                     'n_threads': torch.get_num_threads(),
+                     'platform': platform.platform(),
+                     'device': ARGS['DEVICE'],
+                     'args': ARGS},
+            'results': results}
+    with open(ARGS['OUTPUT_FILE'],'w') as f:
+        json.dump(output,f,indent=1)
+    print("Saved results in: ", ARGS['OUTPUT_FILE'])
@@ -0,0 +1,92 @@
+#LIBRARIES:
+#Tools:
+import json
+import sys
+import argparse
+
+'''
+-------------------------------------------------------------------------
+--------------------------COMPARE BENCHMARKS-----------------------------
+-------------------------------------------------------------------------
+Compares two JSON result files of benchmark_steercnp.py (a baseline and a new one).
+A benchmark is flagged as a regression if its time (or peak memory) grew by more than the threshold
+relative to the baseline. The script exits with a non-zero status if a regression was found.
+'''
+
+def give_key(result):
+    return((result['component'],tuple(sorted(result['params'].items()))))
+
+def load_results(filename):
+    '''
+    Input: filename - string - JSON file written by benchmark_steercnp.py
+    Output: dictionary - results keyed by (component,params)
+    '''
+    with open(filename,'r') as f:
+        output=json.load(f)
+    return({give_key(result): result for result in output['results']})
+
+def compare_results(Base_Results,New_Results,time_key='median_time',threshold=0.1,memory_threshold=None,min_time=1e-4):
+    '''
+    Input: Base_Results,New_Results - dictionaries - output of load_results
+           time_key - string - which time statistic to compare (median_time,min_time,mean_time)
+           threshold - float - relative increase of time which is flagged as a regression
+           memory_threshold - float/None - relative increase of peak memory which is flagged (None: memory is not compared)
+           min_time - float - benchmarks faster than this (in both files) are not flagged (timer noise)
+    Output: list of dictionaries - one row per benchmark contained in both files
+    '''
+    rows=[]
+    for key in sorted(Base_Results.keys(),key=str):
+        if key not in New_Results:
+            continue
+        base=Base_Results[key]
+        new=New_Results[key]
+        time_ratio=new[time_key]/base[time_key] if base[time_key]>0 else float('inf')
+        memory_ratio=new['peak_memory_MB']/base['peak_memory_MB'] if base['peak_memory_MB']>0 else float('inf')
+        regression=time_ratio>1+threshold and max(base[time_key],new[time_key])>min_time
+        if memory_threshold is not None:
+            regression=regression or memory_ratio>1+memory_threshold
+        rows.append({'component': base['component'],
+                     'params': base['params'],
+                     'base_time': base[time_key],
+                     'new_time': new[time_key],
+                     'time_ratio': time_ratio,
+                     'memory_ratio': memory_ratio,
+                     'regression': regression})
+    return(rows)
+
+def print_rows(rows):
+    for row in rows:
+        print("%s%s | %s | %.6fs -> %.6fs | time x%.3f | memory x%.3f"\
+              %("REGRESSION " if row['regression'] else "",row['component'],row['params'],
+                row['base_time'],row['new_time'],row['time_ratio'],row['memory_ratio']))
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        TIME_KEY='median_time',
+        THRESHOLD=0.1,
+        MEMORY_THRESHOLD=None,
+        MIN_TIME=1e-4)
+
+    ap.add_argument("base", type=str, help="JSON file of the baseline")
+    ap.add_argument("new", type=str, help="JSON file to compare against the baseline")
+    ap.add_argument("-key", "--TIME_KEY", type=str, required=False,help="Time statistic to compare (median_time,min_time,mean_time)")
+    ap.add_argument("-thresh", "--THRESHOLD", type=float, required=False,help="Relative time increase flagged as regression")
+    ap.add_argument("-mem_thresh", "--MEMORY_THRESHOLD", type=float, required=False,help="Relative memory increase flagged as regression")
+    ap.add_argument("-min_time", "--MIN_TIME", type=float, required=False,help="Benchmarks faster than this are not flagged")
+    ARGS = vars(ap.parse_args())
+
+    Base_Results=load_results(ARGS['base'])
+    New_Results=load_results(ARGS['new'])
+    rows=compare_results(Base_Results,New_Results,time_key=ARGS['TIME_KEY'],threshold=ARGS['THRESHOLD'],
+                         memory_threshold=ARGS['MEMORY_THRESHOLD'],min_time=ARGS['MIN_TIME'])
+    print_rows(rows)
+
+    n_missing=len(set(Base_Results.keys())^set(New_Results.keys()))
+    if n_missing>0:
+        print("Number of benchmarks only contained in one of the files: ", n_missing)
+    n_regressions=sum(row['regression'] for row in rows)
+    print("Number of compared benchmarks: %d | Number of regressions: %d"%(len(rows),n_regressions))
+    if n_regressions>0:
+        sys.exit(1)
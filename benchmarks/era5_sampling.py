@@ -0,0 +1,149 @@
+#LIBRARIES:
+#Tensors:
+import numpy as np
+import torch
+
+#Tools:
+import datetime
+import time
+import json
+import os
+import sys
+import platform
+import warnings
+import argparse
+warnings.filterwarnings("ignore", category=UserWarning)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+#Own files:
+import equiv_encoder
+import decoder_models as models
+import evaluation
+import steercnp
+import training
+import tasks.era5.era5_dataset as dataset
+
+#HYPERPARAMETERS and set seed:
+torch.set_default_dtype(torch.float)
+
+'''
+-------------------------------------------------------------------------
+--------------------------ERA5 SAMPLING BENCHMARK------------------------
+-------------------------------------------------------------------------
+Compares the sampling modes of ERA5Dataset.get_rand_batch:
+    'random' - independent random time points (random reads across the netCDF file)
+    'buffer' - contiguous blocks of hours are read sequentially into a shuffle buffer and batches are drawn from the buffer
+1. Data loading: time per batch of get_rand_batch (including reading from the file).
+2. Statistical effect: for every seed, the same ConvCNP (same initialization) is trained with both modes for the same number
+   of iterations and evaluated on the same seeded task manifest of the validation data (see evaluation.py).
+The results are written to a JSON file.
+'''
+MODES=['random','buffer']
+
+def give_model(n_x_axis,l_scale_in,l_scale_out,architecture):
+    encoder=equiv_encoder.EquivEncoder(x_range=[-10,10],n_x_axis=n_x_axis,l_scale=l_scale_in)
+    decoder=models.get_CNNDecoder(architecture,dim_cov_est=4,dim_features_inp=4)
+    return(steercnp.SteerCNP(encoder,decoder,4,dim_context_feat=4,l_scale=l_scale_out))
+
+def give_time_per_batch(data_set,batch_size,n_batches):
+    start=time.perf_counter()
+    for _ in range(n_batches):
+        data_set.get_rand_batch(batch_size=batch_size,cont_in_target=True)
+    return((time.perf_counter()-start)/n_batches)
+
+def give_list(string,type_func=int):
+    return([type_func(item) for item in string.split(',')])
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        TRAIN_FILE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','tasks','era5','era5_us','data','Train_Small_ERA5_US.nc'),
+        VAL_FILE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','tasks','era5','era5_us','data','Valid_Small_ERA5_US.nc'),
+        OUTPUT_FILE=None,
+        ARCHITECTURE='little',
+        N_X_AXIS=20,
+        BATCH_SIZE=30,
+        N_ITERAT=500,
+        LEARNING_RATE=1e-3,
+        BUFFER_SIZE=2400,
+        BLOCK_SIZE=240,
+        N_TIMED_BATCHES=50,
+        N_EVAL_SAMPLES=None,
+        N_THREADS=None,
+        SEEDS='1,2,3')
+
+    ap.add_argument("-train", "--TRAIN_FILE", type=str, required=False,help="netCDF file of the training data")
+    ap.add_argument("-val", "--VAL_FILE", type=str, required=False,help="netCDF file of the validation data")
+    ap.add_argument("-out", "--OUTPUT_FILE", type=str, required=False,help="JSON file the results are written to")
+    ap.add_argument("-A", "--ARCHITECTURE", type=str, required=False,help="Architecture of the CNNDecoder")
+    ap.add_argument("-axis", "--N_X_AXIS", type=int, required=False,help="Number of grid points per axis")
+    ap.add_argument("-batch", "--BATCH_SIZE", type=int, required=False,help="Batch size")
+    ap.add_argument("-it", "--N_ITERAT", type=int, required=False,help="Number of training iterations per run")
+    ap.add_argument("-lr", "--LEARNING_RATE", type=float, required=False,help="Learning rate")
+    ap.add_argument("-buffer", "--BUFFER_SIZE", type=int, required=False,help="Number of maps in the shuffle buffer")
+    ap.add_argument("-block", "--BLOCK_SIZE", type=int, required=False,help="Number of contiguous hours per read")
+    ap.add_argument("-n_timed", "--N_TIMED_BATCHES", type=int, required=False,help="Number of batches to time the data loading")
+    ap.add_argument("-n_eval", "--N_EVAL_SAMPLES", type=int, required=False,help="Number of validation samples (default: all)")
+    ap.add_argument("-threads", "--N_THREADS", type=int, required=False,help="Number of CPU threads of torch")
+    ap.add_argument("-seeds", "--SEEDS", type=str, required=False,help="Comma-separated list of seeds (one training run per mode and seed)")
+    ARGS = vars(ap.parse_args())
+
+    ARGS['SEEDS']=give_list(ARGS['SEEDS'])
+    if ARGS['N_THREADS'] is not None:
+        torch.set_num_threads(ARGS['N_THREADS'])
+    if ARGS['OUTPUT_FILE'] is None:
+        ARGS['OUTPUT_FILE']="Benchmark_ERA5_sampling_"+datetime.datetime.today().strftime('%Y_%m_%d_%H_%M')+".json"
+    DEVICE=torch.device('cpu')
+
+    data_sets={mode: dataset.ERA5Dataset(ARGS['TRAIN_FILE'],2,50,place='US',normalize=True,circular=True,sampling=mode,
+                                         buffer_size=ARGS['BUFFER_SIZE'],block_size=ARGS['BLOCK_SIZE']) for mode in MODES}
+    val_dataset=dataset.ERA5Dataset(ARGS['VAL_FILE'],2,50,place='US',normalize=True,circular=True)
+    manifest=evaluation.give_task_manifest(val_dataset.n_obs,val_dataset.Min_n_cont,val_dataset.Max_n_cont,n_samples=ARGS['N_EVAL_SAMPLES'],
+                                           batch_size=ARGS['BATCH_SIZE'],seed=1)
+
+    #Data loading:
+    time_per_batch={mode: give_time_per_batch(data_sets[mode],ARGS['BATCH_SIZE'],ARGS['N_TIMED_BATCHES']) for mode in MODES}
+
+    #Training runs:
+    results=[]
+    for seed in ARGS['SEEDS']:
+        for mode in MODES:
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            #Empty the shuffle buffer such that every run starts from the same state (and not from the state of the previous run):
+            if mode=='buffer':
+                data_sets[mode].init_buffer(ARGS['BUFFER_SIZE'],ARGS['BLOCK_SIZE'])
+            CNP=give_model(ARGS['N_X_AXIS'],3.,5.,ARGS['ARCHITECTURE'])
+            start=time.time()
+            CNP,_,_=training.train_cnp(CNP,train_dataset=data_sets[mode],val_dataset=val_dataset,data_identifier="ERA5_data",device=DEVICE,
+                                       minibatch_size=ARGS['BATCH_SIZE'],n_epochs=1,n_iterat_per_epoch=ARGS['N_ITERAT'],
+                                       learning_rate=ARGS['LEARNING_RATE'],print_progress=False)
+            train_time=time.time()-start
+            log_ll=evaluation.evaluate(CNP,val_dataset,manifest,DEVICE)['log_ll']
+            print("Seed: %d | sampling: %6s | training time: %.1fs | validation log-likelihood: %.4f"%(seed,mode,train_time,log_ll))
+            results.append({'seed': seed,'sampling': mode,'train_time': train_time,'log_ll': log_ll})
+
+    summary={}
+    for mode in MODES:
+        log_lls=[result['log_ll'] for result in results if result['sampling']==mode]
+        summary[mode]={'time_per_batch': time_per_batch[mode],
+                       'mean_log_ll': float(np.mean(log_lls)),
+                       'std_log_ll': float(np.std(log_lls))}
+        print("%6s | data loading: %.2f ms per batch | validation log-likelihood: %.4f +- %.4f (over %d seeds)"\
+              %(mode,1000*time_per_batch[mode],summary[mode]['mean_log_ll'],summary[mode]['std_log_ll'],len(log_lls)))
+    differences=[result_buffer['log_ll']-result_random['log_ll'] for result_random,result_buffer in zip(results[0::2],results[1::2])]
+    print("Difference of the log-likelihood (buffer-random, paired by seed): %.4f +- %.4f"%(np.mean(differences),np.std(differences)))
+
+    output={'meta': {'date': datetime.datetime.today().strftime('%Y-%m-%d %H:%M'),
+                     'torch_version': torch.__version__,
+                     'n_threads': torch.get_num_threads(),
+                     'platform': platform.platform(),
+                     'args': ARGS},
+            'summary': summary,
+            'log_ll_differences': differences,
+            'results': results}
+    with open(ARGS['OUTPUT_FILE'],'w') as f:
+        json.dump(output,f,indent=1)
+    print("Saved results in: ", ARGS['OUTPUT_FILE'])
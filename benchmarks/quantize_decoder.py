@@ -0,0 +1,158 @@
+#LIBRARIES:
+#Tensors:
+import numpy as np
+import torch
+
+#Tools:
+import datetime
+import time
+import os
+import sys
+import warnings
+import argparse
+warnings.filterwarnings("ignore", category=UserWarning)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+#Own files:
+import architectures
+import evaluation
+import steercnp
+
+#HYPERPARAMETERS and set seed:
+torch.set_default_dtype(torch.float)
+
+'''
+-------------------------------------------------------------------------
+--------------------------INT8 QUANTIZATION OF A CNNDecoder--------------
+-------------------------------------------------------------------------
+Post-training static quantization of the decoder of a trained ConvCNP (SteerCNP with a CNNDecoder) for CPU inference:
+1. The ranges of the activations are calibrated on embeddings of random batches of the training data
+   and the hidden (Conv2d,ReLU)-layers are converted to int8 (see architectures.QuantizedCNNDecoder).
+2. Latency of the decoder and of a full forward pass (median over repeats) are compared to the float model.
+3. Both models are evaluated on the same seeded task manifest of the validation data (see evaluation.py).
+The quantized model can be saved and loaded with SteerCNP.create_model_from_dict.
+'''
+
+#Load the data set:
+def give_data_set(data,split,place='US',Min_n_cont=2,Max_n_cont=50):
+    '''
+    Input: data - string - 'era5' or a GP data set ('rbf','div_free','curl_free')
+           split - string - 'train' or 'valid'
+    Output: data set with get_rand_batch and get_batch
+    '''
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','tasks')
+    if data=='era5':
+        import tasks.era5.era5_dataset as dataset
+        prefix={'train': 'Train','valid': 'Valid'}[split]
+        folder='era5_us' if place=='US' else 'era5_china'
+        filename=os.path.join(path,'era5',folder,'data',prefix+'_Big_ERA5_'+place+'.nc')
+        return(dataset.ERA5Dataset(filename,Min_n_cont,Max_n_cont,place=place,normalize=True,circular=True))
+    else:
+        import tasks.gp.gp_loader as dataLoader
+        return(dataLoader.give_gp_data_set(Min_n_cont,Max_n_cont,data,split,file_path=os.path.join(path,'gp','')))
+
+#Median time of a function:
+def give_latency(func,n_warmup=3,n_repeats=20):
+    '''
+    Output: float - median time of func() in seconds
+    '''
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            func()
+        times=[]
+        for _ in range(n_repeats):
+            start=time.perf_counter()
+            func()
+            times.append(time.perf_counter()-start)
+    return(float(np.median(times)))
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        DATA='era5',
+        PLACE='US',
+        BATCH_SIZE=30,
+        N_CALIB_BATCHES=20,
+        N_EVAL_SAMPLES=None,
+        N_WARMUP=3,
+        N_REPEATS=20,
+        N_THREADS=None,
+        BACKEND='fbgemm',
+        OUT_FILE=None,
+        SEED=1)
+
+    ap.add_argument("-file", "--FILE", type=str, required=True,help="File of the trained model (ConvCNP with CNNDecoder)")
+    ap.add_argument("-data", "--DATA", type=str, required=False,help="era5 or GP data set: rbf, div_free or curl_free")
+    ap.add_argument("-place", "--PLACE", type=str, required=False,help="US or China (only for era5)")
+    ap.add_argument("-batch", "--BATCH_SIZE", type=int, required=False,help="Batch size")
+    ap.add_argument("-n_calib", "--N_CALIB_BATCHES", type=int, required=False,help="Number of calibration batches")
+    ap.add_argument("-n_eval", "--N_EVAL_SAMPLES", type=int, required=False,help="Number of validation samples (default: all)")
+    ap.add_argument("-warmup", "--N_WARMUP", type=int, required=False,help="Warm-up calls per latency measurement")
+    ap.add_argument("-repeats", "--N_REPEATS", type=int, required=False,help="Timed calls per latency measurement")
+    ap.add_argument("-threads", "--N_THREADS", type=int, required=False,help="Number of CPU threads of torch")
+    ap.add_argument("-backend", "--BACKEND", type=str, required=False,help="Quantized engine: fbgemm (x86) or qnnpack (ARM)")
+    ap.add_argument("-out", "--OUT_FILE", type=str, required=False,help="File to save the quantized model to")
+    ap.add_argument("-seed", "--SEED", type=int, required=False,help="Seed")
+    ARGS = vars(ap.parse_args())
+
+    torch.manual_seed(ARGS['SEED'])
+    np.random.seed(ARGS['SEED'])
+    if ARGS['N_THREADS'] is not None:
+        torch.set_num_threads(ARGS['N_THREADS'])
+    DEVICE=torch.device('cpu')
+
+    #Load the float model:
+    dictionary=torch.load(ARGS['FILE'],map_location=DEVICE)
+    if 'CNP_dict' in dictionary:
+        dictionary=dictionary['CNP_dict']
+    if dictionary['decoder_class']!="CNNDecoder":
+        sys.exit("Only models with a CNNDecoder can be quantized.")
+    CNP=steercnp.SteerCNP.create_model_from_dict(dictionary)
+    CNP.eval()
+
+    train_dataset=give_data_set(ARGS['DATA'],'train',ARGS['PLACE'])
+    val_dataset=give_data_set(ARGS['DATA'],'valid',ARGS['PLACE'])
+
+    #Calibrate on embeddings of random training batches:
+    calibration_inputs=[]
+    with torch.no_grad():
+        for _ in range(ARGS['N_CALIB_BATCHES']):
+            x_context,y_context,_,_=train_dataset.get_rand_batch(batch_size=ARGS['BATCH_SIZE'])
+            calibration_inputs.append(CNP.encoder(x_context,y_context))
+    Q_Decoder=architectures.QuantizedCNNDecoder.from_CNNDecoder(CNP.decoder,calibration_inputs,backend=ARGS['BACKEND'])
+
+    #Create the quantized model via the dictionary (same path as loading a saved model):
+    Q_dictionary=CNP.give_dict()
+    Q_dictionary['decoder_dict']=Q_Decoder.give_model_dict()
+    Q_dictionary['decoder_class']=Q_Decoder.__class__.__name__
+    Q_CNP=steercnp.SteerCNP.create_model_from_dict(Q_dictionary)
+    Q_CNP.eval()
+    if ARGS['OUT_FILE'] is not None:
+        torch.save(Q_dictionary,f=ARGS['OUT_FILE'])
+
+    #Latency on a fixed batch:
+    x_context,y_context,x_target,_=val_dataset.get_rand_batch(batch_size=ARGS['BATCH_SIZE'])
+    with torch.no_grad():
+        Embedding=CNP.encoder(x_context,y_context)
+    latency={}
+    for key,Model in [('float',CNP),('int8',Q_CNP)]:
+        latency[key]={'decoder': give_latency(lambda: Model.decoder(Embedding),ARGS['N_WARMUP'],ARGS['N_REPEATS']),
+                      'forward': give_latency(lambda: Model(x_context,y_context,x_target),ARGS['N_WARMUP'],ARGS['N_REPEATS'])}
+
+    #Log-likelihood on the same validation tasks:
+    manifest=evaluation.give_task_manifest(val_dataset.n_obs,val_dataset.Min_n_cont,val_dataset.Max_n_cont,n_samples=ARGS['N_EVAL_SAMPLES'],
+                                           batch_size=ARGS['BATCH_SIZE'],seed=ARGS['SEED'])
+    log_ll={'float': evaluation.evaluate(CNP,val_dataset,manifest,DEVICE)['log_ll'],
+            'int8': evaluation.evaluate(Q_CNP,val_dataset,manifest,DEVICE)['log_ll']}
+
+    print("Filename: ", ARGS['FILE'])
+    print("Time: ", datetime.datetime.today())
+    print("Threads: ", torch.get_num_threads(), " | backend: ", ARGS['BACKEND'])
+    for key in ['float','int8']:
+        print("%5s | decoder: %.2f ms | forward: %.2f ms | validation log-likelihood: %.4f"%(key,1000*latency[key]['decoder'],
+                                                                                         1000*latency[key]['forward'],log_ll[key]))
+    print("Speedup decoder: %.2fx | speedup forward: %.2fx"%(latency['float']['decoder']/latency['int8']['decoder'],
+                                                             latency['float']['forward']/latency['int8']['forward']))
+    print("Log-likelihood degradation: %.4f"%(log_ll['float']-log_ll['int8']))
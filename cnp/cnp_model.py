@@ -11,6 +11,7 @@ from numpy import savetxt
 sys.path.append('../')
 import cnp.enc_dec_models as models
 import my_utils
+from profiling import profile_stage
 
 class ConditionalNeuralProcess(nn.Module):
     def __init__(self, dim_X, dim_Y_in,dim_Y_out, dim_R, hidden_layers_encoder, 
@@ -42,11 +43,14 @@ class ConditionalNeuralProcess(nn.Module):
 
         #Intialize the decoder:
         self.decoder=models.CNPDecoder(dim_X=dim_X, dim_Y=dim_Y_out, dim_R=dim_R, hidden_layers=hidden_layers_decoder)
+
+        #Profiler for the stages of the forward pass (None means no profiling, see profiling.StageProfiler):
+        self.profiler=None
         
         if state_dict is not None:
             self.load_state_dict(state_dict)
 
-    def forward(self,x_context,y_context,x_target):
+    def forward(self,x_context,y_context,x_target,mask_context=None):
         '''
         Input:
           x_context: torch.Tensor
@@ -55,32 +59,99 @@ class ConditionalNeuralProcess(nn.Module):
                       Shape (batch_size,n_context_points,self.dim_Y)
           x_target:  torch.Tensor
                       Shape (batch_size,n_target_points,self.dim_X)
+          mask_context: torch.Tensor/None
+                      Shape (batch_size,n_context_points) - 1. for context points, 0. for padding
         Output:
             mean_vec - torch.Tensor - shape (batch_size,n_target_points,self.dim_Y)
             Covs - torch.Tensor - shape (batch_size,n_target_points,self.dim_Y,self.dim_Y)
         '''
         batch_size,n_target_points,_=x_target.size()
 
-        r=self.encoder(x_context,y_context) #Shape of r: (batch_size,self.dim_R)
+        with profile_stage(self.profiler,'encoder'):
+            r=self.encoder(x_context,y_context,mask=mask_context) #Shape of r: (batch_size,self.dim_R)
         
-        mean_vec, scale_vec=self.decoder(x=x_target,r=r)
+        with profile_stage(self.profiler,'decoder'):
+            mean_vec, scale_vec=self.decoder(x=x_target,r=r)
         
         Covs=scale_vec.diag_embed()
         return mean_vec,Covs
 
-    def loss(self,Y_Target,Predict,Covs,shape_reg=None):
+    #Two-phase version of the forward pass: the context set is only encoded once, the target set can be queried many times.
+    #1.Condition on the context set:
+    def condition(self,x_context,y_context,mask_context=None):
+        '''
+        Input: x_context,y_context,mask_context - see self.forward
+        Output: handle - dictionary - 'r': torch.Tensor - shape (batch_size,self.dim_R) - representation of the context set
+        '''
+        with profile_stage(self.profiler,'encoder'):
+            r=self.encoder(x_context,y_context,mask=mask_context)
+        return({'r': r})
+
+    #2.Predict on a target set:
+    def predict(self,handle,x_target):
+        '''
+        Input: handle - dictionary - output of self.condition
+               x_target - torch.Tensor - shape (batch_size,n_target_points,self.dim_X)
+        Output: mean_vec,Covs - see self.forward
+        '''
+        with profile_stage(self.profiler,'decoder'):
+            mean_vec, scale_vec=self.decoder(x=x_target,r=handle['r'])
+        return mean_vec,scale_vec.diag_embed()
+
+    #Streaming predictions on large target sets: the representation r is computed once and the decoder MLP
+    #is applied to chunks of the target set such that its activations stay within a memory budget.
+    def give_target_chunk_size(self,batch_size,memory_budget_MB=256.):
+        '''
+        Input: batch_size - int
+               memory_budget_MB - float - memory budget of the decoder in MB
+        Output: int - number of target points per chunk
+        '''
+        #Floats per target point: input (x and r, r only if it is not fused, see CNPDecoder), hidden activations (before and after the ReLU) and output:
+        n_floats=self.dim_X+2*sum(self.decoder.hidden_layers)+4*self.dim_Y_out+self.dim_Y_out**2
+        if not self.decoder.fused_first_layer:
+            n_floats+=self.dim_R
+        return(max(int(memory_budget_MB*1024**2//(4*batch_size*n_floats)),1))
+
+    def predict_chunks(self,handle,x_target,memory_budget_MB=256.,chunk_size=None):
+        '''
+        Input: handle - dictionary - output of self.condition
+               x_target - torch.Tensor - shape (batch_size,n_target_points,self.dim_X)
+               memory_budget_MB - float - memory budget of the decoder (ignored if chunk_size is given)
+               chunk_size - int/None - number of target points per chunk
+        Output: generator of (mean_vec,Covs) per chunk of target points - see self.forward
+        '''
+        if chunk_size is None:
+            chunk_size=self.give_target_chunk_size(x_target.size(0),memory_budget_MB)
+        return(my_utils.chunked_predictions(lambda x_chunk: self.predict(handle,x_chunk),x_target,chunk_size))
+
+    def predict_chunked(self,handle,x_target,memory_budget_MB=256.,chunk_size=None):
+        '''
+        Same as self.predict_chunks but the chunks are concatenated --> mean_vec,Covs - see self.forward
+        '''
+        mean_list,Covs_list=zip(*self.predict_chunks(handle,x_target,memory_budget_MB,chunk_size))
+        return torch.cat(mean_list,dim=1),torch.cat(Covs_list,dim=1)
+
+    def forward_chunked(self,x_context,y_context,x_target,mask_context=None,memory_budget_MB=256.,chunk_size=None):
+        '''
+        Same as self.forward but the target set is processed in chunks (see self.predict_chunks)
+        '''
+        handle=self.condition(x_context,y_context,mask_context=mask_context)
+        return self.predict_chunked(handle,x_target,memory_budget_MB,chunk_size)
+
+    def loss(self,Y_Target,Predict,Covs,shape_reg=None,mask=None):
         '''
             Inputs: Y_Target: torch.tensor - shape (batch_size,n,2) - Target set locations and vectors
                     Predict: torch.tensor - shape (batch_size,n,2) - Predictions of Y_Target at X_Target
                     Covs: torch.tensor - shape (batch_size,n,2,2) - covariance matrices of Y_Target at X_Target
+                    mask: torch.tensor/None - shape (batch_size,n) - 1. for target points, 0. for padding
             Output: -log_ll,log_ll
         '''
         log_ll_vec=my_utils.batch_multivar_log_ll(Means=Predict,Covs=Covs,data=Y_Target)
-        log_ll=log_ll_vec.mean()
+        log_ll=my_utils.masked_mean(log_ll_vec,mask)
         if shape_reg is None:
             loss=-log_ll
         else:
-            loss=-log_ll+shape_reg*utils.shape_regularizer(Y_Target,Predict).mean()
+            loss=-log_ll+shape_reg*my_utils.shape_regularizer(Y_Target,Predict,mask=mask).mean()
         return(loss,log_ll)
 
     def give_dict(self):
@@ -39,13 +39,15 @@ class CNPEncoder(nn.Module):
 
         self.encoder=nn.Sequential(*layers_list)
 
-    def forward(self,x,y):
+    def forward(self,x,y,mask=None):
         '''
         Input:
         x: torch.Tensor
            Shape (batch_size,n_context_points,self.dim_X)
         y: torch.Tensor
            Shape (batch_size,n_context_points,self.dim_Y)
+        mask: torch.Tensor/None
+           Shape (batch_size,n_context_points) - 1. for context points, 0. for padding
         Output:
         encoder_mean: torch.Tensor
                       Shape (batch_size,self.dim_R)
@@ -61,8 +63,11 @@ class CNPEncoder(nn.Module):
 
         encoder_input_pairs=torch.cat((x,y),dim=2)
         encoder_output=self.encoder(encoder_input_pairs)
-        #Take the mean of the vectors:
-        encoder_mean=encoder_output.mean(dim=1)
+        #Take the mean of the vectors (only over the context points which are not padding):
+        if mask is None:
+            encoder_mean=encoder_output.mean(dim=1)
+        else:
+            encoder_mean=(encoder_output*mask.unsqueeze(2)).sum(dim=1)/mask.sum(dim=1,keepdim=True)
         return(encoder_mean)
         
 class CNPDecoder(nn.Module):
@@ -84,6 +89,8 @@ class CNPDecoder(nn.Module):
         self.dim_Y=dim_Y
         self.hidden_layers=hidden_layers
         self.dim_R=dim_R
+        #If True, the first layer is split into W_x x+(W_r r+b) where the second term is computed once per task (see forward):
+        self.fused_first_layer=True
         
         if (len(hidden_layers)==0):
             layers_list=[nn.Linear(dim_X +self.dim_R, 2*self.dim_Y)]
@@ -126,12 +133,21 @@ class CNPDecoder(nn.Module):
             sys.exit("Input r for Decoder has the wrong shape.")
 
 
-        #Expand r by adding a dimension for the target points and replicate them:
-        r=r.unsqueeze(1).expand(batch_size,n_target_points,self.dim_R)
-        decoder_input=torch.cat((x,r),dim=2)
-
-        #Send the input through the MLP:
-        decoder_output=self.decoder(decoder_input)
+        if self.fused_first_layer:
+            #The first layer applied to (x,r) is W_x x+(W_r r+b) - the part of r is the same for all target points
+            #and is computed once per task and broadcasted (the parameters are the same as for the concatenated input):
+            first_layer=self.decoder[0]
+            r_term=F.linear(r,first_layer.weight[:,self.dim_X:],first_layer.bias)
+            hidden=torch.matmul(x,first_layer.weight[:,:self.dim_X].t())+r_term.unsqueeze(1)
+            #Send it through the rest of the MLP:
+            decoder_output=self.decoder[1:](hidden)
+        else:
+            #Expand r by adding a dimension for the target points and replicate them:
+            r=r.unsqueeze(1).expand(batch_size,n_target_points,self.dim_R)
+            decoder_input=torch.cat((x,r),dim=2)
+
+            #Send the input through the MLP:
+            decoder_output=self.decoder(decoder_input)
 
         #First half of the components is the mean vector:
         mean_vec=decoder_output[:,:,:self.dim_Y]
@@ -0,0 +1,113 @@
+#LIBRARIES:
+#Tensors:
+import torch
+
+#Tools:
+import hashlib
+from collections import OrderedDict
+import sys
+
+'''
+-------------------------------------------------------------------------
+--------------------------CONTEXT CACHE----------------------------------
+-------------------------------------------------------------------------
+A least-recently-used cache of conditioned context sets (handles of SteerCNP.condition or
+ConditionalNeuralProcess.condition) keyed on a hash of the context tensors.
+If one context set is queried with many different target sets, the encoder and decoder only run once.
+The cache is bounded by the memory of the stored handles: if it is exceeded, the least recently used handles are evicted.
+Handles are computed without gradients, i.e. the cache is meant for inference only.
+'''
+class ContextCache(object):
+    def __init__(self,CNP,max_memory_MB=512.):
+        '''
+        Input: CNP - model with functions condition and predict (see SteerCNP)
+               max_memory_MB - float - maximal memory of all stored handles in MB
+        '''
+        self.CNP=CNP
+        self.max_memory_MB=max_memory_MB
+        self.clear()
+
+        if max_memory_MB<=0:
+            sys.exit("Memory budget of the cache has to be positive.")
+
+    def clear(self):
+        '''
+        Deletes all handles (has to be called if the parameters of the model change).
+        '''
+        self.handles=OrderedDict()
+        self.memory_MB=0.
+        self.n_hits=0
+        self.n_misses=0
+        self.n_evictions=0
+
+    def give_key(self,X_context,Y_context,mask_context=None):
+        '''
+        Input: X_context,Y_context,mask_context - torch.Tensor - context set (see SteerCNP.forward)
+        Output: string - sha256 hex digest of shapes, data types and values of the tensors
+        '''
+        sha=hashlib.sha256()
+        for tensor in [X_context,Y_context,mask_context]:
+            if tensor is None:
+                sha.update(b'None')
+            else:
+                tensor=tensor.detach().cpu().contiguous()
+                sha.update(str((tuple(tensor.shape),tensor.dtype)).encode())
+                sha.update(tensor.numpy().tobytes())
+        return(sha.hexdigest())
+
+    def give_handle_memory(self,handle):
+        '''
+        Output: float - memory of the tensors of a handle in MB (the memory of the underlying storages, counted once per storage,
+                such that views of larger tensors are counted with the memory they keep alive)
+        '''
+        storages={}
+        for tensor in handle.values():
+            storage=tensor.storage()
+            storages[storage.data_ptr()]=storage.size()*tensor.element_size()
+        return(sum(storages.values())/1024**2)
+
+    def get_handle(self,X_context,Y_context,mask_context=None):
+        '''
+        Input: X_context,Y_context,mask_context - torch.Tensor - context set (see SteerCNP.forward)
+        Output: handle - dictionary - output of self.CNP.condition (from the cache if possible)
+        '''
+        key=self.give_key(X_context,Y_context,mask_context)
+        if key in self.handles:
+            self.n_hits+=1
+            self.handles.move_to_end(key)
+            return(self.handles[key])
+
+        self.n_misses+=1
+        with torch.no_grad():
+            handle=self.CNP.condition(X_context,Y_context,mask_context=mask_context)
+        memory=self.give_handle_memory(handle)
+        #Handles larger than the budget are not stored:
+        if memory>self.max_memory_MB:
+            return(handle)
+        #Evict the least recently used handles until the new handle fits:
+        while self.memory_MB+memory>self.max_memory_MB:
+            _,evicted=self.handles.popitem(last=False)
+            self.memory_MB-=self.give_handle_memory(evicted)
+            self.n_evictions+=1
+        self.handles[key]=handle
+        self.memory_MB+=memory
+        return(handle)
+
+    def predict(self,X_context,Y_context,X_target,mask_context=None):
+        '''
+        Input: X_context,Y_context,X_target,mask_context - see SteerCNP.forward
+        Output: Means,Covs - see SteerCNP.forward
+        '''
+        handle=self.get_handle(X_context,Y_context,mask_context)
+        with torch.no_grad():
+            return(self.CNP.predict(handle,X_target))
+
+    def give_stats(self):
+        '''
+        Output: dictionary - number of stored handles, memory in MB, hits, misses and evictions
+        '''
+        return({'n_handles': len(self.handles),
+                'memory_MB': self.memory_MB,
+                'n_hits': self.n_hits,
+                'n_misses': self.n_misses,
+                'n_evictions': self.n_evictions})
@@ -56,6 +56,13 @@ LIST_NAMES=["regular_little",
 "irrep_huge"
 ]
 
+LIST_CNN_NAMES=["little",
+"small",
+"middle",
+"big",
+"huge"
+]
+
 def get_SO2_Decoder(name,dim_cov_est,context_rep_ids):
     N=-1
     flip=False
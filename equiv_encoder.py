@@ -38,7 +38,7 @@ torch.set_default_dtype(torch.float)
 
 class EquivEncoder(nn.Module):
     def __init__(self, x_range,n_x_axis,y_range=None,n_y_axis=None,
-                 l_scale=1.,normalize=True,train_l_scale=False):
+                 l_scale=1.,normalize=True,train_l_scale=False,adaptive_grid=False,points_per_l_scale=None,grid_sizes=[16,24,32,48,64,96]):
         super(EquivEncoder, self).__init__()
         '''
         Inputs:
@@ -47,11 +47,20 @@ class EquivEncoder(nn.Module):
             n_y_axis: int - number of grid points along the y-axis
             l_scale: float - initialisation of length scale
             normalize: boolean - indicates whether feature channels is divided by density channel
+            adaptive_grid: boolean - if True, the grid is chosen per batch from the bounding box of the context and target points
+                           (see self.give_adaptive_grid) and the fixed grid is only used if no grid is given to self.forward
+            points_per_l_scale: float/None - resolution of the adaptive grid: number of grid points per length of the kernel
+                                (None: same spacing as the fixed grid)
+            grid_sizes: list of ints - canonical numbers of grid points per axis the adaptive grid is bucketed to
         '''
         #-------------------------SET PARAMETERS-----------------
         #Save whether to normalize and train l scale:
         self.normalize=normalize
         self.train_l_scale=train_l_scale
+        #Parameters of the adaptive grid:
+        self.adaptive_grid=adaptive_grid
+        self.points_per_l_scale=points_per_l_scale
+        self.grid_sizes=sorted(grid_sizes)
         
         #Kernel parameters:
         self.kernel_type="rbf"
@@ -86,6 +95,8 @@ class EquivEncoder(nn.Module):
             sys.exit("Encoder error: l_scale not correct.")
         if self.x_range[0]>=self.x_range[1] or self.y_range[0]>=self.y_range[1]:
             sys.exit("x and y range are not valid.")
+        if points_per_l_scale is not None and points_per_l_scale<=0:
+            sys.exit("Encoder error: points_per_l_scale has to be positive.")
         #-------------------------CONTROL PARAMETERS FINISHED-----------------
 
     #Function to add a one to every vector: y->(1,y):
@@ -96,38 +107,87 @@ class EquivEncoder(nn.Module):
         '''
         return(torch.cat([torch.ones([Y.size(0),Y.size(1),1],device=Y.device),Y],dim=2))
 
-    def forward(self,X,Y):
+    #Function to choose a grid for a batch: the extent is given by the bounding box of the context points (plus a margin of one length scale)
+    #extended to the target points which are at most three length scales away from it (further away, the density channel is numerically zero),
+    #the spacing by the number of grid points per length scale. The number of grid points per axis is rounded up to
+    #the next canonical size (the grid is extended symmetrically) such that only few different shapes reach the decoder.
+    def give_adaptive_grid(self,X_context,X_target=None,min_size=1):
+        '''
+        Input: X_context - torch.Tensor - shape (batch_size,n_context,2)
+               X_target - torch.Tensor - shape (batch_size,n_target,2) (or None)
+               min_size - int - minimal number of grid points per axis (e.g. the largest kernel size of the decoder)
+        Output: grid_dict - dictionary - 'grid': torch.Tensor - shape (n_y_axis*n_x_axis,2) - ordered as self.grid
+                                         'n_x_axis','n_y_axis': int - number of grid points per axis
+        '''
+        #The rbf kernel uses l_scale as a squared length (exp(-0.5*|x-y|^2/l_scale)):
+        length=torch.exp(self.log_l_scale).detach().sqrt().item()
+        if self.points_per_l_scale is None:
+            spacing=(self.x_range[1]-self.x_range[0])/max(self.n_x_axis-1,1)
+        else:
+            spacing=length/self.points_per_l_scale
+        device=X_context.device
+        X_context=X_context.detach().reshape(-1,2).cpu()
+        Min=X_context.min(dim=0)[0]-length
+        Max=X_context.max(dim=0)[0]+length
+        if X_target is not None:
+            X_target=X_target.detach().reshape(-1,2).cpu()
+            Min=torch.min(Min,torch.max(X_target.min(dim=0)[0],Min-2*length))
+            Max=torch.max(Max,torch.min(X_target.max(dim=0)[0],Max+2*length))
+        n_axis=[]
+        for extent in (Max-Min).tolist():
+            n=max(int(math.ceil(extent/spacing))+1,min_size)
+            #Round up to the next canonical size (larger grids than the largest size are rounded up to a multiple of it):
+            n_axis.append(next((size for size in self.grid_sizes if size>=n),int(math.ceil(n/self.grid_sizes[-1]))*self.grid_sizes[-1]))
+        #Extend the bounding box symmetrically to the rounded size:
+        Center=(Min+Max)/2
+        Half_Width=torch.tensor([(n_axis[0]-1)*spacing/2,(n_axis[1]-1)*spacing/2])
+        grid=my_utils.give_2d_grid(min_x=(Center[0]-Half_Width[0]).item(),max_x=(Center[0]+Half_Width[0]).item(),
+                                   min_y=(Center[1]+Half_Width[1]).item(),max_y=(Center[1]-Half_Width[1]).item(),
+                                   n_x_axis=n_axis[0],n_y_axis=n_axis[1],flatten=True).to(device)
+        return({'grid': grid,'n_x_axis': n_axis[0],'n_y_axis': n_axis[1]})
+
+    def forward(self,X,Y,mask=None,grid_dict=None):
         '''
         Inputs:
             X: torch.Tensor - shape (batch_size,n,2)
             Y: torch.Tensor - shape (batch_size,n,dim_Y)
+            mask: torch.Tensor - shape (batch_size,n) - 1. for context points, 0. for padding (None: no padding)
+            grid_dict: dictionary - output of self.give_adaptive_grid (None: the fixed grid self.grid is used)
         Outputs:
-            torch.Tensor - shape (batch_size,dim_Y+1,self.n_y_axis,self.n_x_axis)
+            torch.Tensor - shape (batch_size,dim_Y+1,n_y_axis,n_x_axis) (n_y_axis=self.n_y_axis,n_x_axis=self.n_x_axis for the fixed grid)
         '''
         #DEBUG: Control whether X and the grid are on the same device:
         if self.grid.device!=X.device:
             self.grid=self.grid.to(X.device)
+        if grid_dict is None:
+            grid,n_y_axis,n_x_axis=self.grid,self.n_y_axis,self.n_x_axis
+        else:
+            grid,n_y_axis,n_x_axis=grid_dict['grid'],grid_dict['n_y_axis'],grid_dict['n_x_axis']
         
         #Get the batch size:
         batch_size=X.size(0)
         #Compute the length scale out of the log-scale (clamp for numerical stability):
         l_scale=torch.exp(self.log_l_scale)#torch.clamp(self.log_l_scale,max=5.,min=-5.))
         
-        #Compute for every grid-point x' the value k(x',x_i) for all x_i in the data-->shape (batch_size,self.n_y_axis*self.n_x_axis,n)
-        Gram=GP.batch_gram_matrix(self.grid.unsqueeze(0).expand(batch_size,self.n_y_axis*self.n_x_axis,2),
+        #Compute for every grid-point x' the value k(x',x_i) for all x_i in the data-->shape (batch_size,n_y_axis*n_x_axis,n)
+        Gram=GP.batch_gram_matrix(grid.unsqueeze(0).expand(batch_size,n_y_axis*n_x_axis,2),
                                   X,l_scale=l_scale,kernel_type=self.kernel_type,B=torch.ones((1),device=X.device))
+        #Padded context points do not contribute to the feature map:
+        if mask is not None:
+            Gram=Gram*mask.unsqueeze(1)
         
         #Compute feature expansion --> shape (batch_size,n,self.dim_Y+1)
         Expand_Y=self.expand_with_ones(Y)
-        #Compute feature map -->shape (self.n_y_axis*self.n_x_axis,self.dim_Y+1)
+        #Compute feature map -->shape (n_y_axis*n_x_axis,self.dim_Y+1)
         Feature_Map=torch.matmul(Gram,Expand_Y)
 
         #If wanted, normalize the weights for the channel which is not the density channel:
         if self.normalize:
             Feature_Map[:,:,1:]=Feature_Map[:,:,1:]/Feature_Map[:,:,0].unsqueeze(2)
         
-        #Reshape the Feature Map to the form (batch_size,dim_Y+1,self.n_y_axis,self.n_x_axis) (because this is the form required for a an EquivCNN):
-        return(Feature_Map.reshape(batch_size,self.n_y_axis,self.n_x_axis,Expand_Y.size(2)).permute(dims=(0,3,1,2)))     
+        #Reshape the Feature Map to the form (batch_size,dim_Y+1,n_y_axis,n_x_axis) (because this is the form required for a an EquivCNN)
+        #-the permutation is a view, i.e. the memory format of the output is channels_last (NHWC):
+        return(Feature_Map.reshape(batch_size,n_y_axis,n_x_axis,Expand_Y.size(2)).permute(dims=(0,3,1,2)))     
     
     def plot_embedding(self,Embedding,X_context=None,Y_context=None,title="",quiver_scale=1.,size_scale=2):
         '''
@@ -195,7 +255,10 @@ class EquivEncoder(nn.Module):
             'n_y_axis':self.n_y_axis,
             'l_scale': torch.exp(self.log_l_scale).item(),
             'normalize': self.normalize,
-            'train_l_scale': self.train_l_scale
+            'train_l_scale': self.train_l_scale,
+            'adaptive_grid': self.adaptive_grid,
+            'points_per_l_scale': self.points_per_l_scale,
+            'grid_sizes': self.grid_sizes
         }
         return(dictionary)
 
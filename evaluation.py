@@ -0,0 +1,223 @@
+#LIBRARIES:
+#Tensors:
+import torch
+import numpy as np
+
+#Tools:
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+#Own files:
+import my_utils
+from training import send_batch_to_device
+
+'''
+-------------------------------------------------------------------------
+--------------------------EVALUATION ENGINE------------------------------
+-------------------------------------------------------------------------
+Deterministic evaluation of a CNP model on a data set:
+1. A seeded task manifest is generated: for every batch the indices of the observations, the number of context
+   points and a seed. Before a batch is loaded, torch and numpy are reseeded with the seed of the batch such that
+   the permutations and transformations drawn in dataset.get_batch only depend on the manifest (the global random
+   states are restored afterwards).
+2. The manifest can be sharded across a process pool (CPU only) - the per-task log-likelihoods are merged afterwards.
+3. Results are cached in a directory keyed by a hash of the model parameters, the manifest and the data identifier,
+   i.e. re-evaluating an unchanged model is free.
+'''
+
+#Generate a task manifest:
+def give_task_manifest(n_obs,Min_n_cont,Max_n_cont,n_samples=None,batch_size=1,n_data_passes=1,seed=1,variable_context=False):
+    '''
+    Input: n_obs - int - number of observations of the data set
+           Min_n_cont,Max_n_cont - int - range of the number of context points
+           n_samples - int/None - number of samples per data pass (None: all observations)
+           batch_size - int - size of the batches
+           n_data_passes - int - number of data passes
+           seed - int - seed of the manifest
+           variable_context - Boolean - if True, every task of a batch has its own number of context points
+    Output: dictionary - 'batches': list of dictionaries with keys 'inds' (list of ints), 'n_context' (int or list of ints)
+                         and 'seed' (int) and the parameters of the manifest
+    '''
+    generator=torch.Generator()
+    generator.manual_seed(seed)
+    n_samples_max=n_obs if n_samples is None else min(n_samples,n_obs)
+    n_iterat=max(n_samples_max//batch_size,1)
+    batches=[]
+    for j in range(n_data_passes):
+        ind_list=torch.randperm(n_obs,generator=generator)[:n_samples_max]
+        for it in range(n_iterat):
+            inds=ind_list[it*batch_size:(it+1)*batch_size]
+            n_context=torch.randint(low=Min_n_cont,high=Max_n_cont,size=[len(inds) if variable_context else 1],generator=generator)
+            batches.append({'inds': inds.tolist(),
+                            'n_context': n_context.tolist() if variable_context else n_context.item(),
+                            'seed': torch.randint(low=0,high=2**31-1,size=[1],generator=generator).item()})
+    manifest={'seed': seed,
+              'n_obs': n_obs,
+              'Min_n_cont': Min_n_cont,
+              'Max_n_cont': Max_n_cont,
+              'batch_size': batch_size,
+              'n_data_passes': n_data_passes,
+              'variable_context': variable_context,
+              'batches': batches}
+    return(manifest)
+
+#Convert a (nested) model dictionary to JSON-serialisable objects (tensors and arrays are replaced by their shape and a hash):
+def _serialise(obj):
+    if torch.is_tensor(obj):
+        obj=obj.detach().cpu().contiguous().numpy()
+    if isinstance(obj,np.ndarray):
+        return({'shape': list(obj.shape),'dtype': str(obj.dtype),'sha256': hashlib.sha256(obj.tobytes()).hexdigest()})
+    elif isinstance(obj,dict):
+        return({str(key): _serialise(value) for key,value in obj.items()})
+    elif isinstance(obj,(list,tuple)):
+        return([_serialise(value) for value in obj])
+    else:
+        return(obj)
+
+#Hash of the parameters, buffers and settings of a model:
+def give_model_hash(CNP):
+    '''
+    Input: CNP - nn.Module
+    Output: string - sha256 hex digest of the class name, the state dict and (if the model has give_dict) the dictionary of CNP
+            (settings which are not parameters, e.g. normalize_output or the decoder type, change predictions as well)
+    '''
+    sha=hashlib.sha256(CNP.__class__.__name__.encode())
+    for key,tensor in sorted(CNP.state_dict().items()):
+        sha.update(key.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    if hasattr(CNP,'give_dict'):
+        sha.update(json.dumps(_serialise(CNP.give_dict()),sort_keys=True,default=str).encode())
+    return(sha.hexdigest())
+
+#Hash of a manifest:
+def give_manifest_hash(manifest):
+    return(hashlib.sha256(json.dumps(manifest,sort_keys=True).encode()).hexdigest())
+
+#Load the batch of a manifest:
+def give_manifest_batch(dataset,batch_dict,variable_context=False):
+    '''
+    Input: dataset - data set with get_batch(inds,n_context_points,cont_in_target,variable_context)
+           batch_dict - dictionary - batch of a manifest (see give_task_manifest)
+    Output: output of dataset.get_batch
+    The global random states of torch and numpy are reseeded with the seed of the batch (such that the permutations and
+    transformations are determined by the manifest) and restored afterwards.
+    '''
+    np_state=np.random.get_state()
+    try:
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(batch_dict['seed'])
+            np.random.seed(batch_dict['seed'])
+            n_context_points=torch.tensor(batch_dict['n_context']) if variable_context else batch_dict['n_context']
+            batch=dataset.get_batch(inds=torch.tensor(batch_dict['inds']),n_context_points=n_context_points,
+                                    cont_in_target=False,variable_context=variable_context)
+    finally:
+        np.random.set_state(np_state)
+    return(batch)
+
+#Evaluate the batches of a manifest:
+def evaluate_batches(CNP,dataset,batches,device,variable_context=False):
+    '''
+    Input: CNP - model (see SteerCNP, ConditionalNeuralProcess)
+           dataset - data set with get_batch(inds,n_context_points,cont_in_target,variable_context)
+           batches - list of dictionaries - batches of a manifest (see give_task_manifest)
+    Output: list of lists of floats - per batch the mean log-likelihood per task
+    '''
+    results=[]
+    with torch.no_grad():
+        for batch_dict in batches:
+            batch=give_manifest_batch(dataset,batch_dict,variable_context)
+            x_context,y_context,x_target,y_target,mask_context,mask_target=send_batch_to_device(batch,device)
+            Means,Sigmas=CNP(x_context,y_context,x_target,mask_context=mask_context)
+            log_ll_vec=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target).view(x_target.size(0),x_target.size(1))
+            if mask_target is None:
+                task_log_ll=log_ll_vec.mean(dim=1)
+            else:
+                task_log_ll=(log_ll_vec*mask_target).sum(dim=1)/mask_target.sum(dim=1)
+            results.append(task_log_ll.cpu().tolist())
+    return(results)
+
+#Model and data set of the workers (set before forking, such that they are not pickled):
+_WORKER_STATE={}
+
+def _evaluate_shard(shard):
+    '''
+    Input: shard - list of (position,batch_dict)
+    Output: list of (position,list of floats)
+    '''
+    torch.set_num_threads(_WORKER_STATE['n_threads'])
+    positions,batches=zip(*shard)
+    results=evaluate_batches(_WORKER_STATE['CNP'],_WORKER_STATE['dataset'],list(batches),torch.device('cpu'),
+                             variable_context=_WORKER_STATE['variable_context'])
+    return(list(zip(positions,results)))
+
+#Evaluate a model on a manifest:
+def evaluate(CNP,dataset,manifest,device,n_workers=1,cache_dir=None,data_identifier=''):
+    '''
+    Input: CNP - model (see SteerCNP, ConditionalNeuralProcess)
+           dataset - data set with get_batch(inds,n_context_points,cont_in_target,variable_context)
+           manifest - dictionary - output of give_task_manifest
+           device - instance of torch.device
+           n_workers - int - number of processes the manifest is sharded across (only on a CPU)
+           cache_dir - string/None - if not None, the results are cached in this directory
+           data_identifier - string - identifies the data and the settings of the data set (part of the cache key,
+                             e.g. ERA5Dataset.give_data_identifier)
+    Output: dictionary - 'log_ll': mean log-likelihood over all tasks
+                         'task_log_ll': list of floats - mean log-likelihood per task (in the order of the manifest)
+                         'n_tasks': int - number of tasks
+                         'time': float - wall time of the evaluation (of the original run if loaded from the cache)
+                         'cached': Boolean - indicates whether the results were loaded from the cache
+    '''
+    #Load from the cache if possible:
+    if cache_dir is not None:
+        key=hashlib.sha256((give_model_hash(CNP)+give_manifest_hash(manifest)+data_identifier).encode()).hexdigest()
+        cache_file=os.path.join(cache_dir,key+'.json')
+        if os.path.isfile(cache_file):
+            with open(cache_file,'r') as f:
+                report=json.load(f)
+            report['cached']=True
+            return(report)
+
+    CNP=CNP.to(device)
+    batches=manifest['batches']
+    variable_context=manifest['variable_context']
+    #Processes are forked which does not work with CUDA:
+    if torch.device(device).type=='cuda':
+        n_workers=1
+    n_workers=max(min(n_workers,len(batches)),1)
+
+    start=time.time()
+    if n_workers==1:
+        results=evaluate_batches(CNP,dataset,batches,device,variable_context=variable_context)
+    else:
+        _WORKER_STATE.update({'CNP': CNP,'dataset': dataset,'variable_context': variable_context,
+                              'n_threads': max(torch.get_num_threads()//n_workers,1)})
+        #Shard the manifest (round robin to balance the context sizes):
+        shards=[[(pos,batches[pos]) for pos in range(j,len(batches),n_workers)] for j in range(n_workers)]
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            shard_results=pool.map(_evaluate_shard,shards)
+        _WORKER_STATE.clear()
+        #Merge the results in the order of the manifest:
+        results=[None]*len(batches)
+        for shard_result in shard_results:
+            for pos,result in shard_result:
+                results[pos]=result
+    eval_time=time.time()-start
+
+    task_log_ll=[value for result in results for value in result]
+    report={'log_ll': float(np.mean(task_log_ll)),
+            'task_log_ll': task_log_ll,
+            'n_tasks': len(task_log_ll),
+            'time': eval_time,
+            'cached': False}
+
+    #Save to the cache (atomically):
+    if cache_dir is not None:
+        os.makedirs(cache_dir,exist_ok=True)
+        with open(cache_file+'.tmp','w') as f:
+            json.dump(report,f)
+        os.replace(cache_file+'.tmp',cache_file)
+    return(report)
@@ -12,3 +12,6 @@ mode='testChina'
 
 python Run_GP.py -data $data -lscale $lscale -sigma $sigma -noise $noise -mode $mode -n_passes $passes
 
+
+#Hyperparameter search on the validation data (grid search, the 5 best configurations are refined by maximizing the marginal likelihood):
+python run_gp.py -data small -mode val -gp_mode search -n_refine 5 -out GP_search_small_val.json
@@ -79,7 +79,22 @@ ap.set_defaults(
     CONTINUE=None,
     FILENAME=None,
     N_PASSES_US=None,
-    N_PASSES_CHINA=None
+    N_PASSES_CHINA=None,
+    CHECKPOINT_FILE=None,
+    CHECKPOINT_EVERY_EPOCHS=None,
+    CHECKPOINT_EVERY_MINUTES=None,
+    N_CHECKPOINTS_KEPT=2,
+    RESUME=None,
+    PROFILE=False,
+    TRACE_FILE=None,
+    VARIABLE_CONTEXT=False,
+    EVAL_TOKEN_BUDGET=None,
+    ADAPTIVE_GRID=False,
+    POINTS_PER_L_SCALE=None,
+    SAMPLING='random',
+    BUFFER_SIZE=2400,
+    BLOCK_SIZE=240,
+    TIME_WINDOW=None
     )
 
 #Arguments for architecture:
@@ -98,7 +113,22 @@ ap.add_argument("-it", "--N_ITERAT_PER_EPOCH", type=int, required=False,help="Nu
 ap.add_argument("-file", "--FILENAME", type=str, required=False,help="Number of iterations per epoch.")
 ap.add_argument("-l", "--LENGTH_SCALE_IN", type=float, required=False,help="Length scale for encoder.")
 ap.add_argument("-seed","--SEED", type=int, required=False, help="Seed for randomness.")
+ap.add_argument("-ckpt","--CHECKPOINT_FILE", type=str, required=False, help="Prefix of periodic checkpoints.")
+ap.add_argument("-ckpt_epochs","--CHECKPOINT_EVERY_EPOCHS", type=int, required=False, help="Save a checkpoint every k epochs.")
+ap.add_argument("-ckpt_min","--CHECKPOINT_EVERY_MINUTES", type=float, required=False, help="Save a checkpoint every t minutes.")
+ap.add_argument("-ckpt_keep","--N_CHECKPOINTS_KEPT", type=int, required=False, help="Number of newest checkpoints to keep.")
+ap.add_argument("-resume","--RESUME", type=str, required=False, help="Checkpoint to resume training from (or 'latest').")
+ap.add_argument("-profile","--PROFILE", type=bool, required=False, help="Record time and memory per stage of a training step.")
+ap.add_argument("-trace","--TRACE_FILE", type=str, required=False, help="File to export a torch profiler trace to.")
+ap.add_argument("-var_cont","--VARIABLE_CONTEXT", type=bool, required=False, help="Every element of a minibatch has its own number of context points.")
+ap.add_argument("-eval_budget","--EVAL_TOKEN_BUDGET", type=int, required=False, help="If given, final evaluation packs tasks bucketed by context size to this token budget.")
+ap.add_argument("-adaptive","--ADAPTIVE_GRID", type=bool, required=False, help="Encoder grid is fitted to the bounding box of every batch.")
+ap.add_argument("-grid_res","--POINTS_PER_L_SCALE", type=float, required=False, help="Grid points per length scale of the adaptive grid (default: spacing of the fixed grid).")
 ap.add_argument("-shape","--SHAPE_REG", type=float, required=False, help="Shape Regularizer")
+ap.add_argument("-sampling","--SAMPLING", type=str, required=False, help="Sampling of training maps: random or buffer (contiguous blocks of hours read into a shuffle buffer).")
+ap.add_argument("-buffer","--BUFFER_SIZE", type=int, required=False, help="Number of maps in the shuffle buffer (sampling buffer).")
+ap.add_argument("-block","--BLOCK_SIZE", type=int, required=False, help="Number of contiguous hours per read (sampling buffer).")
+ap.add_argument("-time_window","--TIME_WINDOW", type=int, required=False, help="Spatio-temporal mode: contexts from the current and previous k hours with time offset channel.")
 ap.add_argument("-data","--data_SET", type=str, required=False, help="data set to use - big or small.")
 
 #Arguments for tracking:
@@ -136,8 +166,18 @@ elif ARGS['data_SET']=='big':
 else:
     sys.exit("Unknown data set.")
 
-train_dataset=dataset.ERA5Dataset(PATH_TO_TRAIN_FILE,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True)
-val_dataset=dataset.ERA5Dataset(PATH_TO_VAL_FILE,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True)
+train_dataset=dataset.ERA5Dataset(PATH_TO_TRAIN_FILE,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True,
+                                  sampling=ARGS['SAMPLING'],buffer_size=ARGS['BUFFER_SIZE'],block_size=ARGS['BLOCK_SIZE'],
+                                  time_window=ARGS['TIME_WINDOW'])
+val_dataset=dataset.ERA5Dataset(PATH_TO_VAL_FILE,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True,time_window=ARGS['TIME_WINDOW'])
+
+#Context features: scalars (pressure, temperature), time offset (spatio-temporal mode) and the wind vector:
+if ARGS['TIME_WINDOW'] is None:
+    DIM_CONTEXT_FEAT=4
+    SCALAR_REP_IDS=[0,0]
+else:
+    DIM_CONTEXT_FEAT=5
+    SCALAR_REP_IDS=[0,0,0]
 
 print()
 print("Time: ", datetime.datetime.today())
@@ -145,11 +185,12 @@ print("Number of grid points per axis: ", N_X_AXIS)
 print("Group:", ARGS['GROUP'])
 print('Model type:', ARGS['ARCHITECTURE'])
 #Define the encoder:
-encoder=equiv_encoder.EquivEncoder(x_range=X_RANGE,n_x_axis=N_X_AXIS,l_scale=ARGS['LENGTH_SCALE_IN'])
+encoder=equiv_encoder.EquivEncoder(x_range=X_RANGE,n_x_axis=N_X_AXIS,l_scale=ARGS['LENGTH_SCALE_IN'],
+                                   adaptive_grid=ARGS['ADAPTIVE_GRID'],points_per_l_scale=ARGS['POINTS_PER_L_SCALE'])
 
 #Define the correct encoder:
 if ARGS['GROUP']=='CNP':
-    CNP=CNP_architectures.give_cnp_architecture(ARGS['ARCHITECTURE'],dim_Y_in=4,dim_Y_out=2)
+    CNP=CNP_architectures.give_cnp_architecture(ARGS['ARCHITECTURE'],dim_Y_in=DIM_CONTEXT_FEAT,dim_Y_out=2)
     if ARGS['CONTINUE'] is not None:
         train_dict=torch.load(ARGS['CONTINUE'])
         CNP_dict=train_dict['CNP_dict']
@@ -157,22 +198,22 @@ if ARGS['GROUP']=='CNP':
         print("Reloaded CNP model from training dict.")
 else:
     if ARGS['GROUP']=='C16':
-        decoder=models.get_C16_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=[0,0,1])
+        decoder=models.get_C16_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=SCALAR_REP_IDS+[1])
     elif ARGS['GROUP']=='D4':
-        decoder=models.get_D4_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=[0,0,[1,1]])
+        decoder=models.get_D4_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=SCALAR_REP_IDS+[[1,1]])
     elif ARGS['GROUP']=='D8':
-        decoder=models.get_D8_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=[0,0,[1,1]])
+        decoder=models.get_D8_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=SCALAR_REP_IDS+[[1,1]])
     elif ARGS['GROUP']=='SO2':
-        decoder=models.get_SO2_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=[0,0,1])
+        decoder=models.get_SO2_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=SCALAR_REP_IDS+[1])
     elif ARGS['GROUP']=='C4':
-        decoder=models.get_C4_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=[0,0,1])
+        decoder=models.get_C4_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=SCALAR_REP_IDS+[1])
     elif ARGS['GROUP']=='C8':
-        decoder=models.get_C8_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=[0,0,1])
+        decoder=models.get_C8_Decoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],context_rep_ids=SCALAR_REP_IDS+[1])
     elif ARGS['GROUP']=='CNN':
-        decoder=models.get_CNNDecoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],dim_features_inp=4) 
+        decoder=models.get_CNNDecoder(ARGS['ARCHITECTURE'],dim_cov_est=ARGS['DIM_COV_EST'],dim_features_inp=DIM_CONTEXT_FEAT) 
     else:
         sys.exit("Unknown architecture type.")
-    CNP=steercnp.SteerCNP(encoder,decoder,ARGS['DIM_COV_EST'],dim_context_feat=4,l_scale=ARGS['LENGTH_SCALE_OUT'])
+    CNP=steercnp.SteerCNP(encoder,decoder,ARGS['DIM_COV_EST'],dim_context_feat=DIM_CONTEXT_FEAT,l_scale=ARGS['LENGTH_SCALE_OUT'])
 
 #If equivariance is wanted, create the group and the fieldtype for the equivariance:
 
@@ -203,29 +244,46 @@ CNP,_,_=training.train_cnp(CNP,
                            filename=ARGS['FILENAME'],
                            n_equiv_samples=ARGS['N_EQUIV_SAMPLES'],
                            G_act=G_act,
-                           feature_in=feature_in
+                           feature_in=feature_in,
+                           checkpoint_file=ARGS['CHECKPOINT_FILE'],
+                           checkpoint_every_epochs=ARGS['CHECKPOINT_EVERY_EPOCHS'],
+                           checkpoint_every_minutes=ARGS['CHECKPOINT_EVERY_MINUTES'],
+                           n_checkpoints_kept=ARGS['N_CHECKPOINTS_KEPT'],
+                           resume_from=ARGS['RESUME'],
+                           profile=ARGS['PROFILE'],
+                           trace_file=ARGS['TRACE_FILE'],
+                           variable_context=ARGS['VARIABLE_CONTEXT']
                            )
 
 
 #Evaluate on validation set:
 if ARGS['N_EVAL_SAMPLES'] is not None:
-    eval_log_ll=training.test_cnp(CNP,val_dataset,DEVICE,n_samples=ARGS['N_EVAL_SAMPLES'],batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_data_PASSES'])
+    if ARGS['EVAL_TOKEN_BUDGET'] is not None:
+        eval_log_ll=training.test_cnp_bucketed(CNP,val_dataset,DEVICE,n_samples=ARGS['N_EVAL_SAMPLES'],n_data_passes=ARGS['N_data_PASSES'],token_budget=ARGS['EVAL_TOKEN_BUDGET'])['log_ll']
+    else:
+        eval_log_ll=training.test_cnp(CNP,val_dataset,DEVICE,n_samples=ARGS['N_EVAL_SAMPLES'],batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_data_PASSES'],variable_context=ARGS['VARIABLE_CONTEXT'])
     print("Final log ll:", eval_log_ll)
     print()
 
 #Evaluate on test set on US:
 if ARGS['N_PASSES_US'] is not None:
     PATH_TO_TEST_FILE_US="../../tasks/era5/era5_us/data/Test_Big_ERA5_US.nc"
-    train_dataset_US=dataset.ERA5Dataset(PATH_TO_TEST_FILE_US,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True)
-    test_log_ll_US=training.test_cnp(CNP,train_dataset_US,DEVICE,n_samples=train_dataset_US.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_PASSES_US'],send_to_device=True)
+    train_dataset_US=dataset.ERA5Dataset(PATH_TO_TEST_FILE_US,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True,time_window=ARGS['TIME_WINDOW'])
+    if ARGS['EVAL_TOKEN_BUDGET'] is not None:
+        test_log_ll_US=training.test_cnp_bucketed(CNP,train_dataset_US,DEVICE,n_samples=train_dataset_US.n_obs,n_data_passes=ARGS['N_PASSES_US'],send_to_device=True,token_budget=ARGS['EVAL_TOKEN_BUDGET'])['log_ll']
+    else:
+        test_log_ll_US=training.test_cnp(CNP,train_dataset_US,DEVICE,n_samples=train_dataset_US.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_PASSES_US'],send_to_device=True,variable_context=ARGS['VARIABLE_CONTEXT'])
     print("Test log ll US:", test_log_ll_US)
     print()
 
 #Evaluate on test set on China:
 if ARGS['N_PASSES_CHINA'] is not None:
     PATH_TO_TEST_FILE_CHINA="../../tasks/era5/era5_china/data/Test_Big_ERA5_China.nc"
-    train_dataset_China=dataset.ERA5Dataset(PATH_TO_TEST_FILE_CHINA,MIN_N_CONT,MAX_N_CONT,place='China',normalize=True,circular=True)
-    test_log_ll_China=training.test_cnp(CNP,train_dataset_China,DEVICE,n_samples=train_dataset_China.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_PASSES_CHINA'],send_to_device=True)
+    train_dataset_China=dataset.ERA5Dataset(PATH_TO_TEST_FILE_CHINA,MIN_N_CONT,MAX_N_CONT,place='China',normalize=True,circular=True,time_window=ARGS['TIME_WINDOW'])
+    if ARGS['EVAL_TOKEN_BUDGET'] is not None:
+        test_log_ll_China=training.test_cnp_bucketed(CNP,train_dataset_China,DEVICE,n_samples=train_dataset_China.n_obs,n_data_passes=ARGS['N_PASSES_CHINA'],send_to_device=True,token_budget=ARGS['EVAL_TOKEN_BUDGET'])['log_ll']
+    else:
+        test_log_ll_China=training.test_cnp(CNP,train_dataset_China,DEVICE,n_samples=train_dataset_China.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_PASSES_CHINA'],send_to_device=True,variable_context=ARGS['VARIABLE_CONTEXT'])
     print("Test log ll China:", test_log_ll_China)
     print()
 
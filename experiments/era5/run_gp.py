@@ -6,12 +6,16 @@ import numpy as np
 import sys
 import argparse
 import datetime
+import json
+import time
 sys.path.append('../..')
 
 #Own files:
 import kernel_and_gp_tools as GP
 import my_utils
-import tasks.ERA5.era5_dataset as dataset
+import evaluation
+from training import send_batch_to_device
+import tasks.era5.era5_dataset as dataset
 import itertools 
 
 #Set device:
@@ -28,7 +32,25 @@ ap.set_defaults(
     N_SAMPLES=None,
     BATCH_SIZE=30,
     N_data_PASSES=1,
-    data_SET='train')
+    data_SET='train',
+    VARIABLE_CONTEXT=False,
+    GP_MODE='exact',
+    N_NEIGHBOURS=32,
+    NEIGHBOURS_LIST='4,8,16,32,64',
+    CHUNK_SIZE=None,
+    OUTPUT_FILE=None,
+    SEED=1,
+    LSCALE=15.,
+    SIGMA=0.25,
+    NOISE=0.01,
+    LSCALE_LIST='5,10,15,20,30',
+    SIGMA_LIST='0.1,0.25,0.5,1',
+    NOISE_LIST='0.001,0.01,0.1',
+    N_RANDOM_CONFIGS=None,
+    N_CONFIGS_PER_BATCH=64,
+    N_REFINE=0,
+    N_REFINE_STEPS=100,
+    REFINE_LR=0.05)
 
 #Arguments for task:
 ap.add_argument("-n_passes", "--N_data_PASSES", type=int, required=False,help="Number of data passes.")
@@ -36,71 +58,175 @@ ap.add_argument("-n_samples", "--N_SAMPLES", type=int, required=False,help="Numb
 ap.add_argument("-batch", "--BATCH_SIZE", type=int, required=False,help="Batch size.")
 ap.add_argument("-data", "--data_SIZE", type=str, required=True,help="Size of data set. 'big' or 'small'.")
 ap.add_argument("-mode","--data_SET",type=str,required=False,help="Type of data set: 'train', 'val', or 'test'")
-ap.add_argument("-lscale", "--LSCALE", type=float, required=True,help="L scale of kernel.")
-ap.add_argument("-sigma", "--SIGMA", type=float, required=True,help="Sigma scale of kernel.")
-ap.add_argument("-noise", "--NOISE", type=float, required=True,help="Noise scale of kernel.")
+ap.add_argument("-lscale", "--LSCALE", type=float, required=False,help="L scale of kernel.")
+ap.add_argument("-sigma", "--SIGMA", type=float, required=False,help="Sigma scale of kernel.")
+ap.add_argument("-noise", "--NOISE", type=float, required=False,help="Noise scale of kernel.")
+ap.add_argument("-var_cont","--VARIABLE_CONTEXT", type=bool, required=False, help="Every element of a minibatch has its own number of context points.")
+ap.add_argument("-gp_mode","--GP_MODE", type=str, required=False, help="'exact' (per map), 'batch' (batched Cholesky), 'local' (nearest contexts), 'curve' (accuracy vs. time of all modes) or 'search' (hyperparameters).")
+ap.add_argument("-neighbours","--N_NEIGHBOURS", type=int, required=False, help="Number of nearest context points per target point (local).")
+ap.add_argument("-neighbours_list","--NEIGHBOURS_LIST", type=str, required=False, help="Comma-separated numbers of nearest context points (curve).")
+ap.add_argument("-chunk","--CHUNK_SIZE", type=int, required=False, help="Number of target points processed at once (local).")
+ap.add_argument("-out","--OUTPUT_FILE", type=str, required=False, help="JSON file the curve or the search results are written to.")
+ap.add_argument("-seed","--SEED", type=int, required=False, help="Seed of the task manifest.")
+ap.add_argument("-lscale_list","--LSCALE_LIST", type=str, required=False, help="Comma-separated l scales of the search (random search: range).")
+ap.add_argument("-sigma_list","--SIGMA_LIST", type=str, required=False, help="Comma-separated sigma scales of the search (random search: range).")
+ap.add_argument("-noise_list","--NOISE_LIST", type=str, required=False, help="Comma-separated noise scales of the search (random search: range).")
+ap.add_argument("-n_random","--N_RANDOM_CONFIGS", type=int, required=False, help="Random search: number of log-uniform configurations (default: grid search).")
+ap.add_argument("-n_configs_batch","--N_CONFIGS_PER_BATCH", type=int, required=False, help="Number of configurations evaluated at once.")
+ap.add_argument("-n_refine","--N_REFINE", type=int, required=False, help="Number of best configurations refined by maximizing the marginal likelihood.")
+ap.add_argument("-refine_steps","--N_REFINE_STEPS", type=int, required=False, help="Number of Adam steps of the refinement.")
+ap.add_argument("-refine_lr","--REFINE_LR", type=float, required=False, help="Learning rate of the refinement (on log-scale).")
 
 #Pass the arguments:
 ARGS = vars(ap.parse_args())
 
 
-#Compute the log-ll of the GP posterior on the data by sampling:
-def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1):
-        with torch.no_grad():
-            n_obs=dataset.n_obs
-            if n_samples is None: 
-                n_samples=n_obs
-            n_samples_max=min(n_samples,n_obs)
-            n_iterat=max(n_samples_max//batch_size,1)
-            log_ll=torch.tensor(0.0, device=device)
-            
-            for j in range(n_data_passes):
-                ind_list=torch.randperm(n_obs)[:n_samples_max]
-                batch_ind_list=[ind_list[j*batch_size:(j+1)*batch_size] for j in range(n_iterat)]
-
-                for it in range(n_iterat):
-                    #Get random minibatch:
-                    x_context,y_context,x_target,y_target=dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False)
-                    
-                    #Load data to device:
-                    x_context=x_context.to(device)
-                    y_context=y_context.to(device)
-                    x_target=x_target.to(device)
-                    y_target=y_target.to(device)
-
-                    #The target set includes the context set here:
-                    Means_list=[]
-                    Sigmas_list=[]
-                    B=torch.eye(4).to(device)
-                    for b in range(batch_size):
-                        Means,Sigmas,_=GP.gp_inference(x_context[b],y_context[b],x_target[b],**GP_parameters,B=B)
-                        Means=Means[:,2:]
-                        Means_list.append(Means)
-                        Sigmas=my_utils.get_block_diagonal(Sigmas,size=4)
-                        Sigmas=Sigmas[:,2:,2:]
-                        Sigmas_list.append(Sigmas)
-                    Means=torch.stack(Means_list,dim=0)
-                    Sigmas=torch.stack(Sigmas_list,dim=0)
-
-                    log_ll_it=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target)
-                    log_ll+=log_ll_it.mean()/n_iterat
-                                        
-        return(log_ll.item()/n_data_passes)
+#The GP baseline as a model which maps a batch of context and target sets to means and covariances of the wind components:
+class GPBaseline(object):
+    def __init__(self,GP_parameters,gp_mode='exact',n_neighbours=32,chunk_size=None):
+        '''
+        GP_parameters - dictionary - l_scale,sigma_var,kernel_type,obs_noise (see GP.gp_inference)
+        gp_mode - string - 'exact': GP.gp_inference per map (all variables, full covariance matrix of the target points)
+                           'batch': GP.batch_gp_inference (batched Cholesky, covariances per target point)
+                           'local': GP.local_gp_inference (every target point is conditioned on its n_neighbours nearest context points)
+        n_neighbours - int - number of nearest context points (gp_mode 'local')
+        chunk_size - int/None - number of target points which are processed at once (gp_mode 'local')
+        For the rbf kernel with B=I, the components are independent GPs. In the modes 'batch' and 'local', only the wind components
+        are conditioned on (which gives the same predictions as conditioning on all components).
+        '''
+        self.GP_parameters=GP_parameters
+        self.gp_mode=gp_mode
+        self.n_neighbours=n_neighbours
+        self.chunk_size=chunk_size
+        if self.gp_mode not in ['exact','batch','local']:
+            sys.exit("Unknown GP mode.")
 
+    def __call__(self,x_context,y_context,x_target,mask_context=None):
+        '''
+        Input: x_context,y_context,x_target - torch.Tensor - shape (batch_size,n_context,2),(batch_size,n_context,4),(batch_size,n_target,2)
+               mask_context - torch.Tensor/None - shape (batch_size,n_context) - 1. for context points, 0. for padding
+        Output: Means,Sigmas - torch.Tensor - shape (batch_size,n_target,2),(batch_size,n_target,2,2)
+        '''
+        if self.gp_mode=='exact':
+            B=torch.eye(4).to(x_context.device)
+            Means_list=[]
+            Sigmas_list=[]
+            for b in range(x_context.size(0)):
+                #Remove the padding of the context set:
+                if mask_context is not None:
+                    x_c,y_c=x_context[b][mask_context[b].bool()],y_context[b][mask_context[b].bool()]
+                else:
+                    x_c,y_c=x_context[b],y_context[b]
+                Means,Sigmas,_=GP.gp_inference(x_c,y_c,x_target[b],**self.GP_parameters,B=B)
+                Means_list.append(Means[:,2:])
+                Sigmas_list.append(my_utils.get_block_diagonal(Sigmas,size=4)[:,2:,2:])
+            return(torch.stack(Means_list,dim=0),torch.stack(Sigmas_list,dim=0))
+        B=torch.eye(2).to(x_context.device)
+        if self.gp_mode=='batch':
+            return(GP.batch_gp_inference(x_context,y_context[:,:,2:],x_target,**self.GP_parameters,B=B,mask_context=mask_context))
+        else:
+            return(GP.local_gp_inference(x_context,y_context[:,:,2:],x_target,n_neighbours=self.n_neighbours,**self.GP_parameters,B=B,
+                                         mask_context=mask_context,chunk_size=self.chunk_size))
+
+#Compute the log-ll of the GP posterior on the tasks of a seeded manifest (the same tasks for every GP mode):
+def compute_gp_log_ll(GP_model,dataset,device,n_samples=None,batch_size=1,n_data_passes=1,variable_context=False,seed=1):
+    '''
+    Output: float - mean log-likelihood over all tasks
+            float - wall time
+    '''
+    manifest=evaluation.give_task_manifest(dataset.n_obs,dataset.Min_n_cont,dataset.Max_n_cont,n_samples=n_samples,batch_size=batch_size,
+                                           n_data_passes=n_data_passes,seed=seed,variable_context=variable_context)
+    start=time.time()
+    results=evaluation.evaluate_batches(GP_model,dataset,manifest['batches'],device,variable_context=variable_context)
+    return(float(np.mean([value for result in results for value in result])),time.time()-start)
+
+
+#Configurations (l_scale,sigma_var,obs_noise) of the hyperparameter search:
+def give_search_configs(l_scales,sigma_vars,obs_noises,n_random=None,seed=1):
+    '''
+    Input: l_scales,sigma_vars,obs_noises - lists of floats - values of the grid (random search: minimum and maximum give the range)
+           n_random - int/None - if int, number of configurations sampled log-uniformly, otherwise all configurations of the grid
+    Output: torch.Tensor - shape (n_configs,3)
+    '''
+    if n_random is None:
+        return(torch.tensor(list(itertools.product(l_scales,sigma_vars,obs_noises)),dtype=torch.get_default_dtype()))
+    generator=torch.Generator()
+    generator.manual_seed(seed)
+    Log_Min=torch.log(torch.tensor([min(l_scales),min(sigma_vars),min(obs_noises)]))
+    Log_Max=torch.log(torch.tensor([max(l_scales),max(sigma_vars),max(obs_noises)]))
+    return(torch.exp(Log_Min+(Log_Max-Log_Min)*torch.rand((n_random,3),generator=generator)))
+
+#Log-ll of the GP posterior (wind components) for many configurations at once - the configurations are an extra batch dimension:
+def search_gp_log_ll(Configs,dataset,device,manifest,n_configs_per_batch=64):
+    '''
+    Input: Configs - torch.Tensor - shape (n_configs,3) - l_scale,sigma_var,obs_noise per configuration
+           manifest - dictionary - see evaluation.give_task_manifest
+    Output: torch.Tensor - shape (n_configs) - mean log-likelihood over the tasks of the manifest per configuration
+    '''
+    variable_context=manifest['variable_context']
+    Log_ll=torch.zeros(Configs.size(0))
+    n_tasks=0
+    B=torch.eye(2).to(device)
+    with torch.no_grad():
+        for batch_dict in manifest['batches']:
+            #The same tasks as in evaluation.evaluate_batches:
+            batch=evaluation.give_manifest_batch(dataset,batch_dict,variable_context)
+            x_context,y_context,x_target,y_target,mask_context,mask_target=send_batch_to_device(batch,device)
+            batch_size=x_context.size(0)
+            for start in range(0,Configs.size(0),n_configs_per_batch):
+                C=Configs[start:start+n_configs_per_batch].to(device)
+                n_configs=C.size(0)
+                #Configuration-major order (element i*batch_size+b is configuration i on map b):
+                Means,Covs=GP.batch_gp_inference(x_context.repeat(n_configs,1,1),y_context[:,:,2:].repeat(n_configs,1,1),x_target.repeat(n_configs,1,1),
+                                                 l_scale=C[:,0].repeat_interleave(batch_size),sigma_var=C[:,1].repeat_interleave(batch_size),kernel_type="rbf",
+                                                 obs_noise=C[:,2].repeat_interleave(batch_size),B=B,
+                                                 mask_context=mask_context.repeat(n_configs,1) if mask_context is not None else None)
+                log_ll=my_utils.batch_multivar_log_ll(Means,Covs,y_target.repeat(n_configs,1,1)).view(n_configs,batch_size,-1)
+                if mask_target is None:
+                    task_log_ll=log_ll.mean(dim=2)
+                else:
+                    task_log_ll=(log_ll*mask_target[None]).sum(dim=2)/mask_target.sum(dim=1)[None]
+                Log_ll[start:start+n_configs]+=task_log_ll.sum(dim=1).cpu()
+            n_tasks+=batch_size
+    return(Log_ll/n_tasks)
+
+#Refine configurations by maximizing the log-marginal likelihood of random context sets with Adam (on log-scale):
+def refine_gp_parameters(Configs,dataset,device,n_steps=100,learning_rate=0.05,batch_size=30):
+    '''
+    Input: Configs - torch.Tensor - shape (n_configs,3) - initial configurations (l_scale,sigma_var,obs_noise)
+    Output: torch.Tensor - shape (n_configs,3) - refined configurations (every configuration is optimized independently)
+    '''
+    Log_Configs=torch.log(Configs).to(device).requires_grad_(True)
+    optimizer=torch.optim.Adam([Log_Configs],lr=learning_rate)
+    B=torch.eye(2).to(device)
+    n_configs=Configs.size(0)
+    for step in range(n_steps):
+        x_context,y_context,_,_=dataset.get_rand_batch(batch_size=batch_size,n_context_points=dataset.Max_n_cont)
+        x_context,y_context=x_context.to(device),y_context.to(device)
+        C=torch.exp(Log_Configs)
+        log_ml=GP.batch_gp_log_marginal_likelihood(x_context.repeat(n_configs,1,1),y_context[:,:,2:].repeat(n_configs,1,1),
+                                                   l_scale=C[:,0].repeat_interleave(x_context.size(0)),sigma_var=C[:,1].repeat_interleave(x_context.size(0)),
+                                                   kernel_type="rbf",obs_noise=C[:,2].repeat_interleave(x_context.size(0)),B=B)
+        #The sum over the configurations gives independent gradients per configuration:
+        loss=-log_ml.view(n_configs,-1).mean(dim=1).sum()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return(torch.exp(Log_Configs).detach().cpu())
 
 #Fixed hyperparameters:
 MIN_N_CONT=5
 MAX_N_CONT=50
 
 if ARGS['data_SIZE']=='small':
-        PATH_TO_TRAIN_FILE="../../tasks/ERA5/ERA5_US/data/Train_Small_ERA5_US.nc"
-        PATH_TO_VAL_FILE="../../tasks/ERA5/ERA5_US/data/Valid_Small_ERA5_US.nc"
-        PATH_TO_TEST_FILE="../../tasks/ERA5/ERA5_US/data/Test_Small_ERA5_US.nc"
+        PATH_TO_TRAIN_FILE="../../tasks/era5/era5_us/data/Train_Small_ERA5_US.nc"
+        PATH_TO_VAL_FILE="../../tasks/era5/era5_us/data/Valid_Small_ERA5_US.nc"
+        PATH_TO_TEST_FILE="../../tasks/era5/era5_us/data/Test_Small_ERA5_US.nc"
 elif ARGS['data_SIZE']=='big':
-        PATH_TO_TRAIN_FILE="../../tasks/ERA5/ERA5_US/data/Train_Big_ERA5_US.nc"
-        PATH_TO_VAL_FILE="../../tasks/ERA5/ERA5_US/data/Valid_Big_ERA5_US.nc"
-        PATH_TO_TEST_FILE="../../tasks/ERA5/ERA5_US/data/Test_Big_ERA5_US.nc"
-        PATH_TO_TEST_CHINA_FILE="../../tasks/ERA5/ERA5_China/data/Test_Big_ERA5_China.nc"
+        PATH_TO_TRAIN_FILE="../../tasks/era5/era5_us/data/Train_Big_ERA5_US.nc"
+        PATH_TO_VAL_FILE="../../tasks/era5/era5_us/data/Valid_Big_ERA5_US.nc"
+        PATH_TO_TEST_FILE="../../tasks/era5/era5_us/data/Test_Big_ERA5_US.nc"
+        PATH_TO_TEST_CHINA_FILE="../../tasks/era5/era5_china/data/Test_Big_ERA5_China.nc"
 else:
     sys.exit("Unknown data set.")
 
@@ -121,7 +247,55 @@ GP_parameters={'l_scale':ARGS['LSCALE'],
 
 print("GP parameters: ", GP_parameters)
 print("Start time:", datetime.datetime.today())   
-log_ll=compute_gp_log_ll(GP_parameters,dataset,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'])
-print("Mean log-likelihood on data set:")
-print(log_ll)
-
+if ARGS['GP_MODE']=='curve':
+    #Accuracy vs. time: all modes on the same tasks (the exact mode is the reference):
+    models=[('exact',None),('batch',None)]+[('local',k) for k in [int(k) for k in ARGS['NEIGHBOURS_LIST'].split(',')]]
+    results=[]
+    for gp_mode,n_neighbours in models:
+        GP_model=GPBaseline(GP_parameters,gp_mode,n_neighbours=n_neighbours,chunk_size=ARGS['CHUNK_SIZE'])
+        log_ll,eval_time=compute_gp_log_ll(GP_model,dataset,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'],ARGS['VARIABLE_CONTEXT'],ARGS['SEED'])
+        results.append({'gp_mode': gp_mode,'n_neighbours': n_neighbours,'log_ll': log_ll,'time': eval_time})
+    print("GP mode | neighbours | log-likelihood | difference to exact | time (s) | speedup")
+    for result in results:
+        print("%7s | %10s | %14.4f | %19.4f | %8.2f | %.2fx"%(result['gp_mode'],result['n_neighbours'] or '-',result['log_ll'],
+                                                               result['log_ll']-results[0]['log_ll'],result['time'],results[0]['time']/result['time']))
+    if ARGS['OUTPUT_FILE'] is not None:
+        with open(ARGS['OUTPUT_FILE'],'w') as f:
+            json.dump({'args': ARGS,'GP_parameters': GP_parameters,'results': results},f,indent=1)
+        print("Saved results in: ", ARGS['OUTPUT_FILE'])
+elif ARGS['GP_MODE']=='search':
+    #Hyperparameter search: all configurations on the same tasks (batched along the configurations):
+    give_floats=lambda string: [float(value) for value in string.split(',')]
+    Configs=give_search_configs(give_floats(ARGS['LSCALE_LIST']),give_floats(ARGS['SIGMA_LIST']),give_floats(ARGS['NOISE_LIST']),
+                                ARGS['N_RANDOM_CONFIGS'],ARGS['SEED'])
+    manifest=evaluation.give_task_manifest(dataset.n_obs,dataset.Min_n_cont,dataset.Max_n_cont,n_samples=ARGS['N_SAMPLES'],batch_size=ARGS['BATCH_SIZE'],
+                                           n_data_passes=ARGS['N_data_PASSES'],seed=ARGS['SEED'],variable_context=ARGS['VARIABLE_CONTEXT'])
+    start=time.time()
+    Log_ll=search_gp_log_ll(Configs,dataset,DEVICE,manifest,ARGS['N_CONFIGS_PER_BATCH'])
+    print("Evaluated %d configurations in %.2fs"%(Configs.size(0),time.time()-start))
+    results=[{'l_scale': C[0].item(),'sigma_var': C[1].item(),'obs_noise': C[2].item(),'log_ll': log_ll.item(),'refined': False} 
+             for C,log_ll in zip(Configs,Log_ll)]
+    #Refine the best configurations by maximizing the marginal likelihood:
+    if ARGS['N_REFINE']>0:
+        best_inds=torch.argsort(Log_ll,descending=True)[:ARGS['N_REFINE']]
+        Refined=refine_gp_parameters(Configs[best_inds],dataset,DEVICE,ARGS['N_REFINE_STEPS'],ARGS['REFINE_LR'],ARGS['BATCH_SIZE'])
+        Log_ll_refined=search_gp_log_ll(Refined,dataset,DEVICE,manifest,ARGS['N_CONFIGS_PER_BATCH'])
+        results+=[{'l_scale': C[0].item(),'sigma_var': C[1].item(),'obs_noise': C[2].item(),'log_ll': log_ll.item(),'refined': True} 
+                  for C,log_ll in zip(Refined,Log_ll_refined)]
+    results=sorted(results,key=lambda result: result['log_ll'],reverse=True)
+    print("l_scale  | sigma_var | obs_noise | refined | log-likelihood")
+    for result in results:
+        print("%8.4f | %9.4f | %9.5f | %7s | %.4f"%(result['l_scale'],result['sigma_var'],result['obs_noise'],result['refined'],result['log_ll']))
+    best={key: results[0][key] for key in ['l_scale','sigma_var','obs_noise','log_ll']}
+    print("Best configuration: ", best)
+    if ARGS['OUTPUT_FILE'] is None:
+        ARGS['OUTPUT_FILE']="GP_search_"+ARGS['data_SIZE']+"_"+ARGS['data_SET']+"_"+datetime.datetime.today().strftime('%Y_%m_%d_%H_%M')+".json"
+    with open(ARGS['OUTPUT_FILE'],'w') as f:
+        json.dump({'args': ARGS,'best': best,'results': results},f,indent=1)
+    print("Saved results in: ", ARGS['OUTPUT_FILE'])
+else:
+    GP_model=GPBaseline(GP_parameters,ARGS['GP_MODE'],n_neighbours=ARGS['N_NEIGHBOURS'],chunk_size=ARGS['CHUNK_SIZE'])
+    log_ll,eval_time=compute_gp_log_ll(GP_model,dataset,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'],ARGS['VARIABLE_CONTEXT'],ARGS['SEED'])
+    print("Mean log-likelihood on data set:")
+    print(log_ll)
+    print("Time: %.2fs"%eval_time)
@@ -5,10 +5,10 @@ import datetime
 sys.path.append("../../")
 
 
-import training
+import evaluation
 import steercnp
 import cnp.cnp_model as CNP_Model
-import tasks.ERA5.era5_dataset as dataset
+import tasks.era5.era5_dataset as dataset
 
 if torch.cuda.is_available():
     DEVICE = torch.device("cuda:0")  
@@ -22,14 +22,22 @@ ap.set_defaults(
     TYPE='SteerCNP',
     N_data_PASSES=1,
     PLACE='US',
-    BATCH_SIZE=30)
+    BATCH_SIZE=30,
+    SEED=1,
+    N_WORKERS=1,
+    CACHE_DIR=None,
+    VARIABLE_CONTEXT=False)
 
 #Arguments for architecture:
 ap.add_argument("-file", "--FILE", required=True, type=str)
-ap.add_argument("-batch", "--BATCH", required=False,type=int)
+ap.add_argument("-batch", "--BATCH_SIZE", required=False,type=int)
 ap.add_argument("-p", "--N_data_PASSES", required=False,type=int)
 ap.add_argument("-type", "--TYPE", required=False,type=str)
 ap.add_argument("-place","--PLACE", required=False,type=str)
+ap.add_argument("-seed","--SEED", required=False,type=int,help="Seed of the task manifest.")
+ap.add_argument("-workers","--N_WORKERS", required=False,type=int,help="Number of processes the evaluation is sharded across (CPU only).")
+ap.add_argument("-cache","--CACHE_DIR", required=False,type=str,help="Directory to cache evaluation results in.")
+ap.add_argument("-var_cont","--VARIABLE_CONTEXT", type=bool, required=False, help="Every element of a minibatch has its own number of context points.")
 
 #Pass arguments:
 ARGS = vars(ap.parse_args())
@@ -37,17 +45,17 @@ ARGS = vars(ap.parse_args())
 train_dict=torch.load(ARGS['FILE'],map_location=torch.device('cpu'))
 
 if ARGS['TYPE']=="SteerCNP":
-    CNP=SteerCNP.SteerCNP.create_model_from_dict(train_dict['CNP_dict'])
+    CNP=steercnp.SteerCNP.create_model_from_dict(train_dict['CNP_dict'])
 else:
     CNP=CNP_Model.ConditionalNeuralProcess.create_model_from_dict(train_dict['CNP_dict'])
 
 CNP=CNP.to(DEVICE)
 
 if ARGS['PLACE']=='US':
-    PATH_TO_TEST_FILE="../../tasks/ERA5/ERA5_US/data/Test_Big_ERA5_US.nc"
+    PATH_TO_TEST_FILE="../../tasks/era5/era5_us/data/Test_Big_ERA5_US.nc"
     print("Use US data.")
 elif ARGS['PLACE']=='China':
-    PATH_TO_TEST_FILE="../../tasks/ERA5/ERA5_China/data/Test_Big_ERA5_China.nc"
+    PATH_TO_TEST_FILE="../../tasks/era5/era5_china/data/Test_Big_ERA5_China.nc"
     print("Use China data.")
 else:
     sys.exit("Unknown place.")
@@ -56,9 +64,14 @@ MIN_N_CONT=2
 MAX_N_CONT=50
 test_dataset=dataset.ERA5Dataset(PATH_TO_TEST_FILE,MIN_N_CONT,MAX_N_CONT,place=ARGS['PLACE'],normalize=True,circular=True)
 
-log_ll=training.test_cnp(CNP,test_dataset,DEVICE,n_samples=test_dataset.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_data_PASSES'])
+manifest=evaluation.give_task_manifest(test_dataset.n_obs,MIN_N_CONT,MAX_N_CONT,batch_size=ARGS['BATCH_SIZE'],
+                                       n_data_passes=ARGS['N_data_PASSES'],seed=ARGS['SEED'],variable_context=ARGS['VARIABLE_CONTEXT'])
+report=evaluation.evaluate(CNP,test_dataset,manifest,DEVICE,n_workers=ARGS['N_WORKERS'],cache_dir=ARGS['CACHE_DIR'],
+                           data_identifier=test_dataset.give_data_identifier())
 print("Filename: ", ARGS['FILE'])
 print("Time: ", datetime.datetime.today())
 print("Place: ", ARGS['PLACE'])
-print("Test log-likelihood: ", log_ll)
+print("Test log-likelihood: ", report['log_ll'])
+print("Number of tasks: ", report['n_tasks'])
+print("Loaded from cache: ", report['cached'])
 print("Number of samples: ", ARGS['N_data_PASSES'])
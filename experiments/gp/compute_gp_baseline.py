@@ -27,13 +27,15 @@ ap.set_defaults(
     data=None,
     N_SAMPLES=None,
     BATCH_SIZE=30,
-    N_data_PASSES=30)
+    N_data_PASSES=30,
+    VARIABLE_CONTEXT=False)
 
 #Arguments for task:
 ap.add_argument("-data", "--data", type=str, required=True,help="data to use.")
 ap.add_argument("-n_passes", "--N_data_PASSES", type=int, required=False,help="Number of data passes.")
 ap.add_argument("-n_samples", "--N_SAMPLES", type=int, required=False,help="Number of data samples (only not None for debugging).")
 ap.add_argument("-batch", "--BATCH_SIZE", type=int, required=False,help="Batch size.")
+ap.add_argument("-var_cont","--VARIABLE_CONTEXT", type=bool, required=False, help="Every element of a minibatch has its own number of context points.")
 
 
 #Pass the arguments:
@@ -41,7 +43,7 @@ ARGS = vars(ap.parse_args())
 
 
 #Compute the log-ll of the GP posterior on the data by sampling:
-def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1):
+def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1,variable_context=False):
         with torch.no_grad():
             n_obs=dataset.n_obs
             if n_samples is None: 
@@ -56,25 +58,26 @@ def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n
 
                 for it in range(n_iterat):
                     #Get random minibatch:
-                    x_context,y_context,x_target,y_target=dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False)
+                    batch=dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False,variable_context=variable_context)
                     
                     #Load data to device:
-                    x_context=x_context.to(device)
-                    y_context=y_context.to(device)
-                    x_target=x_target.to(device)
-                    y_target=y_target.to(device)
+                    x_context,y_context,x_target,y_target=[tensor.to(device) for tensor in batch[:4]]
+                    if variable_context:
+                        mask_context,mask_target=[mask.to(device).bool() for mask in batch[4:]]
 
                     #The target set includes the context set here:
-                    Means_list=[]
-                    Sigmas_list=[]
-                    for b in range(batch_size):
-                        Means,Sigmas,_=GP.gp_inference(x_context[b],y_context[b],x_target[b],**GP_parameters)
-                        Means_list.append(Means)
+                    log_ll_list=[]
+                    for b in range(x_context.size(0)):
+                        #Remove the padding of the context and target set:
+                        if variable_context:
+                            x_c,y_c=x_context[b][mask_context[b]],y_context[b][mask_context[b]]
+                            x_t,y_t=x_target[b][mask_target[b]],y_target[b][mask_target[b]]
+                        else:
+                            x_c,y_c,x_t,y_t=x_context[b],y_context[b],x_target[b],y_target[b]
+                        Means,Sigmas,_=GP.gp_inference(x_c,y_c,x_t,**GP_parameters)
                         Sigmas=my_utils.get_block_diagonal(Sigmas,size=2)
-                        Sigmas_list.append(Sigmas)
-                    Means=torch.stack(Means_list,dim=0)
-                    Sigmas=torch.stack(Sigmas_list,dim=0)
-                    log_ll_it=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target)
+                        log_ll_list.append(my_utils.batch_multivar_log_ll(Means[None],Sigmas[None],y_t[None]).view(-1))
+                    log_ll_it=torch.cat(log_ll_list,dim=0)
                     log_ll+=log_ll_it.mean()/n_iterat
                                         
         return(log_ll.item()/n_data_passes)
@@ -109,7 +112,7 @@ else:
 
 print("Start time:", datetime.datetime.today())
 #Run:
-log_ll=compute_gp_log_ll(GP_parameters,dataSET,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'])
+log_ll=compute_gp_log_ll(GP_parameters,dataSET,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'],ARGS['VARIABLE_CONTEXT'])
 
 #Print:
 print("Mean log-likelihood on validation data set:")
@@ -85,7 +85,18 @@ ap.set_defaults(
     N_data_PASSES=1,
     SEED=1997,
     FILENAME=None,
-    DIV_FREE=False)
+    DIV_FREE=False,
+    CHECKPOINT_FILE=None,
+    CHECKPOINT_EVERY_EPOCHS=None,
+    CHECKPOINT_EVERY_MINUTES=None,
+    N_CHECKPOINTS_KEPT=2,
+    RESUME=None,
+    PROFILE=False,
+    TRACE_FILE=None,
+    VARIABLE_CONTEXT=False,
+    EVAL_TOKEN_BUDGET=None,
+    ADAPTIVE_GRID=False,
+    POINTS_PER_L_SCALE=None)
 
 #Arguments for task:
 ap.add_argument("-data", "--data", type=str, required=True,help="data set to use: rbf, div_free or curl_free")
@@ -105,6 +116,17 @@ ap.add_argument("-it", "--N_ITERAT_PER_EPOCH", type=int, required=False,help="Nu
 ap.add_argument("-file", "--FILENAME", type=str, required=False,help="Number of iterations per epoch.")
 ap.add_argument("-l", "--LENGTH_SCALE_IN", type=float, required=False,help="Length scale for encoder.")
 ap.add_argument("-seed","--SEED", type=int, required=False, help="Seed for randomness.")
+ap.add_argument("-ckpt","--CHECKPOINT_FILE", type=str, required=False, help="Prefix of periodic checkpoints.")
+ap.add_argument("-ckpt_epochs","--CHECKPOINT_EVERY_EPOCHS", type=int, required=False, help="Save a checkpoint every k epochs.")
+ap.add_argument("-ckpt_min","--CHECKPOINT_EVERY_MINUTES", type=float, required=False, help="Save a checkpoint every t minutes.")
+ap.add_argument("-ckpt_keep","--N_CHECKPOINTS_KEPT", type=int, required=False, help="Number of newest checkpoints to keep.")
+ap.add_argument("-resume","--RESUME", type=str, required=False, help="Checkpoint to resume training from (or 'latest').")
+ap.add_argument("-profile","--PROFILE", type=bool, required=False, help="Record time and memory per stage of a training step.")
+ap.add_argument("-trace","--TRACE_FILE", type=str, required=False, help="File to export a torch profiler trace to.")
+ap.add_argument("-var_cont","--VARIABLE_CONTEXT", type=bool, required=False, help="Every element of a minibatch has its own number of context points.")
+ap.add_argument("-eval_budget","--EVAL_TOKEN_BUDGET", type=int, required=False, help="If given, final evaluation packs tasks bucketed by context size to this token budget.")
+ap.add_argument("-adaptive","--ADAPTIVE_GRID", type=bool, required=False, help="Encoder grid is fitted to the bounding box of every batch.")
+ap.add_argument("-grid_res","--POINTS_PER_L_SCALE", type=float, required=False, help="Grid points per length scale of the adaptive grid (default: spacing of the fixed grid).")
 ap.add_argument("-shape","--SHAPE_REG", type=float, required=False, help="Shape Regularizer")
 ap.add_argument("-continue","--CONTINUE",type=str,required=False,help="File to continue training")
 #Arguments for tracking:
@@ -141,7 +163,8 @@ print("Time: ", datetime.datetime.today())
 print("Group:", ARGS['GROUP'])
 print('Model type:', ARGS['ARCHITECTURE'])
 #Define the encoder:
-encoder=equiv_encoder.EquivEncoder(x_range=X_RANGE,n_x_axis=N_X_AXIS,l_scale=ARGS['LENGTH_SCALE_IN'])
+encoder=equiv_encoder.EquivEncoder(x_range=X_RANGE,n_x_axis=N_X_AXIS,l_scale=ARGS['LENGTH_SCALE_IN'],
+                                   adaptive_grid=ARGS['ADAPTIVE_GRID'],points_per_l_scale=ARGS['POINTS_PER_L_SCALE'])
 
 #Define the correct encoder:
 if ARGS['GROUP']=='CNP':
@@ -206,7 +229,15 @@ CNP,_,_=training.train_cnp(CNP,
                            filename=ARGS['FILENAME'],
                            n_equiv_samples=ARGS['N_EQUIV_SAMPLES'],
                            G_act=G_act,
-                           feature_in=feature_in
+                           feature_in=feature_in,
+                           checkpoint_file=ARGS['CHECKPOINT_FILE'],
+                           checkpoint_every_epochs=ARGS['CHECKPOINT_EVERY_EPOCHS'],
+                           checkpoint_every_minutes=ARGS['CHECKPOINT_EVERY_MINUTES'],
+                           n_checkpoints_kept=ARGS['N_CHECKPOINTS_KEPT'],
+                           resume_from=ARGS['RESUME'],
+                           profile=ARGS['PROFILE'],
+                           trace_file=ARGS['TRACE_FILE'],
+                           variable_context=ARGS['VARIABLE_CONTEXT']
                            )
 
 print("Time finished with training: ", datetime.datetime.today())
@@ -214,14 +245,20 @@ print("Time finished with training: ", datetime.datetime.today())
 
 #Final evaluation on validation data set:
 if ARGS['N_EVAL_SAMPLES'] is not None:
-    eval_log_ll=training.test_cnp(CNP,val_dataset,DEVICE,n_samples=ARGS['N_EVAL_SAMPLES'],batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_data_PASSES'])
+    if ARGS['EVAL_TOKEN_BUDGET'] is not None:
+        eval_log_ll=training.test_cnp_bucketed(CNP,val_dataset,DEVICE,n_samples=ARGS['N_EVAL_SAMPLES'],n_data_passes=ARGS['N_data_PASSES'],token_budget=ARGS['EVAL_TOKEN_BUDGET'])['log_ll']
+    else:
+        eval_log_ll=training.test_cnp(CNP,val_dataset,DEVICE,n_samples=ARGS['N_EVAL_SAMPLES'],batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_data_PASSES'],variable_context=ARGS['VARIABLE_CONTEXT'])
     print("Final log ll:", eval_log_ll)
     print()
 
 #Final evaluation on test data set:
 if ARGS['N_TEST_data_PASSES'] is not None:
     test_dataset=dataLoader.give_gp_data_set(MIN_N_CONT,MAX_N_CONT,ARGS['data'],'test',file_path=FILEPATH)                 
-    test_log_ll=training.test_cnp(CNP,test_dataset,DEVICE,n_samples=test_dataset.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_TEST_data_PASSES'])
+    if ARGS['EVAL_TOKEN_BUDGET'] is not None:
+        test_log_ll=training.test_cnp_bucketed(CNP,test_dataset,DEVICE,n_samples=test_dataset.n_obs,n_data_passes=ARGS['N_TEST_data_PASSES'],token_budget=ARGS['EVAL_TOKEN_BUDGET'])['log_ll']
+    else:
+        test_log_ll=training.test_cnp(CNP,test_dataset,DEVICE,n_samples=test_dataset.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_TEST_data_PASSES'],variable_context=ARGS['VARIABLE_CONTEXT'])
     print("Final test log ll:", test_log_ll)
     print("Time finished with testing: ", datetime.datetime.today())
 
@@ -5,10 +5,10 @@ import datetime
 sys.path.append("../../")
 
 
-import training
+import evaluation
 import steercnp
 import cnp.cnp_model as CNP_Model
-import tasks.gp.gp_div_free_circle.loader as dataLoader
+import tasks.gp.gp_loader as dataLoader
 
 
 if torch.cuda.is_available():
@@ -21,14 +21,24 @@ else:
 ap = argparse.ArgumentParser()
 ap.set_defaults(
     TYPE='SteerCNP',
+    DATA='div_free',
     N_data_PASSES=1,
-    BATCH_SIZE=30)
+    BATCH_SIZE=30,
+    SEED=1,
+    N_WORKERS=1,
+    CACHE_DIR=None,
+    VARIABLE_CONTEXT=False)
 
 #Arguments for architecture:
 ap.add_argument("-file", "--FILE", required=True, type=str)
-ap.add_argument("-batch", "--BATCH", required=False,type=int)
+ap.add_argument("-data", "--DATA", required=False, type=str,help="GP data set: rbf, div_free or curl_free.")
+ap.add_argument("-batch", "--BATCH_SIZE", required=False,type=int)
 ap.add_argument("-p", "--N_data_PASSES", required=False,type=int)
 ap.add_argument("-type", "--TYPE", required=False,type=str)
+ap.add_argument("-seed","--SEED", required=False,type=int,help="Seed of the task manifest (and of the shuffle of the test data).")
+ap.add_argument("-workers","--N_WORKERS", required=False,type=int,help="Number of processes the evaluation is sharded across (CPU only).")
+ap.add_argument("-cache","--CACHE_DIR", required=False,type=str,help="Directory to cache evaluation results in.")
+ap.add_argument("-var_cont","--VARIABLE_CONTEXT", type=bool, required=False, help="Every element of a minibatch has its own number of context points.")
 
 #Pass arguments:
 ARGS = vars(ap.parse_args())
@@ -36,21 +46,28 @@ ARGS = vars(ap.parse_args())
 train_dict=torch.load(ARGS['FILE'],map_location=torch.device('cpu'))
 
 if ARGS['TYPE']=="SteerCNP":
-    CNP=SteerCNP.SteerCNP.create_model_from_dict(train_dict['CNP_dict'])
+    CNP=steercnp.SteerCNP.create_model_from_dict(train_dict['CNP_dict'])
+    print(CNP.normalize_output)
+    print(CNP.kernel_dict_out)
 else:
     CNP=CNP_Model.ConditionalNeuralProcess.create_model_from_dict(train_dict['CNP_dict'])
 
 CNP=CNP.to(DEVICE)
 
-print(CNP.normalize_output)
-print(CNP.kernel_dict_out)
 MIN_N_CONT=2
 MAX_N_CONT=50
-FILEPATH="../../tasks/gp/gp_div_free_circle/"
-test_dataset=dataLoader.give_gp_div_free_data_set(MIN_N_CONT,MAX_N_CONT,'test',file_path=FILEPATH)
+FILEPATH="../../tasks/gp/"
+#The data set shuffles the observations when it is loaded - seed such that the manifest always refers to the same tasks:
+torch.manual_seed(ARGS['SEED'])
+test_dataset=dataLoader.give_gp_data_set(MIN_N_CONT,MAX_N_CONT,ARGS['DATA'],'test',file_path=FILEPATH)
 
-log_ll=training.test_cnp(CNP,test_dataset,DEVICE,n_samples=test_dataset.n_obs,batch_size=ARGS['BATCH_SIZE'],n_data_passes=ARGS['N_data_PASSES'])
+manifest=evaluation.give_task_manifest(test_dataset.n_obs,MIN_N_CONT,MAX_N_CONT,batch_size=ARGS['BATCH_SIZE'],
+                                       n_data_passes=ARGS['N_data_PASSES'],seed=ARGS['SEED'],variable_context=ARGS['VARIABLE_CONTEXT'])
+report=evaluation.evaluate(CNP,test_dataset,manifest,DEVICE,n_workers=ARGS['N_WORKERS'],cache_dir=ARGS['CACHE_DIR'],
+                           data_identifier='gp_'+ARGS['DATA']+'_test')
 print("Filename: ", ARGS['FILE'])
 print("Time: ", datetime.datetime.today())
-print("Test log-likelihood: ", log_ll)
+print("Test log-likelihood: ", report['log_ll'])
+print("Number of tasks: ", report['n_tasks'])
+print("Loaded from cache: ", report['cached'])
 print("Number of samples: ", ARGS['N_data_PASSES'])
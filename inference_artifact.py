@@ -0,0 +1,180 @@
+#LIBRARIES:
+#Tensors:
+import torch
+import numpy as np
+
+#Tools:
+from collections import OrderedDict
+import json
+import os
+import struct
+import sys
+import time
+import argparse
+
+#Own files:
+import steercnp
+import architectures
+import cnp.cnp_model as CNP_Model
+
+'''
+-------------------------------------------------------------------------
+--------------------------INFERENCE ARTIFACT-----------------------------
+-------------------------------------------------------------------------
+A slim format to load trained models for inference (e.g. in serving processes). An artifact is a directory with
+    config.json - the model dictionary (see SteerCNP.give_dict, ConditionalNeuralProcess.give_dict) without tensors
+    weights.safetensors - the state dict of the model as flat tensors in the safetensors layout:
+                          8 bytes (little-endian unsigned int) giving the size N of the header, N bytes JSON header
+                          {name: {'dtype','shape','data_offsets'}}, then the raw bytes of the tensors
+Compared to the training report (optimizer state, history,... pickled with torch.save), loading only parses a small
+JSON file and memory-maps the weights. If the decoder is exported (see architectures.ExportedSteerDecoder), it is
+created from plain convolutions, i.e. the bases of the steerable convolutions are not computed at all.
+'''
+DTYPES={torch.float32: 'F32',torch.float64: 'F64',torch.float16: 'F16',torch.int64: 'I64',torch.int32: 'I32',
+        torch.int16: 'I16',torch.int8: 'I8',torch.uint8: 'U8',torch.bool: 'BOOL'}
+NP_DTYPES={'F32': np.float32,'F64': np.float64,'F16': np.float16,'I64': np.int64,'I32': np.int32,
+           'I16': np.int16,'I8': np.int8,'U8': np.uint8,'BOOL': np.bool_}
+FORMAT_VERSION=1
+
+#Save a dictionary of tensors in the safetensors layout:
+def save_safetensors(tensors,filename,metadata=None):
+    '''
+    Input: tensors - dictionary - name: torch.Tensor
+           filename - string
+           metadata - dictionary of strings (or None)
+    '''
+    header={}
+    arrays=[]
+    offset=0
+    for name,tensor in tensors.items():
+        array=tensor.detach().cpu().contiguous().numpy()
+        header[name]={'dtype': DTYPES[tensor.dtype],'shape': list(tensor.shape),'data_offsets': [offset,offset+array.nbytes]}
+        arrays.append(array)
+        offset+=array.nbytes
+    if metadata is not None:
+        header['__metadata__']=metadata
+    header_bytes=json.dumps(header).encode()
+    #Pad the header with spaces such that the data is aligned to 8 bytes:
+    header_bytes+=b' '*((8-len(header_bytes)%8)%8)
+    #Write to a temporary file first such that an interrupted save does not leave a corrupted file:
+    with open(filename+'.tmp','wb') as f:
+        f.write(struct.pack('<Q',len(header_bytes)))
+        f.write(header_bytes)
+        for array in arrays:
+            f.write(array.tobytes())
+    os.replace(filename+'.tmp',filename)
+
+#Load a file in the safetensors layout:
+def load_safetensors(filename,mmap=True):
+    '''
+    Input: filename - string
+           mmap - Boolean - if True, the file is memory-mapped (copy-on-write) and only read when the tensors are used
+    Output: OrderedDict - name: torch.Tensor
+            dictionary - metadata
+    '''
+    with open(filename,'rb') as f:
+        header_size=struct.unpack('<Q',f.read(8))[0]
+        header=json.loads(f.read(header_size).decode())
+        if not mmap:
+            data=np.frombuffer(f.read(),dtype=np.uint8)
+    if mmap:
+        data=np.memmap(filename,dtype=np.uint8,mode='c',offset=8+header_size)
+    metadata=header.pop('__metadata__',{})
+    tensors=OrderedDict()
+    for name,info in header.items():
+        begin,end=info['data_offsets']
+        array=data[begin:end].view(NP_DTYPES[info['dtype']]).reshape(info['shape'])
+        tensors[name]=torch.from_numpy(array)
+    return(tensors,metadata)
+
+#Save a model as an inference artifact:
+def save_artifact(CNP,directory,export_decoder=False):
+    '''
+    Input: CNP - instance of SteerCNP or ConditionalNeuralProcess
+           directory - string - directory of the artifact (created if it does not exist)
+           export_decoder - Boolean - if True, a SteerDecoder is stored as exported decoder (see architectures.ExportedSteerDecoder)
+    '''
+    model_class=CNP.__class__.__name__
+    layer_specs=None
+    if model_class=='SteerCNP':
+        if CNP.decoder_type=="QuantizedCNNDecoder":
+            sys.exit("Quantized decoders can not be stored as flat tensors - use save_model_dict.")
+        if export_decoder and CNP.decoder_type=="SteerDecoder":
+            #Export a copy (the model itself is not changed):
+            CNP=steercnp.SteerCNP.create_model_from_dict(CNP.give_dict(),Decoder=CNP.decoder.export())
+        model_dict=CNP.give_dict()
+        model_dict['decoder_dict']={key: value for key,value in model_dict['decoder_dict'].items() if key!='decoder_par'}
+        if CNP.decoder_type=="ExportedSteerDecoder":
+            layer_specs=CNP.decoder.give_layer_specs()
+    elif model_class=='ConditionalNeuralProcess':
+        model_dict={key: value for key,value in CNP.give_dict().items() if key!='state_dict'}
+    else:
+        sys.exit("Unknown model class.")
+
+    config={'format_version': FORMAT_VERSION,
+            'model_class': model_class,
+            'model_dict': model_dict,
+            'decoder_layer_specs': layer_specs}
+    os.makedirs(directory,exist_ok=True)
+    save_safetensors(CNP.state_dict(),os.path.join(directory,'weights.safetensors'),metadata={'format': 'pt'})
+    with open(os.path.join(directory,'config.json'),'w') as f:
+        json.dump(config,f,indent=1)
+
+#Load a model from an inference artifact:
+def load_artifact(directory,device=torch.device('cpu'),mmap=True):
+    '''
+    Input: directory - string - directory of the artifact (see save_artifact)
+           device - instance of torch.device
+           mmap - Boolean - see load_safetensors
+    Output: instance of SteerCNP or ConditionalNeuralProcess (in evaluation mode)
+    '''
+    with open(os.path.join(directory,'config.json'),'r') as f:
+        config=json.load(f)
+    if config['format_version']!=FORMAT_VERSION:
+        sys.exit("Unknown format version of the artifact.")
+    model_dict=config['model_dict']
+    if config['model_class']=='SteerCNP':
+        if config['decoder_layer_specs'] is not None:
+            Decoder=architectures.ExportedSteerDecoder.create_model_from_layer_specs(model_dict['decoder_dict'],config['decoder_layer_specs'])
+        else:
+            Decoder=None
+        CNP=steercnp.SteerCNP.create_model_from_dict(model_dict,Decoder=Decoder)
+    elif config['model_class']=='ConditionalNeuralProcess':
+        CNP=CNP_Model.ConditionalNeuralProcess.create_model_from_dict(model_dict)
+    else:
+        sys.exit("Unknown model class.")
+    tensors,_=load_safetensors(os.path.join(directory,'weights.safetensors'),mmap=mmap)
+    CNP.load_state_dict(tensors)
+    CNP.eval()
+    return(CNP.to(device))
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        TYPE='SteerCNP',
+        EXPORT_DECODER=False)
+
+    ap.add_argument("-file", "--FILE", type=str, required=True,help="File of the trained model (training report or model dictionary)")
+    ap.add_argument("-out", "--OUT_DIR", type=str, required=True,help="Directory of the artifact")
+    ap.add_argument("-type", "--TYPE", type=str, required=False,help="Model type: SteerCNP or CNP")
+    ap.add_argument("-export", "--EXPORT_DECODER", type=bool, required=False,help="Store a steerable decoder exported to plain convolutions")
+    ARGS = vars(ap.parse_args())
+
+    start=time.time()
+    dictionary=torch.load(ARGS['FILE'],map_location=torch.device('cpu'))
+    if 'CNP_dict' in dictionary:
+        dictionary=dictionary['CNP_dict']
+    if ARGS['TYPE']=='SteerCNP':
+        CNP=steercnp.SteerCNP.create_model_from_dict(dictionary)
+    elif ARGS['TYPE']=='CNP':
+        CNP=CNP_Model.ConditionalNeuralProcess.create_model_from_dict(dictionary)
+    else:
+        sys.exit("Unknown model type.")
+    print("Loading from the training file: %.3fs"%(time.time()-start))
+
+    save_artifact(CNP,ARGS['OUT_DIR'],export_decoder=ARGS['EXPORT_DECODER'])
+    start=time.time()
+    load_artifact(ARGS['OUT_DIR'])
+    print("Loading from the artifact: %.3fs"%(time.time()-start))
+    print("Saved artifact in: ", ARGS['OUT_DIR'])
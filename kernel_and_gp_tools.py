@@ -37,6 +37,69 @@ ________________________________________________________________________________
 ----------------------------KERNEL TOOLS -------------------------------------------------------------------------
 ____________________________________________________________________________________________________________________
 '''
+#Fused evaluation of the divergence-free and curl-free kernels in 2d (equations (24) and (25) in
+#"Kernels for Vector-Valued Functions: a Review" by Alvarez et al). With u,v the differences of the coordinates, 
+#r2=u^2+v^2 and e=exp(-r2/(2*l_scale))/l_scale, the four entries of the 2x2 blocks are:
+#   div_free:  K11=e*(1-v^2/l_scale), K22=e*(1-u^2/l_scale), K12=K21=e*u*v/l_scale
+#   curl_free: K11=e*(1-u^2/l_scale), K22=e*(1-v^2/l_scale), K12=K21=-e*u*v/l_scale
+#They are written directly into one preallocated output and the backward pass is computed analytically
+#(only X,Y and l_scale are saved, the differences are recomputed).
+class FusedMatrixKernel2d(torch.autograd.Function):
+    @staticmethod
+    def give_entries(X,Y,l_scale):
+        '''
+        Input: X,Y - torch.tensor - shape (batch_size,n,2),(batch_size,m,2)
+               l_scale - torch.tensor - shape (batch_size,1,1) or (1,1,1)
+        Output: U,V,E - torch.tensor - shape (batch_size,n,m) - differences of the coordinates and e (see above)
+        '''
+        U=X[:,:,0].unsqueeze(2)-Y[:,:,0].unsqueeze(1)
+        V=X[:,:,1].unsqueeze(2)-Y[:,:,1].unsqueeze(1)
+        E=torch.exp(-0.5*(U**2+V**2)/l_scale)/l_scale
+        return(U,V,E)
+
+    @staticmethod
+    def forward(ctx,X,Y,l_scale,div_free):
+        '''
+        Input: X,Y - torch.tensor - shape (batch_size,n,2),(batch_size,m,2)
+               l_scale - torch.tensor - shape (batch_size,1,1) or (1,1,1)
+               div_free - Boolean - True: divergence-free kernel, False: curl-free kernel
+        Output: K - torch.tensor - shape (batch_size,n,m,2,2)
+        '''
+        U,V,E=FusedMatrixKernel2d.give_entries(X,Y,l_scale)
+        K=torch.empty(U.size()+(2,2),dtype=X.dtype,device=X.device)
+        P,Q=(V,U) if div_free else (U,V)
+        torch.mul(E,1-P**2/l_scale,out=K[:,:,:,0,0])
+        torch.mul(E,1-Q**2/l_scale,out=K[:,:,:,1,1])
+        torch.mul(E,U*V/l_scale if div_free else -U*V/l_scale,out=K[:,:,:,0,1])
+        K[:,:,:,1,0]=K[:,:,:,0,1]
+        ctx.save_for_backward(X,Y,l_scale)
+        ctx.div_free=div_free
+        return(K)
+
+    @staticmethod
+    def backward(ctx,Grad_K):
+        X,Y,l_scale=ctx.saved_tensors
+        U,V,E=FusedMatrixKernel2d.give_entries(X,Y,l_scale)
+        G11,G22,G_off=Grad_K[:,:,:,0,0],Grad_K[:,:,:,1,1],Grad_K[:,:,:,0,1]+Grad_K[:,:,:,1,0]
+        sign=1. if ctx.div_free else -1.
+        P,Q=(V,U) if ctx.div_free else (U,V)
+        #Derivative of e is e*(-u/l_scale,-v/l_scale) - the rest is the derivative of the polynomial parts:
+        S=E*(G11*(1-P**2/l_scale)+G22*(1-Q**2/l_scale)+sign*G_off*U*V/l_scale)
+        G_P,G_Q=(G22,G11) if ctx.div_free else (G11,G22)
+        Grad_U=-U/l_scale*S+E/l_scale*(-2*U*G_P+sign*V*G_off)
+        Grad_V=-V/l_scale*S+E/l_scale*(-2*V*G_Q+sign*U*G_off)
+        Grad_X=Grad_Y=Grad_l_scale=None
+        if ctx.needs_input_grad[0]:
+            Grad_X=torch.stack([Grad_U.sum(dim=2),Grad_V.sum(dim=2)],dim=2)
+        if ctx.needs_input_grad[1]:
+            Grad_Y=-torch.stack([Grad_U.sum(dim=1),Grad_V.sum(dim=1)],dim=2)
+        if ctx.needs_input_grad[2]:
+            Grad_l=S*((U**2+V**2)/(2*l_scale**2)-1/l_scale)+E/l_scale**2*(G11*P**2+G22*Q**2-sign*G_off*U*V)
+            Grad_l_scale=Grad_l.sum(dim=(1,2),keepdim=True)
+            if l_scale.size(0)==1:
+                Grad_l_scale=Grad_l_scale.sum(dim=0,keepdim=True)
+        return(Grad_X,Grad_Y,Grad_l_scale,None)
+
 # This function gives the Gram/Kernel -matrix K(X,Y) of two data sets X and Y"
 def gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_project=False,flatten=True):
     '''
@@ -53,108 +116,9 @@ def gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_pro
                  Block i,j of size DxD gives Kernel value of i-th X-data point and
                  j-th Y data point
     '''
-    #Get dimension of data space and number of observations from X:
-    d=X.size(1)
-    n=X.size(0)
-    #If B is not given, set to identity:
-    if B is None:
-        B=torch.eye(d).to(X.device)
-    #If Y is not given, set to X:
-    if Y is None:
-        Y=X
-    #Get number of observations from Y and dimension of B:
-    m=Y.size(0)
-    D=B.size(0)
-    #RBF kernel:
-    if kernel_type=="rbf":
-        #Expand X,Y along different dimension to get a grid shape:
-        X=X.unsqueeze(1).expand(n,m,d)
-        Y=Y.unsqueeze(0).expand(n,m,d)
-        #Compute the squared distance matrix:
-        Dist_mat=torch.sum((X-Y)**2,dim=2)
-        #Compute the RBF kernel from that:
-        Gram_RBF=sigma_var*torch.exp(-0.5*Dist_mat/l_scale)
-        #Expand B such that it has the right shape:
-        B=B.view(1,1,D,D)
-        B=B.expand(n,m,D,D)
-        #Reshape RBF Gram matrix:
-        Gram_RBF=Gram_RBF.view(n,m,1,1)
-        #Multiply scalar Gram matrix with the matrix B:
-        K=Gram_RBF*B
-
-    elif kernel_type=="dot_product":
-        #Get dot product Gram matrix:
-        Gram_one_d=torch.matmul(X,Y.t())
-        #Expand B:
-        B=B.view(1,1,D,D)
-        B=B.expand(n,m,D,D)
-        #Expand one-dimensional Gram:
-        Gram_one_d=Gram_one_d.view(n,m,1,1)
-        #Multiply with B:
-        K=Gram_one_d*B
-
-    elif kernel_type=="div_free":
-        '''
-        The following computations are based on equation (24) in
-        "Kernels for Vector-Valued Functions: a Review" by Alvarez et al
-        '''
-        #Create a distance matrix:
-        X=X.unsqueeze(1).expand(n,m,d)
-        Y=Y.unsqueeze(0).expand(n,m,d)
-        #Create distance matrix from that --> shape (n,m)
-        Dist_mat=torch.sum((X-Y)**2,dim=2)
-        #Create the RBF matrix from that --> shape (n,m)
-        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
-        #Reshape for later use:
-        Gram_RBF=Gram_RBF.view(n,m,1,1)
-        #Get the differences:
-        Diff=X-Y
-        #Get matrix of outer product --> shape (n,m,d,d)
-        Outer_Prod_Mat=torch.matmul(Diff.unsqueeze(3),Diff.unsqueeze(2))
-        #Get n*m copies of identity matrices in Rd--> shape (n,m,d,d)
-        Ids=torch.eye(d).to(X.device)
-        Ids=Ids.view(1,1,d,d)
-        Ids=Ids.expand(n,m,d,d)
-        #First matrix component for divergence-free kernel-->shape (n,m,d,d)
-        Mat_1=Outer_Prod_Mat/l_scale
-        #Second matrix component for divergence-free kernel --> shape (n,m,d,d)
-        Mat_2=(d-1-Dist_mat.view(n,m,1,1)/l_scale)*Ids
-        #Matrix sum of the two matrices:
-        A=Mat_1+Mat_2
-        #Multiply scalar and matrix part:
-        K=Gram_RBF*A
-    
-    elif kernel_type=="curl_free":
-        '''
-        The following computations are based on equation (25) in
-        "Kernels for Vector-Valued Functions: a Review" by Alvarez et al
-        '''
-        #Create a distance matrix:
-        X=X.unsqueeze(1).expand(n,m,d)
-        Y=Y.unsqueeze(0).expand(n,m,d)
-        #Create distance matrix from that --> shape (n,m)
-        Dist_mat=torch.sum((X-Y)**2,dim=2)
-        #Create the RBF matrix from that --> shape (n,m)
-        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
-        #Reshape for later use:
-        Gram_RBF=Gram_RBF.view(n,m,1,1)
-        #Get the differences:
-        Diff=X-Y
-        #Get matrix of outer product --> shape (n,m,d,d)
-        Outer_Prod_Mat=torch.matmul(Diff.unsqueeze(3),Diff.unsqueeze(2))
-        #Get n*m copies of identity matrices in Rd--> shape (n,m,d,d)
-        Ids=torch.eye(d).to(X.device)
-        Ids=Ids.view(1,1,d,d)
-        Ids=Ids.expand(n,m,d,d)
-        #First matrix component for divergence-free kernel-->shape (n,m,d,d)
-        Mat_1=Outer_Prod_Mat/l_scale
-        #Matrix sum of the two matrices:
-        A=Ids-Mat_1
-        #Multiply scalar and matrix part:
-        K=Gram_RBF*A
-
-    else:
-        sys.exit("Unknown kernel type")
+    #Compute via the batched version:
+    K=batch_gram_matrix(X.unsqueeze(0),Y.unsqueeze(0) if Y is not None else None,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,
+                        B=B,Ker_project=Ker_project,flatten=False)[0]
     if flatten:
         return(my_utils.create_matrix_from_blocks(K))
     else:
@@ -170,6 +134,7 @@ def batch_gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,K
     Y: torch.tensor or None
           Shape: (batch_size,m,d)...m number of obs, d...dimension of state space 
     l_scale,sigma_var,kernel_type,B,Ker_project: see function "mat_kernel"
+                 (l_scale and sigma_var can also be torch.tensors of shape (batch_size) - one value per element of the batch)
 
     Output:
     gram_matrix: torch.tensor
@@ -190,6 +155,11 @@ def batch_gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,K
     #Get number of observations from Y and dimension of B:
     m=Y.size(1)
     D=B.size(0)
+    #Hyperparameters per element of the batch are broadcasted over the points:
+    if torch.is_tensor(l_scale) and l_scale.dim()>0:
+        l_scale=l_scale.view(-1,1,1)
+    if torch.is_tensor(sigma_var) and sigma_var.dim()>0:
+        sigma_var=sigma_var.view(-1,1,1)
     #RBF kernel:
     if kernel_type=="rbf":
         #Expand X,Y along different dimension to get a grid shape:
@@ -218,36 +188,32 @@ def batch_gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,K
         #Multiply with B:
         K=Gram_one_d*B
 
-    elif kernel_type=="div_free":
+    elif kernel_type=="div_free" or kernel_type=="curl_free":
         '''
-        The following computations are based on equation (24) in
+        The following computations are based on equations (24) and (25) in
         "Kernels for Vector-Valued Functions: a Review" by Alvarez et al
         '''
-        #Create a distance matrix:
-        X=X.unsqueeze(2).expand(batch_size,n,m,d)
-        Y=Y.unsqueeze(1).expand(batch_size,n,m,d)
-        #Create distance matrix from that --> shape (batch_size,n,m)
-        Dist_mat=torch.sum((X-Y)**2,dim=3)
-        #Create the RBF matrix from that --> shape (batch_size,n,m)
-        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
-        #Reshape for later use:
-        Gram_RBF=Gram_RBF.view(batch_size,n,m,1,1)
-        #Get the differences -->shape (batch_size,n,m,d):
-        Diff=X-Y
-        #Get matrix of outer product --> shape (batch_size,n,m,d,d)
-        Outer_Prod_Mat=torch.matmul(Diff.unsqueeze(4),Diff.unsqueeze(3))
-        #Get n*m copies of identity matrices in Rd--> shape (batch_size,n,m,d,d)
-        Ids=torch.eye(d).to(X.device)
-        Ids=Ids.view(1,1,1,d,d)
-        Ids=Ids.expand(batch_size,n,m,d,d)
-        #First matrix component for divergence-free kernel-->shape (batch_size,n,m,d,d)
-        Mat_1=Outer_Prod_Mat/l_scale
-        #Second matrix component for divergence-free kernel --> shape (batch_size,n,m,d,d)
-        Mat_2=(d-1-Dist_mat.view(batch_size,n,m,1,1)/l_scale)*Ids
-        #Matrix sum of the two matrices:
-        A=Mat_1+Mat_2
-        #Multiply scalar and matrix part:
-        K=Gram_RBF*A
+        if d==2:
+            #Fused computation of the entries (see FusedMatrixKernel2d):
+            l_scale=torch.as_tensor(l_scale,dtype=X.dtype,device=X.device).reshape(-1,1,1)
+            K=FusedMatrixKernel2d.apply(X,Y,l_scale,kernel_type=="div_free")
+        else:
+            if torch.is_tensor(l_scale):
+                l_scale=l_scale.view(-1,1,1,1,1)
+            #Get the differences -->shape (batch_size,n,m,d):
+            Diff=X.unsqueeze(2)-Y.unsqueeze(1)
+            #Create distance matrix from that --> shape (batch_size,n,m,1,1)
+            Dist_mat=torch.sum(Diff**2,dim=3).view(batch_size,n,m,1,1)
+            #Create the RBF matrix from that --> shape (batch_size,n,m,1,1)
+            Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
+            #Get matrix of outer product divided by the length scale --> shape (batch_size,n,m,d,d)
+            Mat_1=torch.matmul(Diff.unsqueeze(4),Diff.unsqueeze(3))/l_scale
+            #Identity matrix in Rd:
+            Ids=torch.eye(d).to(X.device).view(1,1,1,d,d)
+            if kernel_type=="div_free":
+                K=Gram_RBF*(Mat_1+(d-1-Dist_mat/l_scale)*Ids)
+            else:
+                K=Gram_RBF*(Ids-Mat_1)
        
     else:
         sys.exit("Unknown kernel type")
@@ -437,6 +403,119 @@ def gp_inference(X_Context,Y_Context,X_Target,l_scale=1,sigma_var=1, kernel_type
     return(Means,Cov_Mat,Vars)
 
 
+#Cholesky decomposition of the Gram matrices of a batch of context sets (shared by batch_gp_inference and batch_gp_log_marginal_likelihood):
+def batch_context_cholesky(X_Context,Y_Context,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,mask_context=None):
+    '''
+    Input:
+        X_Context - torch.tensor - Shape (batch_size,n_context_points,d)
+        Y_Context - torch.tensor- Shape (batch_size,n_context_points,D)
+        l_scale,sigma_var,obs_noise - float or torch.tensor of shape (batch_size) - hyperparameters (per element of the batch)
+        mask_context - torch.tensor/None - Shape (batch_size,n_context_points) - 1. for context points, 0. for padding
+    Output:
+        L - torch.tensor - Shape (batch_size,n_context_points*D,n_context_points*D) - Cholesky factor of K(X_Context,X_Context)+noise
+        Y - torch.tensor - Shape (batch_size,n_context_points*D,1) - flattened Y_Context (padding set to zero)
+        Mask - torch.tensor/None - Shape (batch_size,n_context_points*D) - mask of the entries of Y
+    '''
+    batch_size,n_context_points,D=Y_Context.size()
+    Gram_context=batch_gram_matrix(X_Context,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+    Y=Y_Context.reshape(batch_size,n_context_points*D,1)
+    Mask=None
+    if mask_context is not None:
+        #Padding is decoupled from the context and target points (identity rows and columns):
+        Mask=mask_context.to(Gram_context.dtype).repeat_interleave(D,dim=1)
+        Gram_context=Gram_context*Mask.unsqueeze(2)*Mask.unsqueeze(1)+torch.diag_embed(1-Mask)
+        Y=Y*Mask.unsqueeze(2)
+    if torch.is_tensor(obs_noise) and obs_noise.dim()>0:
+        obs_noise=obs_noise.view(-1,1,1)
+    Gram_context=Gram_context+(obs_noise+chol_noise)*torch.eye(n_context_points*D,device=X_Context.device)
+    return(Gram_context.cholesky(),Y,Mask)
+
+#Batched version of gp_inference (Cholesky instead of an explicit inverse) which only gives the covariances of the individual
+#target points (no (n_target_points*D)^2 covariance matrix):
+def batch_gp_inference(X_Context,Y_Context,X_Target,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,mask_context=None):
+    '''
+    Input:
+        X_Context - torch.tensor - Shape (batch_size,n_context_points,d)
+        Y_Context - torch.tensor- Shape (batch_size,n_context_points,D)
+        X_Target - torch.tensor - Shape (batch_size,n_target_points,d)
+        l_scale,sigma_var,obs_noise - float or torch.tensor of shape (batch_size) - hyperparameters (per element of the batch)
+        mask_context - torch.tensor/None - Shape (batch_size,n_context_points) - 1. for context points, 0. for padding
+    Output:
+        Means - torch.tensor - Shape (batch_size,n_target_points,D) - Means of conditional dist.
+        Covs - torch.tensor - Shape (batch_size,n_target_points,D,D) - Covariance matrices of the conditional dist. per target point
+    '''
+    #Dimensions of data matrices:
+    batch_size,n_context_points,D=Y_Context.size()
+    n_target_points=X_Target.size(1)
+    d=X_Context.size(2)
+    #Cholesky decomposition of the Gram-Context matrix and matrix K(X_Target,X_Context):
+    L,Y,Mask=batch_context_cholesky(X_Context,Y_Context,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,obs_noise=obs_noise,
+                                    B=B,Ker_project=Ker_project,chol_noise=chol_noise,mask_context=mask_context)
+    Gram_target_context=batch_gram_matrix(X_Target,X_Context,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+    if Mask is not None:
+        Gram_target_context=Gram_target_context*Mask.unsqueeze(1)
+
+    #Get prediction means:
+    Means=torch.matmul(Gram_target_context,torch.cholesky_solve(Y,L)).view(batch_size,n_target_points,D)
+
+    #Get prediction covariances per target point (K(x,x)-V^TV with V=L^(-1)K(X_Context,x)):
+    V=torch.triangular_solve(Gram_target_context.transpose(1,2),L,upper=False)[0].view(batch_size,n_context_points*D,n_target_points,D)
+    Gram_target=batch_gram_matrix(X_Target.reshape(batch_size*n_target_points,1,d),
+                                  l_scale=l_scale.repeat_interleave(n_target_points) if torch.is_tensor(l_scale) and l_scale.dim()>0 else l_scale,
+                                  sigma_var=sigma_var.repeat_interleave(n_target_points) if torch.is_tensor(sigma_var) and sigma_var.dim()>0 else sigma_var,
+                                  kernel_type=kernel_type,B=B,Ker_project=Ker_project,flatten=False).view(batch_size,n_target_points,D,D)
+    if torch.is_tensor(obs_noise) and obs_noise.dim()>0:
+        obs_noise=obs_noise.view(-1,1,1,1)
+    Covs=Gram_target-torch.einsum('bknd,bkne->bnde',V,V)+(obs_noise+chol_noise)*torch.eye(D,device=X_Context.device)
+    return(Means,Covs)
+
+#Log-marginal likelihood log p(Y_Context|X_Context) of a batch of context sets (differentiable w.r.t. the hyperparameters):
+def batch_gp_log_marginal_likelihood(X_Context,Y_Context,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,mask_context=None):
+    '''
+    Input: see batch_context_cholesky
+    Output: torch.tensor - Shape (batch_size) - log-marginal likelihood per element of the batch
+    '''
+    L,Y,Mask=batch_context_cholesky(X_Context,Y_Context,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,obs_noise=obs_noise,
+                                    B=B,Ker_project=Ker_project,chol_noise=chol_noise,mask_context=mask_context)
+    Log_Diag_L=torch.log(torch.diagonal(L,dim1=1,dim2=2))
+    n_values=Y.size(1) if Mask is None else Mask.sum(dim=1)
+    if Mask is not None:
+        Log_Diag_L=Log_Diag_L*Mask
+    return(-0.5*torch.sum(Y*torch.cholesky_solve(Y,L),dim=(1,2))-Log_Diag_L.sum(dim=1)-0.5*n_values*math.log(2*math.pi))
+
+#Local GP: every target point is conditioned on its n_neighbours nearest context points only:
+def local_gp_inference(X_Context,Y_Context,X_Target,n_neighbours=32,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,
+                       chol_noise=1e-4,mask_context=None,chunk_size=None):
+    '''
+    Input:
+        X_Context,Y_Context,X_Target,mask_context - see batch_gp_inference
+        n_neighbours - int - number of nearest context points per target point
+        chunk_size - int/None - number of target points which are processed at once (None: all)
+    Output:
+        Means,Covs - see batch_gp_inference
+    The nearest neighbours are found with torch.topk on the (batch_size,n_target_points,n_context_points) distances and
+    the local GPs of all target points are solved as one batch, i.e. the cost is linear in the number of target points.
+    '''
+    batch_size,n_context_points,D=Y_Context.size()
+    d=X_Context.size(2)
+    n_neighbours=min(n_neighbours,n_context_points)
+    Batch_ind=torch.arange(batch_size,device=X_Context.device).view(batch_size,1,1)
+    def predict(X_Target_chunk):
+        n_target_points=X_Target_chunk.size(1)
+        Dist=torch.sum((X_Target_chunk.unsqueeze(2)-X_Context.unsqueeze(1))**2,dim=3)
+        if mask_context is not None:
+            Dist=Dist.masked_fill(mask_context.unsqueeze(1)==0,float('inf'))
+        Neighbours=Dist.topk(n_neighbours,dim=2,largest=False)[1]
+        Mask=mask_context[Batch_ind,Neighbours].reshape(-1,n_neighbours) if mask_context is not None else None
+        Means,Covs=batch_gp_inference(X_Context[Batch_ind,Neighbours].reshape(-1,n_neighbours,d),Y_Context[Batch_ind,Neighbours].reshape(-1,n_neighbours,D),
+                                      X_Target_chunk.reshape(-1,1,d),l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,obs_noise=obs_noise,
+                                      B=B,Ker_project=Ker_project,chol_noise=chol_noise,mask_context=Mask)
+        return(Means.view(batch_size,n_target_points,D),Covs.view(batch_size,n_target_points,D,D))
+    chunk_size=X_Target.size(1) if chunk_size is None else chunk_size
+    Means,Covs=zip(*my_utils.chunked_predictions(predict,X_Target,chunk_size))
+    return(torch.cat(Means,dim=1),torch.cat(Covs,dim=1))
+
+
 '''
 ____________________________________________________________________________________________________________________
 
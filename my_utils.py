@@ -60,8 +60,62 @@ def rand_target_context_splitter(X,Y,n_context_points):
     Y_Target=Y[:,ind_shuffle[n_context_points:,]]
     return(X_Context,Y_Context,X_Target,Y_Target)
 
-
-#This function returns the indices of an (n,n)-grid 
+#Tool to split an (already shuffled) batch in a context and target set where every element of the batch
+#has its own number of context points - the sets are padded to the same size and masks are returned:
+def padded_target_context_splitter(X,Y,n_context_points,cont_in_target=False):
+    '''
+    Inputs: X: torch.tensor - shape (batch_size,n,d) - n...number of observations, d...dimension of state space
+            Y: torch.tensor - shape (batch_size,n,D) - D...dimension of label space
+            n_context_points: torch.tensor of ints - shape (batch_size) - size of context set per element
+            cont_in_target: Boolean - if True, the target set includes the context set
+    Outputs:
+        X_Context: torch.tensor - shape (batch_size,max(n_context_points),d)
+        Y_Context: torch.tensor - shape (batch_size,max(n_context_points),D)
+        X_Target:  torch.tensor - shape (batch_size,n-min(n_context_points),d) (shape (batch_size,n,d) if cont_in_target)
+        Y_Target:  torch.tensor - shape (batch_size,n-min(n_context_points),D) (shape (batch_size,n,D) if cont_in_target)
+        Mask_Context: torch.tensor - shape (batch_size,max(n_context_points)) - 1. for context points, 0. for padding
+        Mask_Target: torch.tensor - shape (batch_size,n_target) - 1. for target points, 0. for padding
+    The first n_context_points[i] points of element i are its context points, the remaining ones its target points.
+    Padding consists of points of the same element (no zeros), so the models can process it without numerical problems.
+    '''
+    n_context_points=torch.as_tensor(n_context_points).to(X.device).view(-1)
+    n=X.size(1)
+    n_max=n_context_points.max().item()
+    n_min=n_context_points.min().item()
+    Mask_Context=(torch.arange(n_max,device=X.device)[None,:]<n_context_points[:,None]).to(X.dtype)
+    if cont_in_target:
+        Mask_Target=torch.ones((X.size(0),n),device=X.device,dtype=X.dtype)
+        return(X[:,:n_max],Y[:,:n_max],X,Y,Mask_Context,Mask_Target)
+    else:
+        Mask_Target=((torch.arange(n_min,n,device=X.device)[None,:])>=n_context_points[:,None]).to(X.dtype)
+        return(X[:,:n_max],Y[:,:n_max],X[:,n_min:],Y[:,n_min:],Mask_Context,Mask_Target)
+
+#Split a target set into chunks and apply a prediction function to every chunk (used for predictions on large target sets):
+def chunked_predictions(predict,X_target,chunk_size):
+    '''
+    Input: predict - function - maps a target set of shape (batch_size,n,d) to a tuple of tensors of shape (batch_size,n,...)
+           X_target - torch.tensor - shape (batch_size,n_target,d)
+           chunk_size - int - number of target points per chunk
+    Output: generator of the outputs of predict per chunk (in the order of the target points)
+    '''
+    chunk_size=max(int(chunk_size),1)
+    for start in range(0,X_target.size(1),chunk_size):
+        yield(predict(X_target[:,start:start+chunk_size]))
+
+#Masked mean over all points (used for the log-likelihood of padded batches):
+def masked_mean(X,mask=None):
+    '''
+    Input: X - torch.tensor - shape (batch_size,n)
+           mask - torch.tensor - shape (batch_size,n) - 1. for valid entries, 0. for padding (or None)
+    Output: torch.tensor - shape () - mean of the valid entries of X
+    '''
+    if mask is None:
+        return(X.mean())
+    else:
+        return((X*mask).sum()/mask.sum())
+
+
+#This function returns the indices of an (n,n)-grid
 #which are in the inner circle of that square grid.
 #In other words, those points in square which stay within the square
 #after a rotation.
@@ -115,18 +169,26 @@ def set_outer_circle_zero(X):
 #functions with the same "distance" to f (same as F) but a different shape.
 #Mathematically: we take the difference F-f between the two functions, center it to mean zero
 #i.e. take D=F-f-mean(F-f) and then take the the norm of D.
-def shape_regularizer(Y_1,Y_2):
+def shape_regularizer(Y_1,Y_2,mask=None):
     '''
     Input: Y_1,Y_2 - torch.tensor - shape (batch_size,T,*) - T...number of observations, *...shape of space
-    Output: float (torch.tensor of dim 0) - Centers Y_1-Y_2 to Cent_Diff and returns the Frobenius norm of Cent_Diff
+           mask - torch.tensor/None - shape (batch_size,T) - 1. for observations, 0. for padding (padding is ignored)
+    Output: torch.tensor - shape (batch_size) - Centers Y_1-Y_2 to Cent_Diff and returns the Frobenius norm of Cent_Diff per batch element
     '''
     #Compute the difference--> shape (batch_size,T,*)
     Diff=Y_1-Y_2
-    #Get means of difference--> shape (batch_size,*)
-    Means=Diff.mean(dim=1)
-    #Substract it from Diff:
-    Cent_Diff=Diff-Means.unsqueeze(1)
-    return(torch.sum(Cent_Diff**2,dim=(1,2)))
+    if mask is None:
+        #Get means of difference--> shape (batch_size,*)
+        Means=Diff.mean(dim=1)
+        #Substract it from Diff:
+        Cent_Diff=Diff-Means.unsqueeze(1)
+        return(torch.sum(Cent_Diff**2,dim=(1,2)))
+    else:
+        #Masked means of the difference--> shape (batch_size,*)
+        Mask=mask.view(mask.size(0),mask.size(1),*[1]*(Diff.dim()-2))
+        Means=(Diff*Mask).sum(dim=1)/Mask.sum(dim=1)
+        Cent_Diff=Diff-Means.unsqueeze(1)
+        return(torch.sum((Cent_Diff**2)*Mask,dim=(1,2)))
 
 
 '''
@@ -0,0 +1,129 @@
+#LIBRARIES:
+#Tensors:
+import torch
+
+#Tools:
+import contextlib
+import time
+import os
+import sys
+import psutil
+
+'''
+-------------------------------------------------------------------------
+--------------------------STAGE PROFILER----------------------------------
+-------------------------------------------------------------------------
+A profiler which records wall time and peak memory of named stages of a model
+(e.g. encoder, decoder, kernel smoother, loss, backward pass).
+Stages can be nested (e.g. the covariance activation is part of the target smoother).
+On a GPU, the peak memory is the peak of allocated memory by PyTorch during the stage.
+On a CPU, PyTorch does not expose a peak, so the resident set size of the process at
+the end of the stage is recorded instead.
+'''
+class StageProfiler(object):
+    def __init__(self,device=torch.device('cpu')):
+        '''
+        Input: device - instance of torch.device - device on which the model runs
+        '''
+        self.device=torch.device(device)
+        self.use_cuda=self.device.type=='cuda'
+        self.process=psutil.Process(os.getpid())
+        #Stack of peaks of currently open stages (needed for nested stages):
+        self.peak_stack=[]
+        self.reset()
+
+    def reset(self):
+        '''
+        Deletes all records.
+        '''
+        self.records={}
+
+    def give_memory(self):
+        '''
+        Output: float - allocated memory (GPU) or resident set size (CPU) in MB
+        '''
+        if self.use_cuda:
+            return(torch.cuda.memory_allocated(self.device)/1024**2)
+        else:
+            return(self.process.memory_info().rss/1024**2)
+
+    def give_peak_memory(self):
+        '''
+        Output: float - peak of allocated memory (GPU) or resident set size (CPU) in MB since the last reset
+        '''
+        if self.use_cuda:
+            return(torch.cuda.max_memory_allocated(self.device)/1024**2)
+        else:
+            return(self.give_memory())
+
+    def reset_peak_memory(self):
+        if self.use_cuda:
+            torch.cuda.reset_max_memory_allocated(self.device)
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        '''
+        Input: name - string - name of the stage
+        Context manager recording the wall time and peak memory of the code in the with-block.
+        '''
+        #The peak of the outer stage might be overwritten by resetting - so save it first:
+        if len(self.peak_stack)>0:
+            self.peak_stack[-1]=max(self.peak_stack[-1],self.give_peak_memory())
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+        self.reset_peak_memory()
+        self.peak_stack.append(self.give_memory())
+        start=time.perf_counter()
+        try:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        finally:
+            if self.use_cuda:
+                torch.cuda.synchronize(self.device)
+            wall_time=time.perf_counter()-start
+            peak=max(self.peak_stack.pop(),self.give_peak_memory())
+            #Propagate the peak to the outer stage:
+            if len(self.peak_stack)>0:
+                self.peak_stack[-1]=max(self.peak_stack[-1],peak)
+            self.update(name,wall_time,peak)
+
+    def update(self,name,wall_time,peak_memory):
+        '''
+        Input: name - string - name of the stage
+               wall_time - float - time in seconds
+               peak_memory - float - memory in MB
+        '''
+        if name not in self.records:
+            self.records[name]={'n_calls': 0,'total_time': 0.,'max_time': 0.,'peak_memory_MB': 0.}
+        record=self.records[name]
+        record['n_calls']+=1
+        record['total_time']+=wall_time
+        record['max_time']=max(record['max_time'],wall_time)
+        record['peak_memory_MB']=max(record['peak_memory_MB'],peak_memory)
+
+    def summary(self):
+        '''
+        Output: dictionary - for every stage: number of calls, total, mean and maximum wall time (seconds)
+                             and peak memory (MB)
+        '''
+        summary={}
+        for name,record in self.records.items():
+            summary[name]=dict(record,mean_time=record['total_time']/record['n_calls'])
+        return(summary)
+
+    def print_summary(self):
+        for name,record in self.summary().items():
+            print("%s | calls: %d | total time: %.4fs | mean time: %.6fs | peak memory: %.1f MB"\
+                %(name,record['n_calls'],record['total_time'],record['mean_time'],record['peak_memory_MB']))
+
+#Give a context manager for a stage if a profiler is given, otherwise a context manager doing nothing:
+def profile_stage(profiler,name):
+    '''
+    Input: profiler - StageProfiler/None
+           name - string - name of stage
+    Output: context manager
+    '''
+    if profiler is None:
+        return(contextlib.nullcontext())
+    else:
+        return(profiler.stage(name))
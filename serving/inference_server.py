@@ -0,0 +1,249 @@
+#LIBRARIES:
+#Tensors:
+import torch
+import numpy as np
+
+#Tools:
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+import warnings
+import argparse
+warnings.filterwarnings("ignore", category=UserWarning)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+#Own files:
+import steercnp
+import cnp.cnp_model as CNP_Model
+import tasks.era5.era5_dataset as dataset
+import inference_artifact
+
+#HYPERPARAMETERS and set seed:
+torch.set_default_dtype(torch.float)
+
+'''
+-------------------------------------------------------------------------
+--------------------------INFERENCE SERVER-------------------------------
+-------------------------------------------------------------------------
+A local asyncio HTTP server for wind field interpolation with a trained model.
+Endpoints:
+    POST /predict - body: JSON {"X_context": [[lon,lat],...], "Y_context": [[sp_in_kPa,t_in_Cels,wind_10m_east,wind_10m_north],...],
+                                "X_target": [[lon,lat],...]} (original scale)
+                    response: JSON {"Means": [[east,north],...], "Covs": [[[.,.],[.,.]],...]} (original scale)
+    GET /metrics  - latency percentiles, throughput and batch sizes
+Incoming requests are queued and coalesced into padded batches (see my_utils.padded_target_context_splitter)
+up to a maximal batch size or a maximal waiting time. Every batch is processed by one forward pass under torch.no_grad.
+'''
+
+class InferenceServer(object):
+    def __init__(self,CNP,translater,device=torch.device('cpu'),max_batch_size=32,max_wait_ms=5.,n_latencies_kept=10000):
+        '''
+        Input: CNP - model accepting a context mask (see SteerCNP.forward)
+               translater - instance of ERA5_translater - normalizes inputs and denormalizes outputs
+               max_batch_size - int - maximal number of requests per batch
+               max_wait_ms - float - maximal time a request waits for other requests to be batched with
+               n_latencies_kept - int - number of latest latencies used for the percentiles
+        '''
+        self.CNP=CNP.to(device)
+        self.translater=translater
+        self.device=device
+        self.max_batch_size=max_batch_size
+        self.max_wait_ms=max_wait_ms
+        self.latencies=collections.deque(maxlen=n_latencies_kept)
+        self.batch_sizes=collections.deque(maxlen=n_latencies_kept)
+        self.n_requests=0
+        self.n_batches=0
+        self.start_time=time.time()
+        self.queue=None
+
+    #----------------------------BATCHING------------------------------------
+    def pad(self,tensor_list):
+        '''
+        Input: tensor_list - list of torch.Tensor - shapes (n_i,d)
+        Output: torch.Tensor - shape (len(tensor_list),max n_i,d) - padded by repeating the first row
+                torch.Tensor - shape (len(tensor_list),max n_i) - mask (1. for data, 0. for padding)
+        '''
+        n_max=max(tensor.size(0) for tensor in tensor_list)
+        Padded=torch.stack([torch.cat([tensor,tensor[:1].expand(n_max-tensor.size(0),tensor.size(1))],dim=0) for tensor in tensor_list],dim=0)
+        Mask=torch.stack([(torch.arange(n_max)<tensor.size(0)).to(Padded.dtype) for tensor in tensor_list],dim=0)
+        return(Padded,Mask)
+
+    def process_batch(self,requests):
+        '''
+        Input: requests - list of dictionaries with keys 'X_context','Y_context','X_target' (torch.Tensor, original scale)
+        Output: list of dictionaries with keys 'Means','Covs' (lists, original scale)
+        '''
+        X_context,Mask_context=self.pad([self.translater.norm_X(request['X_context']) for request in requests])
+        Y_context,_=self.pad([self.translater.norm_Y(request['Y_context']) for request in requests])
+        X_target,_=self.pad([self.translater.norm_X(request['X_target']) for request in requests])
+        with torch.no_grad():
+            Means,Covs=self.CNP(X_context.to(self.device),Y_context.to(self.device),X_target.to(self.device),
+                               mask_context=Mask_context.to(self.device))
+        Means=self.translater.denorm_Y_out(Means.cpu())
+        Covs=self.translater.denorm_Cov_out(Covs.cpu())
+        results=[]
+        for i,request in enumerate(requests):
+            n_target=request['X_target'].size(0)
+            results.append({'Means': Means[i,:n_target].tolist(),'Covs': Covs[i,:n_target].tolist()})
+        return(results)
+
+    async def batcher(self):
+        '''
+        Coalesces queued requests into batches and runs them (in a thread, such that new requests are accepted meanwhile).
+        '''
+        loop=asyncio.get_running_loop()
+        while True:
+            batch=[await self.queue.get()]
+            deadline=loop.time()+self.max_wait_ms/1000
+            while len(batch)<self.max_batch_size:
+                timeout=deadline-loop.time()
+                if timeout<=0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),timeout))
+                except asyncio.TimeoutError:
+                    break
+            requests=[request for request,future in batch]
+            try:
+                results=await loop.run_in_executor(None,self.process_batch,requests)
+                for (request,future),result in zip(batch,results):
+                    future.set_result(result)
+            except Exception:
+                #Retry the requests one by one such that only the failing requests get the error:
+                for request,future in batch:
+                    try:
+                        future.set_result((await loop.run_in_executor(None,self.process_batch,[request]))[0])
+                    except Exception as error:
+                        future.set_exception(error)
+            self.n_batches+=1
+            self.batch_sizes.append(len(batch))
+
+    #----------------------------METRICS------------------------------------
+    def give_metrics(self):
+        '''
+        Output: dictionary - latency percentiles (ms), throughput (requests per second) and mean batch size
+        '''
+        latencies=np.array(self.latencies) if len(self.latencies)>0 else np.zeros(1)
+        elapsed=time.time()-self.start_time
+        return({'n_requests': self.n_requests,
+                'n_batches': self.n_batches,
+                'p50_latency_ms': float(np.percentile(latencies,50)*1000),
+                'p99_latency_ms': float(np.percentile(latencies,99)*1000),
+                'mean_latency_ms': float(latencies.mean()*1000),
+                'throughput_per_second': self.n_requests/elapsed,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes)>0 else 0.})
+
+    #----------------------------HTTP------------------------------------
+    async def handle_predict(self,body):
+        start=time.time()
+        data=json.loads(body)
+        request={key: torch.tensor(data[key],dtype=torch.get_default_dtype()) for key in ['X_context','Y_context','X_target']}
+        #Control the shapes: X_context (n,2), Y_context (n,4) with n>=1 and X_target (n_target,2) with n_target>=1:
+        for key,dim in [('X_context',2),('Y_context',4),('X_target',2)]:
+            if request[key].dim()!=2 or request[key].size(0)==0 or request[key].size(1)!=dim:
+                raise ValueError("%s must be a non-empty list of points with %d coordinates."%(key,dim))
+        if request['X_context'].size(0)!=request['Y_context'].size(0):
+            raise ValueError("X_context and Y_context do not have the same length.")
+        future=asyncio.get_running_loop().create_future()
+        await self.queue.put((request,future))
+        result=await future
+        self.latencies.append(time.time()-start)
+        self.n_requests+=1
+        return(result)
+
+    async def handle_connection(self,reader,writer):
+        try:
+            request_line=(await reader.readline()).decode().split()
+            headers={}
+            while True:
+                line=(await reader.readline()).decode().strip()
+                if line=='':
+                    break
+                key,value=line.split(':',1)
+                headers[key.strip().lower()]=value.strip()
+            body=await reader.readexactly(int(headers.get('content-length',0)))
+            method,path=request_line[0],request_line[1]
+            try:
+                if method=='POST' and path=='/predict':
+                    status,response='200 OK',await self.handle_predict(body)
+                elif method=='GET' and path=='/metrics':
+                    status,response='200 OK',self.give_metrics()
+                else:
+                    status,response='404 Not Found',{'error': 'Unknown endpoint.'}
+            except (ValueError,KeyError) as error:
+                status,response='400 Bad Request',{'error': str(error)}
+            except Exception as error:
+                status,response='500 Internal Server Error',{'error': str(error)}
+            payload=json.dumps(response).encode()
+            writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"\
+                          %(status,len(payload))).encode()+payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self,host='127.0.0.1',port=8080):
+        self.queue=asyncio.Queue()
+        self.start_time=time.time()
+        batcher=asyncio.ensure_future(self.batcher())
+        server=await asyncio.start_server(self.handle_connection,host,port)
+        print("Serving on http://%s:%d (max batch size: %d, max waiting time: %.1f ms)"%(host,port,self.max_batch_size,self.max_wait_ms))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+#Load a model from an inference artifact (see inference_artifact.py), a file saved by train_cnp (Report with key 'CNP_dict') or by save_model_dict:
+def load_model(filename,model_type='SteerCNP'):
+    if os.path.isdir(filename):
+        return(inference_artifact.load_artifact(filename))
+    dictionary=torch.load(filename,map_location=torch.device('cpu'))
+    if 'CNP_dict' in dictionary:
+        dictionary=dictionary['CNP_dict']
+    if model_type=='SteerCNP':
+        return(steercnp.SteerCNP.create_model_from_dict(dictionary))
+    elif model_type=='CNP':
+        return(CNP_Model.ConditionalNeuralProcess.create_model_from_dict(dictionary))
+    else:
+        sys.exit("Unknown model type.")
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        TYPE='SteerCNP',
+        PLACE='US',
+        HOST='127.0.0.1',
+        PORT=8080,
+        MAX_BATCH_SIZE=32,
+        MAX_WAIT_MS=5.,
+        N_THREADS=None,
+        STATS_FILE=None)
+
+    ap.add_argument("-file", "--FILE", type=str, required=True,help="File of the trained model or directory of an inference artifact")
+    ap.add_argument("-type", "--TYPE", type=str, required=False,help="Model type: SteerCNP or CNP")
+    ap.add_argument("-place", "--PLACE", type=str, required=False,help="US or China (normalization of the data)")
+    ap.add_argument("-host", "--HOST", type=str, required=False,help="Host")
+    ap.add_argument("-port", "--PORT", type=int, required=False,help="Port")
+    ap.add_argument("-batch", "--MAX_BATCH_SIZE", type=int, required=False,help="Maximal number of requests per batch")
+    ap.add_argument("-wait", "--MAX_WAIT_MS", type=float, required=False,help="Maximal waiting time of a request for a batch in ms")
+    ap.add_argument("-threads", "--N_THREADS", type=int, required=False,help="Number of CPU threads of torch")
+    ap.add_argument("-stats", "--STATS_FILE", type=str, required=False,help="Statistics of the data set (<file>.stats.json, see era5_dataset.give_stats) used instead of the constants of the place")
+    ARGS = vars(ap.parse_args())
+
+    if ARGS['N_THREADS'] is not None:
+        torch.set_num_threads(ARGS['N_THREADS'])
+    DEVICE=torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+
+    CNP=load_model(ARGS['FILE'],ARGS['TYPE'])
+    stats=None
+    if ARGS['STATS_FILE'] is not None:
+        with open(ARGS['STATS_FILE'],'r') as f:
+            stats=json.load(f)['stats']
+    server=InferenceServer(CNP,dataset.ERA5_translater(place=ARGS['PLACE'],stats=stats),device=DEVICE,
+                           max_batch_size=ARGS['MAX_BATCH_SIZE'],max_wait_ms=ARGS['MAX_WAIT_MS'])
+    asyncio.run(server.serve(ARGS['HOST'],ARGS['PORT']))
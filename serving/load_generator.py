@@ -0,0 +1,93 @@
+#LIBRARIES:
+#Tensors:
+import numpy as np
+
+#Tools:
+import asyncio
+import json
+import sys
+import time
+import argparse
+
+'''
+-------------------------------------------------------------------------
+--------------------------LOAD GENERATOR---------------------------------
+-------------------------------------------------------------------------
+Sends random (context,target) requests to the inference server (see inference_server.py) with a given
+concurrency and reports client-side latency percentiles and throughput as well as the metrics of the server.
+Context and target locations are drawn uniformly around the center of the region (US or China),
+the context values are drawn around typical values of the ERA5 variables.
+'''
+CENTERS={'US': [-91.,35.],'China': [110.,30.]}
+
+def give_rand_request(n_context,n_target,place='US'):
+    '''
+    Output: dictionary - request for POST /predict (see inference_server.py)
+    '''
+    center=np.array(CENTERS[place])
+    X_context=center+np.random.uniform(-5,5,size=(n_context,2))
+    X_target=center+np.random.uniform(-5,5,size=(n_target,2))
+    Y_context=np.array([100.,7.5,0.,0.])+np.array([1.5,8.5,3.4,3.4])*np.random.randn(n_context,4)
+    return({'X_context': X_context.tolist(),'Y_context': Y_context.tolist(),'X_target': X_target.tolist()})
+
+async def send_request(host,port,method,path,body=None):
+    '''
+    Output: dictionary - JSON response of the server
+    '''
+    reader,writer=await asyncio.open_connection(host,port)
+    payload=json.dumps(body).encode() if body is not None else b''
+    writer.write(("%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"\
+                  %(method,path,host,len(payload))).encode()+payload)
+    await writer.drain()
+    response=await reader.read()
+    writer.close()
+    header,body=response.split(b'\r\n\r\n',1)
+    if not header.startswith(b'HTTP/1.1 200'):
+        sys.exit("Request failed: "+header.decode().split('\r\n')[0]+" "+body.decode())
+    return(json.loads(body))
+
+async def run_load(ARGS):
+    latencies=[]
+    counter={'n_sent': 0}
+    async def worker():
+        while counter['n_sent']<ARGS['N_REQUESTS']:
+            counter['n_sent']+=1
+            request=give_rand_request(np.random.randint(ARGS['MIN_N_CONT'],ARGS['MAX_N_CONT']+1),ARGS['N_TARGET'],ARGS['PLACE'])
+            start=time.time()
+            await send_request(ARGS['HOST'],ARGS['PORT'],'POST','/predict',request)
+            latencies.append(time.time()-start)
+    start=time.time()
+    await asyncio.gather(*[worker() for _ in range(ARGS['CONCURRENCY'])])
+    elapsed=time.time()-start
+    latencies=np.array(latencies)
+    print("Requests: %d | concurrency: %d | throughput: %.1f requests/s"%(len(latencies),ARGS['CONCURRENCY'],len(latencies)/elapsed))
+    print("Client latency: p50: %.2f ms | p99: %.2f ms | mean: %.2f ms"%(np.percentile(latencies,50)*1000,np.percentile(latencies,99)*1000,latencies.mean()*1000))
+    print("Server metrics: ", await send_request(ARGS['HOST'],ARGS['PORT'],'GET','/metrics'))
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        HOST='127.0.0.1',
+        PORT=8080,
+        N_REQUESTS=1000,
+        CONCURRENCY=32,
+        MIN_N_CONT=5,
+        MAX_N_CONT=50,
+        N_TARGET=100,
+        PLACE='US',
+        SEED=1)
+
+    ap.add_argument("-host", "--HOST", type=str, required=False,help="Host of the server")
+    ap.add_argument("-port", "--PORT", type=int, required=False,help="Port of the server")
+    ap.add_argument("-n", "--N_REQUESTS", type=int, required=False,help="Total number of requests")
+    ap.add_argument("-c", "--CONCURRENCY", type=int, required=False,help="Number of concurrent clients")
+    ap.add_argument("-n_cont_min", "--MIN_N_CONT", type=int, required=False,help="Minimal number of context points")
+    ap.add_argument("-n_cont_max", "--MAX_N_CONT", type=int, required=False,help="Maximal number of context points")
+    ap.add_argument("-n_target", "--N_TARGET", type=int, required=False,help="Number of target points")
+    ap.add_argument("-place", "--PLACE", type=str, required=False,help="US or China")
+    ap.add_argument("-seed", "--SEED", type=int, required=False,help="Seed")
+    ARGS = vars(ap.parse_args())
+
+    np.random.seed(ARGS['SEED'])
+    asyncio.run(run_load(ARGS))
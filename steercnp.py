@@ -33,6 +33,7 @@ import equiv_encoder
 from cov_activ_func import cov_activ_func
 import decoder_models as models
 import architectures
+from profiling import profile_stage
 
 #HYPERPARAMETERS and set seed:
 torch.set_default_dtype(torch.float)
@@ -71,6 +72,8 @@ class SteerCNP(nn.Module):
         #Save the dimension of the covariance estimator of the last layer:
         self.dim_cov_est=dim_cov_est
         self.dim_context_feat=dim_context_feat
+        #Profiler for the stages of the forward pass (None means no profiling, see profiling.StageProfiler):
+        self.profiler=None
         #-----------------------SAVING of PARAMETERS FINISHED---------------------------------
 
 
@@ -93,20 +96,27 @@ class SteerCNP(nn.Module):
         if (self.dim_cov_est+2)!=test_output.size(1):sys.exit("Number of output channels!=2+dim of cov estimation.")
         #-------------------END CONTROL WHETHER DECODER ACCEPTS AND RETURNS CORRECT SHAPES----
         '''
-    #Define the function which maps the output of the decoder to
-    #predictions on the target set based on kernel smoothing, i.e. the predictions on 
-    #the target set are obtained by kernel smoothing of these points on the grid of encoder
-    def target_smoother(self,X_target,Final_Feature_Map):
+    #Prepare the decoder for inference: a SteerDecoder is exported to plain convolutions (see architectures.ExportedSteerDecoder)
+    #and the decoder is set to channels_last memory format (if wanted):
+    def export_decoder(self,channels_last=False):
+        if self.decoder_type=="SteerDecoder":
+            self.decoder=self.decoder.export()
+            self.decoder_type=self.decoder.__class__.__name__
+        if hasattr(self.decoder,'set_channels_last'):
+            self.decoder.set_channels_last(channels_last)
+        return(self)
+
+    #Define the function which maps the output of the decoder to means and (activated) covariances on the grid of the encoder:
+    def decode_grid(self,Final_Feature_Map):
         '''
-        Input: X_target - torch.tensor- shape (batch_size,n_target,2)
-               Final_Feature_Map- torch.tensor - shape (batch_size,self.dim_cov_est+2,self.encoder.n_y_axis,self.encoder.n_x_axis)
-        Output: Predictions on X_target - Means_target - torch.tensor - shape (batch_size,n_target,2)
-                Covariances on X_target - Covs_target - torch.tensor - shape (batch_size,n_target,2,2)
+        Input: Final_Feature_Map- torch.tensor - shape (batch_size,self.dim_cov_est+2,n_y_axis,n_x_axis) (grid of the encoder)
+        Output: Means_grid - torch.tensor - shape (batch_size,n_y_axis*n_x_axis,2)
+                Covs_grid - torch.tensor - shape (batch_size,n_y_axis*n_x_axis,2,2)
         '''
-        batch_size=X_target.size(0)
+        batch_size=Final_Feature_Map.size(0)
         #-----------SPLIT FINAL FEATURE MAP INTO MEANS AND COVARIANCE PARAMETERS----------
-        #Reshape the Final Feature Map:
-        Resh_Final_Feature_Map=Final_Feature_Map.permute(dims=(0,2,3,1)).reshape(batch_size,self.encoder.n_y_axis*self.encoder.n_x_axis,
+        #Reshape the Final Feature Map (if it is in channels_last memory format, this is a view and not a copy):
+        Resh_Final_Feature_Map=Final_Feature_Map.permute(dims=(0,2,3,1)).reshape(batch_size,Final_Feature_Map.size(2)*Final_Feature_Map.size(3),
                                                             self.dim_cov_est+2)
         #Split into mean and parameters for covariance:
         Means_grid=Resh_Final_Feature_Map[:,:,:2]
@@ -114,51 +124,172 @@ class SteerCNP(nn.Module):
         #----------END SPLIT FINAL FEATURE MAP INTO MEANS AND COVARIANCE PARAMETERS----------
 
         #-----------APPLY ACITVATION FUNCTION ON COVARIANCES---------------------
-        Covs_grid=cov_activ_func(Pre_Activ_Covs_grid,dim_cov_est=self.dim_cov_est)
+        with profile_stage(self.profiler,'cov_activ_func'):
+            Covs_grid=cov_activ_func(Pre_Activ_Covs_grid,dim_cov_est=self.dim_cov_est)
         #-----------END APPLY ACITVATION FUNCTION ON COVARIANCES---------------------
+        return(Means_grid,Covs_grid)
 
+    #Define the function which gives predictions on the target set by kernel smoothing of the means and covariances on the grid:
+    def smooth_grid(self,X_target,Means_grid,Covs_grid,grid=None):
+        '''
+        Input: X_target - torch.tensor- shape (batch_size,n_target,2)
+               Means_grid,Covs_grid - torch.tensor - output of self.decode_grid
+               grid - torch.tensor - shape (n_grid,2) - grid of Means_grid and Covs_grid (None: fixed grid of the encoder)
+        Output: Predictions on X_target - Means_target - torch.tensor - shape (batch_size,n_target,2)
+                Covariances on X_target - Covs_target - torch.tensor - shape (batch_size,n_target,2,2)
+        '''
+        batch_size=X_target.size(0)
         #-----------APPLY KERNEL SMOOTHING --------------------------------------
         #Set the lenght scale (clamp for numerical stability):
         l_scale=torch.exp(torch.clamp(self.log_l_scale_out,max=5.,min=-5.))
         #Create a batch-version of the grid (need shape (batch_size,n,2)):
-        expand_grid=self.encoder.grid.unsqueeze(0).expand(batch_size,self.encoder.grid.size(0),2)
+        if grid is None:
+            grid=self.encoder.grid
+        expand_grid=grid.unsqueeze(0).expand(batch_size,grid.size(0),2)
         #Means on Target Set (via Kernel smoothing) --> shape (batch_size,n_target,2):
-        Means_target=GP.batch_kernel_smoother_2d(X_Context=expand_grid,
-                                          Y_Context=Means_grid,
-                                           X_Target=X_target,normalize=self.normalize_output,
-                                           l_scale=l_scale,**self.kernel_dict_out)
+        with profile_stage(self.profiler,'smoother_means'):
+            Means_target=GP.batch_kernel_smoother_2d(X_Context=expand_grid,
+                                            Y_Context=Means_grid,
+                                            X_Target=X_target,normalize=self.normalize_output,
+                                            l_scale=l_scale,**self.kernel_dict_out)
         
         #Create flattened version (needed for target smoother):
-        Covs_grid_flat=Covs_grid.view(batch_size,self.encoder.n_y_axis*self.encoder.n_x_axis,-1)
+        Covs_grid_flat=Covs_grid.view(batch_size,grid.size(0),-1)
         #3.Get covariances on target set--> shape (batch_size,n_target,4):
-        Covs_target_flat=GP.batch_kernel_smoother_2d(X_Context=expand_grid,
-                                            Y_Context=Covs_grid_flat,
-                                          X_Target=X_target,normalize=self.normalize_output,
-                                          l_scale=l_scale,kernel_type="rbf")                                 
+        with profile_stage(self.profiler,'smoother_covs'):
+            Covs_target_flat=GP.batch_kernel_smoother_2d(X_Context=expand_grid,
+                                                Y_Context=Covs_grid_flat,
+                                            X_Target=X_target,normalize=self.normalize_output,
+                                            l_scale=l_scale,kernel_type="rbf")                                 
         #Reshape covariance matrices to proper matrices --> shape (batch_size,n_target,2,2):
         Covs_target=Covs_target_flat.view(batch_size,X_target.size(1),2,2)
         #-----------END APPLY KERNEL SMOOTHING --------------------------------------
         return(Means_target, Covs_target)
 
+    #Define the function which maps the output of the decoder to
+    #predictions on the target set based on kernel smoothing, i.e. the predictions on 
+    #the target set are obtained by kernel smoothing of these points on the grid of encoder
+    def target_smoother(self,X_target,Final_Feature_Map,grid=None):
+        '''
+        Input: X_target - torch.tensor- shape (batch_size,n_target,2)
+               Final_Feature_Map- torch.tensor - shape (batch_size,self.dim_cov_est+2,n_y_axis,n_x_axis)
+               grid - torch.tensor - shape (n_y_axis*n_x_axis,2) - grid of the feature map (None: fixed grid of the encoder)
+        Output: Predictions on X_target - Means_target - torch.tensor - shape (batch_size,n_target,2)
+                Covariances on X_target - Covs_target - torch.tensor - shape (batch_size,n_target,2,2)
+        '''
+        Means_grid,Covs_grid=self.decode_grid(Final_Feature_Map)
+        return(self.smooth_grid(X_target,Means_grid,Covs_grid,grid=grid))
+
+    #Grid of the encoder for a batch: the fixed grid or (if self.encoder.adaptive_grid) a grid fitted to the batch
+    #which has at least as many points per axis as the largest kernel of the decoder:
+    def give_grid_dict(self,X_context,X_target=None):
+        '''
+        Input: X_context,X_target - torch.tensor - see self.forward
+        Output: None (fixed grid) or grid_dict - dictionary - see EquivEncoder.give_adaptive_grid
+        '''
+        if not self.encoder.adaptive_grid:
+            return(None)
+        min_size=max(getattr(self.decoder,'kernel_sizes',[1]))
+        return(self.encoder.give_adaptive_grid(X_context,X_target,min_size=min_size))
+
     #Define the forward pass of ConvCNP: 
-    def forward(self,X_context,Y_context,X_target):
+    def forward(self,X_context,Y_context,X_target,mask_context=None):
         '''
         Inputs:
             X_context: torch.tensor - shape (batch_size,n_context,2)
             Y_context: torch.tensor - shape (batch_size,n_context,2)
             X_target: torch.tensor - shape (batch_size,n_target,2)
+            mask_context: torch.tensor - shape (batch_size,n_context) - 1. for context points, 0. for padding (None: no padding)
+                          (padded target points are predicted independently and only have to be masked in the loss)
         Outputs:
             Means_target: torch.tensor - shape (batch_size,n_target,2) - mean of predictions
             Sigmas_target: torch.tensor -shape (batch_size,n_target,2) - scale of predictions
         '''
-        #1.Context Set -> Embedding (via Encoder) --> shape (batch_size,3,self.encoder.n_y_axis,self.encoder.n_x_axis):
-        Embedding=self.encoder(X_context,Y_context)
-        #2.Embedding ->Feature Map (via CNN) --> shape (batch_size,2+self.dim_cov_est,self.encoder.n_y_axis,self.encoder.n_x_axis):
-        Final_Feature_Map=self.decoder(Embedding)
+        #0.Grid of the encoder (None: fixed grid):
+        grid_dict=self.give_grid_dict(X_context,X_target)
+        #1.Context Set -> Embedding (via Encoder) --> shape (batch_size,3,n_y_axis,n_x_axis):
+        with profile_stage(self.profiler,'encoder'):
+            Embedding=self.encoder(X_context,Y_context,mask=mask_context,grid_dict=grid_dict)
+        #2.Embedding ->Feature Map (via CNN) --> shape (batch_size,2+self.dim_cov_est,n_y_axis,n_x_axis):
+        with profile_stage(self.profiler,'decoder'):
+            Final_Feature_Map=self.decoder(Embedding)
         #Smooth the output:
-        Means_target,Sigmas_target=self.target_smoother(X_target,Final_Feature_Map)
+        Means_target,Sigmas_target=self.target_smoother(X_target,Final_Feature_Map,grid=None if grid_dict is None else grid_dict['grid'])
         #Sigmas_target=Sigmas_target.clamp(min=1e-1,max=10.)
         return(Means_target,Sigmas_target)
+
+    #Two-phase version of the forward pass: the context set is only encoded and decoded once, the target set can be queried many times.
+    #1.Condition on the context set:
+    def condition(self,X_context,Y_context,mask_context=None,X_target=None):
+        '''
+        Inputs: X_context,Y_context,mask_context - see self.forward
+                X_target - torch.tensor - shape (batch_size,n_target,2) - only used for the extent of an adaptive grid (optional)
+        Output: handle - dictionary - 'Means_grid': torch.tensor - shape (batch_size,n_y_axis*n_x_axis,2)
+                                      'Covs_grid': torch.tensor - shape (batch_size,n_y_axis*n_x_axis,2,2)
+                                      'grid': torch.tensor - shape (n_y_axis*n_x_axis,2) (only for an adaptive grid)
+        '''
+        grid_dict=self.give_grid_dict(X_context,X_target)
+        with profile_stage(self.profiler,'encoder'):
+            Embedding=self.encoder(X_context,Y_context,mask=mask_context,grid_dict=grid_dict)
+        with profile_stage(self.profiler,'decoder'):
+            Final_Feature_Map=self.decoder(Embedding)
+        Means_grid,Covs_grid=self.decode_grid(Final_Feature_Map)
+        #Means_grid is a slice of the final feature map - clone it such that the handle does not keep the whole map alive:
+        handle={'Means_grid': Means_grid.clone(),'Covs_grid': Covs_grid}
+        if grid_dict is not None:
+            handle['grid']=grid_dict['grid']
+        return(handle)
+
+    #2.Predict on a target set:
+    def predict(self,handle,X_target):
+        '''
+        Inputs: handle - dictionary - output of self.condition
+                X_target: torch.tensor - shape (batch_size,n_target,2)
+        Outputs: Means_target,Sigmas_target - see self.forward
+        '''
+        return(self.smooth_grid(X_target,handle['Means_grid'],handle['Covs_grid'],grid=handle.get('grid')))
+
+    #Streaming predictions on large target sets (e.g. a dense map): the grid is decoded once and the target set
+    #is smoothed in chunks such that the (batch_size,n_target,n_grid,D,D) tensors of the smoother stay within a memory budget.
+    def give_target_chunk_size(self,batch_size,memory_budget_MB=256.,n_grid=None):
+        '''
+        Input: batch_size - int
+               memory_budget_MB - float - memory budget of the smoother in MB
+               n_grid - int - number of grid points (None: size of the fixed grid of the encoder)
+        Output: int - number of target points per chunk
+        '''
+        if n_grid is None:
+            n_grid=self.encoder.n_y_axis*self.encoder.n_x_axis
+        #Rough upper bound of the floats per target point: the covariance smoother (D=4) holds about four copies
+        #of the Gram blocks (4x4 per grid point) plus distances:
+        bytes_per_target=4*batch_size*n_grid*(4*4**2+4)
+        return(max(int(memory_budget_MB*1024**2//bytes_per_target),1))
+
+    def predict_chunks(self,handle,X_target,memory_budget_MB=256.,chunk_size=None):
+        '''
+        Inputs: handle - dictionary - output of self.condition
+                X_target: torch.tensor - shape (batch_size,n_target,2)
+                memory_budget_MB - float - memory budget of the smoother (ignored if chunk_size is given)
+                chunk_size - int/None - number of target points per chunk
+        Outputs: generator of (Means_target,Sigmas_target) per chunk of target points - see self.forward
+        '''
+        if chunk_size is None:
+            chunk_size=self.give_target_chunk_size(X_target.size(0),memory_budget_MB,n_grid=handle['Means_grid'].size(1))
+        return(my_utils.chunked_predictions(lambda X_chunk: self.predict(handle,X_chunk),X_target,chunk_size))
+
+    def predict_chunked(self,handle,X_target,memory_budget_MB=256.,chunk_size=None):
+        '''
+        Same as self.predict_chunks but the chunks are concatenated --> Means_target,Sigmas_target - see self.forward
+        '''
+        Means_list,Sigmas_list=zip(*self.predict_chunks(handle,X_target,memory_budget_MB,chunk_size))
+        return(torch.cat(Means_list,dim=1),torch.cat(Sigmas_list,dim=1))
+
+    def forward_chunked(self,X_context,Y_context,X_target,mask_context=None,memory_budget_MB=256.,chunk_size=None):
+        '''
+        Same as self.forward but the target set is processed in chunks (see self.predict_chunks)
+        '''
+        handle=self.condition(X_context,Y_context,mask_context=mask_context,X_target=X_target)
+        return(self.predict_chunked(handle,X_target,memory_budget_MB,chunk_size))
         
     def plot_context_target(self,X_Context,Y_Context,X_Target,Y_Target=None,title=""):
         '''
@@ -173,20 +304,21 @@ class SteerCNP(nn.Module):
         for i in range(X_Context.size(0)):
             my_utils.plot_inference_2d(X_Context[i],Y_Context[i],X_Target[i],Y_Target[i],Predict=Means[i].detach(),Cov_Mat=Covs[i].detach(),title=title)
     
-    def loss(self,Y_Target,Predict,Covs,shape_reg=None):
+    def loss(self,Y_Target,Predict,Covs,shape_reg=None,mask=None):
         '''
             Inputs: Y_Target: torch.tensor - shape (batch_size,n,2) - Target set locations and vectors
                     Predict: torch.tensor - shape (batch_size,n,2) - Predictions of Y_Target at X_Target
                     Covs: torch.tensor - shape (batch_size,n,2,2) - covariance matrices of Y_Target at X_Target
                     shape_reg: float/None - if float gives the weight of the shape_regularizer term (see my_utils.shape_regularizer)
+                    mask: torch.tensor/None - shape (batch_size,n) - 1. for target points, 0. for padding
             Output: -log_ll+shape_reg*shape_diff: log_ll is the log-likelihood at Y_Target given the parameters Predict and Covs
                                                   shape_diff is the "shape difference" (interpreted here as the variance
                                                   of the difference Prdict-Y_Target computed by my_utils.shape_regularizer)
         '''
         log_ll_vec=my_utils.batch_multivar_log_ll(Means=Predict,Covs=Covs,data=Y_Target)
-        log_ll=log_ll_vec.mean()
+        log_ll=my_utils.masked_mean(log_ll_vec,mask)
         if shape_reg is not None: 
-            loss=-log_ll+shape_reg*utils.shape_regularizer(Y_1=Y_Target,Y_2=Predict)
+            loss=-log_ll+shape_reg*my_utils.shape_regularizer(Y_1=Y_Target,Y_2=Predict,mask=mask).mean()
         else: 
             loss=-log_ll
         return(loss,log_ll)
@@ -211,18 +343,25 @@ class SteerCNP(nn.Module):
 
     #Two functions to load the model from a dictionary:
     #1.Create model from dictionary:
-    def create_model_from_dict(dictionary):
+    def create_model_from_dict(dictionary,Decoder=None):
         '''
         Input: dictionary - dict - parameters to load into SteerCNP class (including weights and biases for decoder and encoder)
+               Decoder - nn.Module/None - if given, it is used as decoder instead of creating the decoder from the dictionary
         Output: instance of SteerCNP with parameters as specified in dictionary
         '''
         #Load Encoder:
-        Encoder=EquivEncoder.EquivEncoder(**dictionary['encoder_dict'])
+        Encoder=equiv_encoder.EquivEncoder(**dictionary['encoder_dict'])
         #Load Decoder (depending on type of decoder use different functions):
-        if dictionary['decoder_class']=="SteerDecoder":
+        if Decoder is not None:
+            pass
+        elif dictionary['decoder_class']=="SteerDecoder":
             Decoder=architectures.SteerDecoder.create_model_from_dict(dictionary['decoder_dict'])
         elif dictionary['decoder_class']=="CNNDecoder":
             Decoder=architectures.CNNDecoder.create_model_from_dict(dictionary['decoder_dict'])
+        elif dictionary['decoder_class']=="QuantizedCNNDecoder":
+            Decoder=architectures.QuantizedCNNDecoder.create_model_from_dict(dictionary['decoder_dict'])
+        elif dictionary['decoder_class']=="ExportedSteerDecoder":
+            Decoder=architectures.ExportedSteerDecoder.create_model_from_dict(dictionary['decoder_dict'])
         else:
             sys.exit("Unknown decoder type.")
 
@@ -242,7 +381,9 @@ class SteerCNP(nn.Module):
         Input: filename - string -location of dictionary
         Output: instance of SteerCNP with parameters as specified in dictionary at path "filename"
         '''
-        dictionary=torch.load(f=filename)
-        print(list(dictionary.keys()))
+        dictionary=torch.load(f=filename,map_location=torch.device('cpu'))
+        #Training reports (see training.train_cnp) contain the model dictionary under the key 'CNP_dict':
+        if 'CNP_dict' in dictionary:
+            dictionary=dictionary['CNP_dict']
         return(SteerCNP.create_model_from_dict(dictionary))
 
@@ -9,6 +9,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as utils
 import sys
+import os
+import json
+import hashlib
 from datetime import datetime
 from datetime import timedelta
 
@@ -23,17 +26,30 @@ torch.set_default_dtype(torch.float)
 A data set class to deal with the ERA5 weather data set.
 '''
 class ERA5Dataset(utils.Dataset):
-    def __init__(self, path_to_nc_file,Min_n_cont,Max_n_cont,circular=True, normalize=True,place='US'):
+    def __init__(self, path_to_nc_file,Min_n_cont,Max_n_cont,circular=True, normalize=True,place='US',use_stats=False,
+                 sampling='random',buffer_size=2400,block_size=240,time_window=None):
         '''
         path_to_nc_file - string - gives filepath to a netCDF file which can be loaded as an xarray dataset
                                    having index "datetime","Longitude","Latitude" and the data variables
                                    ['sp_in_kPa','t_in_Cels','wind_10m_east','wind_10m_north']
         Min_n_cont,Max_n_cont,n_total - int - minimum and maximum number of context points and the number of total points per sample
         var_names - list of strings - gives names of variables which are supposed to be in the dataset, if None then all variables are used
+        use_stats - Boolean - if True, the data is normalized with the statistics of the file (see give_stats) 
+                              instead of the constants of the place
+        sampling - string - 'random' or 'buffer' - how get_rand_batch samples maps:
+                        'random': independent random time points (random reads across the file)
+                        'buffer': contiguous blocks of block_size hours are read sequentially (in random order of the blocks 
+                                  with a random offset per pass through the data) into a shuffle buffer of buffer_size maps 
+                                  and every batch is drawn uniformly from the maps in the buffer (see get_buffer_maps)
+        buffer_size,block_size - int - number of maps in the shuffle buffer and of hours per read (sampling='buffer')
+        time_window - int/None - if int k, spatio-temporal mode: the context set is drawn from the maps of the current and 
+                                 the previous k hours with the time offset as an extra scalar channel and the target set is 
+                                 the wind of the current map (see get_temporal_batch)
         '''
         super(ERA5Dataset, self).__init__()
-        #Load the data as an xarray:
-        self.Y_data=xarray.open_dataset(path_to_nc_file).to_array()
+        #Load the data as an xarray (variables packed to int16 with scale_factor/add_offset, see 
+        #pre_processing/compress_data_table_era5.py, are decoded to floats when they are read):
+        self.Y_data=xarray.open_dataset(path_to_nc_file,mask_and_scale=True).to_array()
 
         #Save variables list:
         self.variables=list(self.Y_data.coords['variable'].values)
@@ -59,8 +75,14 @@ class ERA5Dataset(utils.Dataset):
 
         self.variables=list(self.Y_data.coords['variable'].values)
 
-        self.translater=ERA5_translater(place=place)
+        if use_stats:
+            self.translater=ERA5_translater(place=place,stats=give_stats(path_to_nc_file,self.Y_data))
+        else:
+            self.translater=ERA5_translater(place=place)
 
+        self.path_to_nc_file=path_to_nc_file
+        self.place=place
+        self.use_stats=use_stats
         self.Min_n_cont=Min_n_cont
         self.Max_n_cont=Max_n_cont
         self.normalize=normalize
@@ -68,6 +90,18 @@ class ERA5Dataset(utils.Dataset):
 
         if self.circular:
             self.circular_indices=my_utils.get_inner_circle_indices(self.n_per_axis,flat=True)
+
+        self.sampling=sampling
+        if self.sampling=='buffer':
+            self.init_buffer(buffer_size,block_size)
+        elif self.sampling!='random':
+            sys.exit("Unknown sampling mode.")
+
+        self.time_window=time_window
+        if self.time_window is not None:
+            if self.sampling!='random':
+                sys.exit("Error: the spatio-temporal mode reads the hours sequentially and can not be combined with the shuffle buffer.")
+            self.init_time_window()
         
         
         #Control inputs:    
@@ -81,21 +115,19 @@ class ERA5Dataset(utils.Dataset):
         self.print_report()
 
     def compute_normalization(self):
-        #Compute the mean for X:
-        X_mean=self.X_tensor.mean(dim=0)
-
-        #Compute the mean for the various components (not correct for wind components):
-        Y_mean=torch.tensor(self.Y_data.mean(dim=['datetime','Longitude','Latitude']).values,dtype=torch.get_default_dtype())
-
-        #Compute the standard deviation for the data (not correct for wind components!):
-        Y_std=torch.tensor(self.Y_data.std(dim=['datetime','Longitude','Latitude']).values,dtype=torch.get_default_dtype())
+        '''
+        Output: X_mean,Y_mean,Y_std - torch.Tensor - shape (2),(self.n_variables),(self.n_variables) - means and standard deviations
+                (for the wind components, the mean is 0 and the standard deviation is the mean norm of the wind vectors)
+        '''
+        stats=compute_stats(self.Y_data,self.X_tensor)
+        Y_mean=torch.tensor(stats['Y_mean'],dtype=torch.get_default_dtype())
+        Y_std=torch.tensor(stats['Y_std'],dtype=torch.get_default_dtype())
         
         #Correct normalizing for the wind components:
         Y_mean[self.ind_wind_10]=torch.tensor([0.,0.],dtype=torch.get_default_dtype())
-        mean_norm_10m=np.linalg.norm(self.Y_data.loc[:,:,:,['wind_10m_east','wind_10m_north']].values,axis=3).mean()
-        Y_std[self.ind_wind_10]=torch.tensor(mean_norm_10m,dtype=torch.get_default_dtype())
+        Y_std[self.ind_wind_10]=torch.tensor(stats['mean_norm_wind_10m'],dtype=torch.get_default_dtype())
 
-        return(X_mean,Y_mean,Y_std)
+        return(torch.tensor(stats['X_mean'],dtype=torch.get_default_dtype()),Y_mean,Y_std)
 
     def print_report(self):
         print()
@@ -110,6 +142,26 @@ class ERA5Dataset(utils.Dataset):
         print("________________________")
         print()
 
+    def give_data_identifier(self):
+        '''
+        Output: string - identifies the data of the tasks (e.g. for the cache key of evaluation.evaluate): the checksum of the file
+                         (see give_cached_checksum) and the settings of the data set which change the tasks
+        '''
+        settings={'checksum': give_cached_checksum(self.path_to_nc_file),
+                  'place': self.place,
+                  'use_stats': self.use_stats,
+                  'normalize': self.normalize,
+                  'circular': self.circular,
+                  'variables': [str(var) for var in self.variables],
+                  'time_window': self.time_window}
+        return(json.dumps(settings,sort_keys=True))
+
+    def give_n_points_per_sample(self):
+        '''
+        Output: int - number of points (context+target) per map returned by get_batch
+        '''
+        return(self.circular_indices.size(0) if self.circular else self.n_points_per_obs)
+
     def give_index_for_var(self,var_names):
         '''
         Input: var_names - list of strings - names of variables whose index is to return
@@ -117,30 +169,86 @@ class ERA5Dataset(utils.Dataset):
         '''
         return([self.variables.index(name) for name in var_names])
     
+    def rand_rot_mats(self,batch_size):
+        '''
+        Input: batch_size - int
+        Output: torch.Tensor - shape (batch_size,2,2) - independent random rotation matrices
+        '''
+        alpha=2*math.pi*torch.rand(batch_size)
+        cos,sin=torch.cos(alpha),torch.sin(alpha)
+        R=torch.stack([torch.stack([cos,-sin],dim=1),torch.stack([sin,cos],dim=1)],dim=1)
+        return(R.to(torch.get_default_dtype()))
+
     def rand_rot_mat(self):
         '''
         Output: torch.Tensor - shape (2,2) - a random rotation matrix
         '''
-        alpha=2*math.pi*np.random.uniform()
-        R=torch.tensor([[math.cos(alpha),-math.sin(alpha)],[math.sin(alpha),math.cos(alpha)]])
-        return(R)
+        return(self.rand_rot_mats(1)[0])
+
+    def rand_transform_batch(self,X,Y):
+        '''
+        Input: X,Y - torch.Tensor - shape (batch_size,n,2), (batch_size,n,4)
+        Output: X,Y - torch.Tensor - shape (batch_size,n,2), (batch_size,n,4) - every map is rotated by its own random rotation
+        (only the wind components of Y are transformed, the scalar values are invariant)
+        '''
+        #Sample a random rotation matrix per map:
+        R=self.rand_rot_mats(X.size(0))
+        n=X.size(1)
+        X_mean=self.translater.X_mean[None,None,:]
+
+        #Rotate coordinates (around the center of the region) and wind components with one batched matrix multiplication:
+        Rotated=torch.bmm(torch.cat([X-X_mean,Y[:,:,self.ind_wind_10]],dim=1),R.transpose(1,2))
+        X=Rotated[:,:n]+X_mean
+        Y=Y.clone()
+        Y[:,:,self.ind_wind_10]=Rotated[:,n:]
+        return(X,Y)
 
     def rand_transform(self,X,Y):
         '''
         Input: X,Y - torch.Tensor - shape (n,2), (n,4)
         Output: X,Y - torch.Tensor - shape (n,2), (n,4) - randomly rotated X and rotated Y 
-        (only the wind components of Y are transformed, the scalar values )
+        (only the wind components of Y are transformed, the scalar values are invariant)
         '''
-        #Sample a random rotation matrix:
-        R=self.rand_rot_mat()
-        
-        #Rotate coordinates:
-        X=torch.matmul(X-self.X_mean[None,:],R.t())+self.X_mean[None,:]
+        X,Y=self.rand_transform_batch(X.unsqueeze(0),Y.unsqueeze(0))
+        return(X[0],Y[0])
+
+    def read_maps(self,inds):
+        '''
+        Input:  inds - list/np.array of ints or slice - indices of the maps to read
+        Output: torch.Tensor - shape (n_maps,n,self.n_variables) - values of the maps (restricted to the circle if self.circular)
+        '''
+        if not isinstance(inds,slice):
+            inds=np.array(inds).reshape(-1)
+        #Read all maps at once:
+        Y=torch.tensor(self.Y_data[inds].values,dtype=torch.get_default_dtype())
+        Y=Y.view(-1,self.n_points_per_obs,self.n_variables)
+        if self.circular:
+            Y=Y[:,self.circular_indices]
+        return(Y)
 
-        #Rotate wind components:
-        Y[:,self.ind_wind_10]=torch.matmul(Y[:,self.ind_wind_10],R.t())
+    def shuffle_maps(self,Y,transform=False):
+        '''
+        Input:  Y - torch.Tensor - shape (n_maps,n,self.n_variables) - maps (see read_maps)
+                transform - Boolean - indicates whether a random transformation is performed (independently per map)
+        Output: X,Y - torch.Tensor - shape (n_maps,n,2),(n_maps,n,self.n_variables) - every map is shuffled independently
+        '''
+        X=self.X_tensor[self.circular_indices] if self.circular else self.X_tensor
+        #Independent random permutations per map:
+        shuffle_ind=torch.argsort(torch.rand(Y.size(0),X.size(0)),dim=1)
+        X=X[shuffle_ind]
+        Y=torch.gather(Y,1,shuffle_ind.unsqueeze(2).expand(-1,-1,self.n_variables))
+        if transform:
+            X,Y=self.rand_transform_batch(X,Y)
         return(X,Y)
 
+    def get_maps(self,inds,transform=False):
+        '''
+        Input:  inds - list or torch.Tensor of ints - indices to get
+                transform - Boolean - indicates whether a random transformation is performed (independently per map)
+        Output: X,Y - torch.Tensor - shape (len(inds),n,2),(len(inds),n,self.n_variables) - every map is shuffled independently
+        '''
+        return(self.shuffle_maps(self.read_maps(inds),transform=transform))
+
     #This is the basis function returning maps to plotting and purposes which do not include training the pytorch model:
     def get_map(self,ind,transform=False):
         '''
@@ -148,17 +256,8 @@ class ERA5Dataset(utils.Dataset):
                 transform - Boolean - indicates whether a random transformation is performed
         Output: X,Y - torch.Tensor - shape (n,2),(n,self.n_variables)
         '''
-        Y=torch.tensor(self.Y_data[ind].values,dtype=torch.get_default_dtype())
-        Y=Y.view(-1,self.n_variables)
-        if self.circular:
-            X=self.X_tensor[self.circular_indices]
-            Y=Y[self.circular_indices]
-        shuffle_ind=torch.randperm(n=X.size(0))
-        X=X[shuffle_ind]
-        Y=Y[shuffle_ind]
-        if transform:
-            X,Y=self.rand_transform(X,Y)
-        return(X,Y)
+        X,Y=self.get_maps([ind],transform=transform)
+        return(X[0],Y[0])
 
     def get_rand_map(self,transform=False):
         ind=torch.randint(low=0,high=self.n_obs,size=[1]).item()
@@ -166,20 +265,43 @@ class ERA5Dataset(utils.Dataset):
 
     
     #Function which returns random batches for training:
-    def get_batch(self,inds,transform=False,n_context_points=None,cont_in_target=False):
+    def get_batch(self,inds,transform=False,n_context_points=None,cont_in_target=False,variable_context=False):
         '''
         Input: `inds - torch.Tensor of ints - indices to choose batch from
                 transform - Boolean - indicates whether a random transformation is performed
+                n_context_points - int/None - number of context points 
+                                   (if variable_context: torch.Tensor of ints of shape (batch_size) - number per element)
+                variable_context - Boolean - if True, every element of the batch has its own number of context points
+                                             (sets are padded, see my_utils.padded_target_context_splitter)
         Output: X_c,Y_c - torch.Tensor - shape (batch_size,n_context_points,2/self.n_variables)
                 X_t,Y_t - torch.Tensor - shape (batch_size,n_target_points,2/self.n_variables) if cont_in_target is False
                                                (batch_size,n_target_points+n_context_points,2/self.n_variables) if cont_in_target is True
+                if variable_context: additionally Mask_c,Mask_t - torch.Tensor - shape (batch_size,n_context_points/n_target_points)
+
+        In the spatio-temporal mode (self.time_window is not None), every index is moved to the next hour with a complete
+        time window and the batch is given by get_temporal_batch (the target set is the complete current map - if cont_in_target
+        is False, the context points of the current hour are masked out of the target set by Mask_t).
+        '''
+        if self.time_window is not None:
+            pos=np.minimum(np.searchsorted(self.window_inds,np.array(inds).reshape(-1)),len(self.window_inds)-1)
+            return(self.get_temporal_batch(self.get_window_maps(self.window_inds[pos]),transform=transform,n_context_points=n_context_points,
+                                           cont_in_target=cont_in_target,variable_context=variable_context))
+        X,Y=self.get_maps(inds,transform=transform)
+        return(self.split_batch(X,Y,n_context_points=n_context_points,cont_in_target=cont_in_target,variable_context=variable_context))
 
+    def split_batch(self,X,Y,n_context_points=None,cont_in_target=False,variable_context=False):
+        '''
+        Input: X,Y - torch.Tensor - shape (batch_size,n,2),(batch_size,n,self.n_variables) - shuffled maps (see shuffle_maps)
+               n_context_points,cont_in_target,variable_context - see get_batch
+        Output: see get_batch
         '''
-        X_list,Y_list=zip(*[self.get_map(ind=ind,transform=transform) for ind in inds])
-        X=torch.stack(X_list,dim=0)
-        Y=torch.stack(Y_list,dim=0)
         if self.normalize:
             X,Y=self.translater.translate_to_normalized_scale(X,Y)
+        if variable_context:
+            if n_context_points is None:
+                n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[X.size(0)])
+            X_c,Y_c,X_t,Y_t,Mask_c,Mask_t=my_utils.padded_target_context_splitter(X,Y,n_context_points,cont_in_target=cont_in_target)
+            return(X_c,Y_c,X_t,Y_t[:,:,[2,3]],Mask_c,Mask_t)
         if n_context_points is None:
             n_context_points=np.random.randint(low=self.Min_n_cont,high=self.Max_n_cont)    
         if cont_in_target:
@@ -187,14 +309,252 @@ class ERA5Dataset(utils.Dataset):
         else:
             return(X[:,:n_context_points],Y[:,:n_context_points],X[:,n_context_points:],Y[:,n_context_points:,[2,3]])
     
-    def get_rand_batch(self,batch_size,transform=False,n_context_points=None,cont_in_target=False):
+    def init_buffer(self,buffer_size,block_size):
+        '''
+        Input: buffer_size,block_size - int - see __init__
+        '''
+        self.buffer_size=min(buffer_size,self.n_obs)
+        self.block_size=min(block_size,self.buffer_size)
+        if self.block_size<1:
+            sys.exit("Error: the block size has to be positive.")
+        #Maps in the buffer and mask of the slots which hold a map which was not drawn yet:
+        self.buffer_Y=torch.zeros((self.buffer_size,self.give_n_points_per_sample(),self.n_variables))
+        self.buffer_filled=torch.zeros(self.buffer_size,dtype=torch.bool)
+        #Blocks (start,stop) which are not read yet in this pass through the data:
+        self.blocks=[]
+
+    def read_next_block(self):
+        '''
+        Reads the next block of contiguous hours into free slots of the buffer.
+        '''
+        if len(self.blocks)==0:
+            #New pass through the data: random offset of the block boundaries and random order of the blocks:
+            offset=np.random.randint(1,self.block_size+1)
+            bounds=[0]+list(range(offset,self.n_obs,self.block_size))+[self.n_obs]
+            self.blocks=[(bounds[it],bounds[it+1]) for it in torch.randperm(len(bounds)-1).tolist()]
+        start,stop=self.blocks.pop()
+        Y=self.read_maps(slice(start,stop))
+        free_slots=torch.nonzero(~self.buffer_filled).view(-1)[:Y.size(0)]
+        self.buffer_Y[free_slots]=Y
+        self.buffer_filled[free_slots]=True
+
+    def get_buffer_maps(self,batch_size,transform=False):
+        '''
+        Input: batch_size - int - number of maps
+        Output: X,Y - see get_maps - maps drawn uniformly without replacement from the buffer
+        A block is read as soon as there are free slots for all of its hours, so every map stays in the buffer for about 
+        buffer_size/batch_size batches.
+        '''
+        if batch_size>self.buffer_size-self.block_size+1:
+            sys.exit("Error: the buffer size has to be at least batch size+block size-1.")
+        while (self.buffer_size-self.buffer_filled.sum().item())>=self.block_size:
+            self.read_next_block()
+        filled_slots=torch.nonzero(self.buffer_filled).view(-1)
+        slots=filled_slots[torch.randperm(filled_slots.size(0))[:batch_size]]
+        self.buffer_filled[slots]=False
+        return(self.shuffle_maps(self.buffer_Y[slots],transform=transform))
+
+    def init_time_window(self):
+        '''
+        Finds the hours whose time window is complete and initializes the ring buffer of the last self.time_window maps.
+        '''
+        if not isinstance(self.time_window,int) or self.time_window<1:
+            sys.exit("Error: the time window has to be a positive integer.")
+        #Hours t for which the hours t-k,...,t are all in the data (the data set is sorted and concatenates several seasons):
+        datetimes=self.Y_data.coords['datetime'].values
+        span=datetimes[self.time_window:]-datetimes[:-self.time_window]
+        self.window_inds=self.time_window+np.nonzero(span==np.timedelta64(self.time_window,'h'))[0]
+        if len(self.window_inds)==0:
+            sys.exit("Error: there are no complete time windows in the data.")
+        #Ring buffer (indices and maps):
+        self.ring_inds=np.zeros(0,dtype=np.int64)
+        self.ring_Y=torch.zeros((0,self.give_n_points_per_sample(),self.n_variables))
+        self.n_maps_read=0
+
+    def read_maps_cached(self,inds):
+        '''
+        Input:  inds - np.array of ints - sorted indices of maps without duplicates
+        Output: torch.Tensor - see read_maps
+        Only the maps which are not in the ring buffer are read from the file. Afterwards, the ring buffer holds the last 
+        self.time_window maps of inds (the ones which are needed again for the next hours).
+        '''
+        new=np.isin(inds,self.ring_inds,invert=True)
+        Y=torch.zeros((len(inds),self.give_n_points_per_sample(),self.n_variables))
+        if new.any():
+            Y[torch.from_numpy(new)]=self.read_maps(inds[new])
+        if not new.all():
+            Y[torch.from_numpy(~new)]=self.ring_Y[torch.from_numpy(np.searchsorted(self.ring_inds,inds[~new]))]
+        self.n_maps_read+=int(new.sum())
+        self.ring_inds=inds[-self.time_window:]
+        self.ring_Y=Y[-self.time_window:]
+        return(Y)
+
+    def get_window_maps(self,hours,cached=False):
+        '''
+        Input:  hours - np.array of ints - shape (batch_size) - indices of the current hours (elements of self.window_inds)
+                cached - Boolean - if True, the maps are read via the ring buffer (see read_maps_cached)
+        Output: torch.Tensor - shape (batch_size,self.time_window+1,n,self.n_variables) - maps of the hours t,t-1,...,t-k
+        '''
+        window=hours[:,None]-np.arange(self.time_window+1)[None,:]
+        inds=np.unique(window)
+        Y=self.read_maps_cached(inds) if cached else self.read_maps(inds)
+        return(Y[torch.from_numpy(np.searchsorted(inds,window))])
+
+    def get_temporal_batch(self,Y_window,transform=False,n_context_points=None,cont_in_target=False,variable_context=False):
+        '''
+        Input: Y_window - torch.Tensor - shape (batch_size,self.time_window+1,n,self.n_variables) - see get_window_maps
+               transform,n_context_points,cont_in_target,variable_context - see get_batch
+        Output: X_c,Y_c - torch.Tensor - shape (batch_size,n_context_points,2/self.n_variables+1) - context points drawn uniformly
+                          from all points of the maps of the window, the time offset (0 for the current hour, -1 for the previous 
+                          one etc., divided by self.time_window if self.normalize) is inserted before the wind components
+                X_t,Y_t - torch.Tensor - shape (batch_size,n,2/2) - the complete current map (wind components)
+                if variable_context: additionally Mask_c,Mask_t - see get_batch
+                if cont_in_target is False and not variable_context: additionally None,Mask_t
+                Mask_t - torch.Tensor - shape (batch_size,n) - 0. for the points of the current map which are in the context set
+                         (only if cont_in_target is False, otherwise 1. for all points)
+        '''
+        batch_size,n_window,n=Y_window.size(0),Y_window.size(1),Y_window.size(2)
+        X=self.X_tensor[self.circular_indices] if self.circular else self.X_tensor
+        #Number of context points per element:
+        if n_context_points is None:
+            if variable_context:
+                n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[batch_size])
+            else:
+                n_context_points=np.random.randint(low=self.Min_n_cont,high=self.Max_n_cont)
+        N_cont=torch.as_tensor(n_context_points).reshape(-1).expand(batch_size)
+        #Shuffle the points of all maps of the window (offset-major order):
+        shuffle_ind=torch.argsort(torch.rand(batch_size,n_window*n),dim=1)
+        X_c=X.repeat(n_window,1)[shuffle_ind]
+        Y_c=torch.gather(Y_window.reshape(batch_size,n_window*n,self.n_variables),1,shuffle_ind.unsqueeze(2).expand(-1,-1,self.n_variables))
+        Offset_c=-torch.arange(n_window).repeat_interleave(n)[shuffle_ind].to(Y_c.dtype)
+        #Target set: the current map (in the order of the grid points, the context points are shuffled):
+        X_t,Y_t=X.unsqueeze(0).repeat(batch_size,1,1),Y_window[:,0]
+        #Mask out the context points of the current hour (shuffle_ind<n) of the target set:
+        Mask_t=torch.ones((batch_size,n),dtype=Y_c.dtype)
+        if not cont_in_target:
+            In_context=(torch.arange(n_window*n).unsqueeze(0)<N_cont.unsqueeze(1)).to(Y_c.dtype)
+            Mask_t=1-torch.zeros((batch_size,n_window*n),dtype=Y_c.dtype).scatter(1,shuffle_ind,In_context)[:,:n]
+        #The same random transformation for context and target set:
+        if transform:
+            X_all,Y_all=self.rand_transform_batch(torch.cat([X_c,X_t],dim=1),torch.cat([Y_c,Y_t],dim=1))
+            X_c,Y_c,X_t,Y_t=X_all[:,:n_window*n],Y_all[:,:n_window*n],X_all[:,n_window*n:],Y_all[:,n_window*n:]
+        if self.normalize:
+            X_c,Y_c=self.translater.translate_to_normalized_scale(X_c,Y_c)
+            X_t,Y_t=self.translater.translate_to_normalized_scale(X_t,Y_t)
+            Offset_c=Offset_c/self.time_window
+        ind_scalar=[it for it in range(self.n_variables) if it not in self.ind_wind_10]
+        Y_c=torch.cat([Y_c[:,:,ind_scalar],Offset_c.unsqueeze(2),Y_c[:,:,self.ind_wind_10]],dim=2)
+        Y_t=Y_t[:,:,self.ind_wind_10]
+        if variable_context:
+            X_c,Y_c,_,_,Mask_c,_=my_utils.padded_target_context_splitter(X_c,Y_c,N_cont,cont_in_target=True)
+            return(X_c,Y_c,X_t,Y_t,Mask_c,Mask_t)
+        if cont_in_target:
+            return(X_c[:,:n_context_points],Y_c[:,:n_context_points],X_t,Y_t)
+        return(X_c[:,:n_context_points],Y_c[:,:n_context_points],X_t,Y_t,None,Mask_t)
+
+    def get_rand_batch(self,batch_size,transform=False,n_context_points=None,cont_in_target=False,variable_context=False):
         '''
         Returns self.get_batch with random number of indices with length=batch_size and random number of context points
         in range [self.Min_n_cont,high=self.Max_n_cont]
         If n_context_points is None, it is randomly sampled.
+        If self.sampling is 'buffer', the maps are drawn from the shuffle buffer (see get_buffer_maps).
+        In the spatio-temporal mode, the batch consists of batch_size consecutive hours with complete time window starting at
+        a new random hour for every batch (such that the batches are not in time order), the overlapping time windows of the 
+        batch are read once.
         '''
+        if self.time_window is not None:
+            start=np.random.randint(len(self.window_inds))
+            hours=self.window_inds[(start+np.arange(batch_size))%len(self.window_inds)]
+            return(self.get_temporal_batch(self.get_window_maps(hours,cached=True),transform=transform,n_context_points=n_context_points,
+                                           cont_in_target=cont_in_target,variable_context=variable_context))
+        if self.sampling=='buffer':
+            X,Y=self.get_buffer_maps(batch_size,transform=transform)
+            return(self.split_batch(X,Y,n_context_points=n_context_points,cont_in_target=cont_in_target,variable_context=variable_context))
         inds=torch.randperm(self.n_obs)[:batch_size]
-        return(self.get_batch(inds=inds,transform=transform,n_context_points=n_context_points,cont_in_target=cont_in_target))
+        return(self.get_batch(inds=inds,transform=transform,n_context_points=n_context_points,cont_in_target=cont_in_target,
+                              variable_context=variable_context))
+
+#Statistics of the data in one pass over chunks of time steps (Welford/Chan update of mean and sum of squared deviations):
+def compute_stats(Y_data,X_tensor,n_times_per_chunk=500):
+    '''
+    Input: Y_data - xarray.DataArray - dimensions ("datetime","Longitude","Latitude","variable")
+           X_tensor - torch.Tensor - shape (n,2) - coordinates of the grid points
+           n_times_per_chunk - int - number of time steps read at once
+    Output: dictionary - 'variables','Y_mean','Y_std' (per variable, std with ddof=0),'mean_norm_wind_10m','X_mean','n'
+    '''
+    variables=list(Y_data.coords['variable'].values)
+    ind_wind=[variables.index('wind_10m_east'),variables.index('wind_10m_north')]
+    n=0
+    mean=np.zeros(len(variables))
+    M2=np.zeros(len(variables))
+    sum_norm_wind=0.
+    for begin in range(0,Y_data.shape[0],n_times_per_chunk):
+        values=Y_data[begin:begin+n_times_per_chunk].values.reshape(-1,len(variables)).astype(np.float64)
+        n_chunk=values.shape[0]
+        mean_chunk=values.mean(axis=0)
+        M2_chunk=((values-mean_chunk[None,:])**2).sum(axis=0)
+        #Combine the statistics of the chunk with the previous ones:
+        delta=mean_chunk-mean
+        mean=mean+delta*n_chunk/(n+n_chunk)
+        M2=M2+M2_chunk+delta**2*n*n_chunk/(n+n_chunk)
+        n+=n_chunk
+        sum_norm_wind+=np.linalg.norm(values[:,ind_wind],axis=1).sum()
+    return({'variables': variables,
+            'Y_mean': mean.tolist(),
+            'Y_std': np.sqrt(M2/n).tolist(),
+            'mean_norm_wind_10m': float(sum_norm_wind/n),
+            'X_mean': X_tensor.mean(dim=0).tolist(),
+            'n': n})
+
+#Checksum of a file:
+def give_file_checksum(filename,block_size=2**20):
+    hash_value=hashlib.sha1()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            hash_value.update(block)
+    return(hash_value.hexdigest())
+
+#Checksum of a file (taken from the cache of give_stats if size and modification time of the file did not change):
+def give_cached_checksum(path_to_nc_file):
+    cache_file=path_to_nc_file+'.stats.json'
+    if os.path.isfile(cache_file):
+        with open(cache_file,'r') as f:
+            cache=json.load(f)
+        if cache['file_info']==[os.path.getsize(path_to_nc_file),os.path.getmtime(path_to_nc_file)]:
+            return(cache['checksum'])
+    return(give_file_checksum(path_to_nc_file))
+
+#Statistics of a data set file cached next to the file (<file>.stats.json):
+def give_stats(path_to_nc_file,Y_data=None):
+    '''
+    Input: path_to_nc_file - string - netCDF file (see ERA5Dataset)
+           Y_data - xarray.DataArray - the data of the file (if None, it is loaded)
+    Output: dictionary - see compute_stats
+    The cache is keyed by the checksum of the file. The checksum itself is only recomputed if size or modification time of the file changed.
+    '''
+    cache_file=path_to_nc_file+'.stats.json'
+    file_info=[os.path.getsize(path_to_nc_file),os.path.getmtime(path_to_nc_file)]
+    cache=None
+    if os.path.isfile(cache_file):
+        with open(cache_file,'r') as f:
+            cache=json.load(f)
+    if cache is not None and cache['file_info']==file_info:
+        return(cache['stats'])
+    checksum=give_file_checksum(path_to_nc_file)
+    if cache is not None and cache['checksum']==checksum:
+        stats=cache['stats']
+    else:
+        if Y_data is None:
+            Y_data=xarray.open_dataset(path_to_nc_file,mask_and_scale=True).to_array().transpose("datetime","Longitude","Latitude","variable")
+        Longitude=torch.tensor(Y_data.coords['Longitude'].values,dtype=torch.get_default_dtype())
+        Latitude=torch.tensor(Y_data.coords['Latitude'].values,dtype=torch.get_default_dtype())
+        X_tensor=torch.stack([Longitude.repeat_interleave(Latitude.size(0)),Latitude.repeat(Longitude.size(0))],dim=1)
+        stats=compute_stats(Y_data,X_tensor)
+    #Save to the cache (atomically):
+    with open(cache_file+'.tmp','w') as f:
+        json.dump({'checksum': checksum,'file_info': file_info,'stats': stats},f,indent=1)
+    os.replace(cache_file+'.tmp',cache_file)
+    return(stats)
 
 '''
 We write a class which get an input X,Y and translates it normalized values
@@ -205,8 +565,16 @@ By normalized, we mean here:
     are only rescaled)
 '''
 class ERA5_translater(object):
-    def __init__(self, place='US'):
+    def __init__(self, place='US',stats=None):
+        '''
+        place - string - 'US' or 'China' - region whose constants are used
+        stats - dictionary - statistics of a data set (see compute_stats) which are used instead of the constants of the place
+                             (e.g. for new regions)
+        '''
         self.place=place
+        if stats is not None:
+            self.set_stats(stats)
+            return
         if self.place=='US':
             self.X_mean=torch.tensor([-91.,35.],dtype=torch.get_default_dtype())
         elif self.place=='China':
@@ -219,6 +587,19 @@ class ERA5_translater(object):
         self.Y_mean_out=torch.tensor([0.0000,   0.0000],dtype=torch.get_default_dtype())
         self.Y_std_out=torch.tensor([3.4162, 3.4162],dtype=torch.get_default_dtype())
         
+    def set_stats(self,stats):
+        '''
+        stats - dictionary - see compute_stats
+        '''
+        Y_mean=[stats['Y_mean'][stats['variables'].index(name)] for name in ['sp_in_kPa','t_in_Cels']]
+        Y_std=[stats['Y_std'][stats['variables'].index(name)] for name in ['sp_in_kPa','t_in_Cels']]
+        norm_wind=stats['mean_norm_wind_10m']
+        self.X_mean=torch.tensor(stats['X_mean'],dtype=torch.get_default_dtype())
+        self.Y_mean=torch.tensor(Y_mean+[0.,0.],dtype=torch.get_default_dtype())
+        self.Y_std=torch.tensor(Y_std+[norm_wind,norm_wind],dtype=torch.get_default_dtype())
+        self.Y_mean_out=torch.tensor([0.,0.],dtype=torch.get_default_dtype())
+        self.Y_std_out=torch.tensor([norm_wind,norm_wind],dtype=torch.get_default_dtype())
+
     def norm_X(self,X):
         '''
         X - torch.Tensor - shape (*,2)
@@ -254,6 +635,13 @@ class ERA5_translater(object):
         '''
         return(Y.mul(self.Y_std_out[None,:]).add(self.Y_mean_out[None,:]))
     
+    def denorm_Cov_out(self,Covs):
+        '''
+        Covs - torch.Tensor - shape (*,2,2) - covariance matrices of predictions on the normalized scale
+        --> returns covariance matrices on the original scale
+        '''
+        return(Covs.mul(self.Y_std_out[:,None]*self.Y_std_out[None,:]))
+
     def translate_to_normalized_scale(self,X,Y):
         '''
         X - torch.Tensor - shape (*,2)
@@ -1,62 +1,66 @@
 import sys
+import numpy as np
 import pandas as pd
 
-#The short names of the variables which we want to use:
+#The short names of the variables which we want to use (default):
 SHORTNAMES=["sp","2t","10u","10v"]
 
+#Columns which identify one measurement of all variables:
+KEY_COLUMNS=["Latitude","Longitude","dataDate","dataTime","validityDate","validityTime"]
 
-#The arguments give the old and the new filename of the data frame:
-filename_old=sys.argv[1]
-filename_new=sys.argv[2]
-
-#Read file to data frame:
-data=pd.read_csv(filename_old,delimiter=",")
-
-#Permute columns such that shortname is at last:
-cols=data.columns.to_list()
-cols_perm=cols[:2]+cols[3:]+[cols[2]]
-data=data[cols_perm]
-
-
-#Get a list of data frames per variable--------------------
-data_list_single_var=[]
-for var in SHORTNAMES:
-    #Extract data for certain variable and reset index:
-    data_single_var=data[data.shortName==var].reset_index(drop=True)
-    #Rename the "value" column to the name of the variable:
-    data_single_var.rename(columns={'Value': var },inplace=True)
-    #Drop the short name:
-    data_single_var.drop(columns=["shortName"],inplace=True) 
-    #Append to the list:
-    data_list_single_var.append(data_single_var)
-#----------------------------------------------------------
-
-#Merge data from different variables-----------------------
-merged_data=data_list_single_var[0]
-for i in range(1,len(SHORTNAMES)):
-    merged_data=pd.merge(merged_data,data_list_single_var[i])
-#----------------------------------------------------------
-
-#Control that merged data has the correct number of rows-----
-n_rows_merged_data=len(merged_data.index)
-n_rows_data=len(data.index)
-n_control=int(n_rows_data/7)
-
-if n_control!=n_rows_merged_data:
-    print(n_control)
-    print(n_rows_merged_data)
-    print("Filename old: ", filename_old)
-    sys.exit("Error when processing data: Numbers of rows of unprocessed and processed do not fit.")
-#------------------------------------------------------------
-
-
-#Save the file:
-merged_data.to_csv(filename_new,index=False)
-
-#Control with reloaded data---------------------------------
-reloaded_data=pd.read_csv(filename_new,delimiter=",")
-EPS=1e-5
-diff_sum=(merged_data-reloaded_data).abs().sum().sum()
-if diff_sum>1e-4:
-    sys.exit("Error when reloading file: it seems that the sum of differences is fairly large.")
-#-----------------------------------------------------------
\ No newline at end of file
+#Reshape the data table from "one row per measurement" to "one row per time point and grid point":
+def build_data_table(data,shortnames=SHORTNAMES):
+    '''
+    Input: data - pd.DataFrame - columns KEY_COLUMNS, 'Value' and 'shortName' (one row per measurement)
+           shortnames - list of strings - variables to use (e.g. also "100u","100v","z"), other variables are dropped
+    Output: pd.DataFrame - columns KEY_COLUMNS+shortnames
+    '''
+    #Index of the variable per row (rows of other variables are dropped):
+    var_index=data.shortName.map({name: it for it,name in enumerate(shortnames)}).values
+    keep=~np.isnan(var_index)
+    var_index=var_index[keep].astype(np.int64)
+    keys=[data[col].values[keep] for col in KEY_COLUMNS]
+    values=data.Value.values[keep]
+    n_vars=len(shortnames)
+
+    if len(values)%n_vars!=0:
+        sys.exit("Error when processing data: number of measurements is not a multiple of the number of variables.")
+
+    #One sort by (time,grid point,variable), after which every block of n_vars rows is one row of the new table
+    #(np.lexsort sorts by the last key first: date and time, then Latitude and Longitude, then the variable):
+    order=np.lexsort([var_index]+keys[:2][::-1]+keys[2:][::-1])
+    var_index=var_index[order].reshape(-1,n_vars)
+    keys=[key[order].reshape(-1,n_vars) for key in keys]
+    values=values[order].reshape(-1,n_vars)
+
+    #Integrity check (O(n)): every block contains every variable once and has the same time and grid point:
+    if (var_index!=np.arange(n_vars)[None,:]).any():
+        sys.exit("Error when processing data: some variables are missing or duplicated for some time and grid points.")
+    if any((key!=key[:,:1]).any() for key in keys):
+        sys.exit("Error when processing data: time and grid points do not match between variables.")
+
+    merged_data=pd.DataFrame({col: key[:,0] for col,key in zip(KEY_COLUMNS,keys)})
+    for it,name in enumerate(shortnames):
+        merged_data[name]=values[:,it]
+    return(merged_data)
+
+if __name__=='__main__':
+    #The arguments give the old and the new filename of the data frame (and optionally comma-separated short names):
+    filename_old=sys.argv[1]
+    filename_new=sys.argv[2]
+    shortnames=sys.argv[3].split(",") if len(sys.argv)>3 else SHORTNAMES
+
+    #Read file to data frame:
+    data=pd.read_csv(filename_old,delimiter=",")
+
+    merged_data=build_data_table(data,shortnames)
+
+    #Control that every value was used exactly once (sums per variable):
+    sums_old=data.groupby("shortName").Value.sum()
+    for name in shortnames:
+        if not np.isclose(sums_old[name],merged_data[name].sum()):
+            print("Filename old: ", filename_old)
+            sys.exit("Error when processing data: values of "+name+" do not fit.")
+
+    #Save the file:
+    merged_data.to_csv(filename_new,index=False)
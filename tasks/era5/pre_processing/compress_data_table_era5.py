@@ -1,119 +1,180 @@
 import sys
+import os
 import pandas as pd
 import numpy as np
 
-filename_old=sys.argv[1]
-filename_new=sys.argv[2]
+'''
+Compresses the data table of one year (see build_data_table_era5.py) to a pickle file.
+The encoding of every column is chosen from a declared precision budget (instead of the smallest float type whose range fits):
+    'int16'    - scale/offset packing (like scale_factor/add_offset in netCDF): value=scale*packed+offset,
+                 scale=max_error such that the rounding error is at most max_error/2 on the declared range
+                 (the other half of the budget is left for decoding to float32)
+    'category' - dictionary encoding (lossless) for columns with few repeated values (Latitude, Longitude)
+    'float32'  - for all other numeric columns
+The packed columns are decoded by decode (merge_years_to_single_file_era5.py) and stored packed in the netCDF files
+(see give_netcdf_encoding), which xarray (and so ERA5Dataset) decodes on load.
+'''
+
+#Precision budget per column: maximal absolute error and range of the values in the units of the data set:
+PRECISION_BUDGET={'sp_in_kPa': {'encoding': 'int16','max_error': 1e-3,'range': [45.,110.]},
+                  't_in_Cels': {'encoding': 'int16','max_error': 5e-3,'range': [-80.,60.]},
+                  'wind_10m_east': {'encoding': 'int16','max_error': 2e-3,'range': [-60.,60.]},
+                  'wind_10m_north': {'encoding': 'int16','max_error': 2e-3,'range': [-60.,60.]},
+                  'Latitude': {'encoding': 'category'},
+                  'Longitude': {'encoding': 'category'}}
+INT16_MAX=np.iinfo(np.int16).max
+FILL_VALUE=np.iinfo(np.int16).min
+
+def give_encoding(col,budget=PRECISION_BUDGET):
+    '''
+    Output: string - 'int16','category' or 'float32' (columns without budget)
+    '''
+    return(budget[col]['encoding'] if col in budget else 'float32')
+
+def give_packing(col,budget=PRECISION_BUDGET):
+    '''
+    Output: scale,offset - float - parameters of the int16 packing of the column
+    '''
+    min_value,max_value=budget[col]['range']
+    scale=budget[col]['max_error']
+    offset=(min_value+max_value)/2
+    if (max_value-min_value)/2/scale>INT16_MAX:
+        sys.exit("Error: the range of "+col+" can not be packed to int16 with the maximal error of the precision budget.")
+    return(scale,offset)
+
+def give_netcdf_encoding(columns,budget=PRECISION_BUDGET):
+    '''
+    Output: dictionary - encoding for xarray.Dataset.to_netcdf of the int16-packed columns
+    '''
+    encoding={}
+    for col in columns:
+        if give_encoding(col,budget)=='int16':
+            scale,offset=give_packing(col,budget)
+            encoding[col]={'dtype': 'int16','scale_factor': np.float32(scale),'add_offset': np.float32(offset),'_FillValue': FILL_VALUE}
+    return(encoding)
+
+def compress(df,budget=PRECISION_BUDGET,verbose=True):
+    '''
+    Input: df - pd.DataFrame - numeric columns (and datetime)
+    Output: pd.DataFrame - encoded columns (see above)
+    '''
+    start_mem=df.memory_usage().sum()/1024**2
+    df=df.copy()
+    for col in df.columns:
+        if not np.issubdtype(df[col].dtype,np.number):
+            continue
+        encoding=give_encoding(col,budget)
+        if encoding=='int16':
+            scale,offset=give_packing(col,budget)
+            min_value,max_value=budget[col]['range']
+            if df[col].min()<min_value or df[col].max()>max_value:
+                sys.exit("Error: values of "+col+" are outside of the range of the precision budget.")
+            df[col]=np.round((df[col].values-offset)/scale).astype(np.int16)
+        elif encoding=='category':
+            df[col]=df[col].astype('category')
+        else:
+            df[col]=df[col].astype(np.float32)
+    end_mem=df.memory_usage().sum()/1024**2
+    if verbose: print('Mem. usage decreased to {:5.2f} Mb ({:.1f}% reduction, ratio {:.2f})'.format(end_mem,100*(start_mem-end_mem)/start_mem,start_mem/end_mem))
+    return df
 
-def compress(df, verbose=True):
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    start_mem = df.memory_usage().sum() / 1024**2    
+def decode(df,budget=PRECISION_BUDGET):
+    '''
+    Input: df - pd.DataFrame - compressed by compress
+    Output: pd.DataFrame - numeric columns as float32 (datetime unchanged)
+    '''
+    df=df.copy()
     for col in df.columns:
-        col_type = df[col].dtypes
-        if col_type in numerics:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if str(col_type)[:3] == 'int':
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)  
-            else:
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)
-    end_mem = df.memory_usage().sum() / 1024**2
-    if verbose: print('Mem. usage decreased to {:5.2f} Mb ({:.1f}% reduction)'.format(end_mem, 100 * (start_mem - end_mem) / start_mem))
+        if df[col].dtype==np.int16 and give_encoding(col,budget)=='int16':
+            scale,offset=give_packing(col,budget)
+            df[col]=(df[col].values*scale+offset).astype(np.float32)
+        elif df[col].dtype.name=='category':
+            df[col]=df[col].astype(np.float32)
     return df
 
-data=pd.read_csv(filename_old,delimiter=",")
-
-#Remove the dataTime and dataDate column if they are redundant:
-#1.Control whether they are redundant and through error if they are not:
-valid_time=data.validityTime.to_numpy(dtype=np.int32)
-valid_date=data.validityDate.to_numpy(dtype=np.int32)
-data_time=data.dataTime.to_numpy(dtype=np.int32)
-data_date=data.dataDate.to_numpy(dtype=np.int32)
-n_inequal=np.sum(np.logical_or(valid_time!=data_time,valid_date!=data_date))
-if n_inequal>0:
-    print("Filename: ", filename)
-    sys.exit("Error: n_inequal is not zero.")
-
-#2.Remove:
-data.drop(columns=["dataDate"],inplace=True) 
-data.drop(columns=["dataTime"],inplace=True) 
-data.rename(columns={'validityDate': "Date", 'validityTime': "Time"},inplace=True)
-
-
-#----------TIME COLUMN------------------------
-#Format time column to 4-element string:
-data['Time']=data['Time'].apply(lambda x: '{0:0>4}'.format(x)).astype(str)
-#Format date column to string:
-data['Date']=data['Date'].astype(str)
-#Insert datetime column:
-data.insert(0,"datetime",pd.to_datetime(data['Date']+data['Time'], format='%Y%m%d%H%M'))
-#Drop time and data:
-data.drop(columns=['Time','Date'],inplace=True)
-#---------------------------------------------
-
-#-----------SORT BY TIME---------------------
-#Order via datetime:
-data=data.sort_values("datetime").reset_index(drop=True)
-
-#Control whether the number of data points per time is equal:
-n_total_grid_points_control=data.groupby("datetime").count()['Latitude'][0]
-
-any_inequal=(data.groupby("datetime").count()!=n_total_grid_points_control).any().any()
-if any_inequal:
-    sys.exit("ERROR: The number of points per time is not equal.")
-#---------------------------------------------
-
-#----------FORMAT VARIABLES-----------------------
-#Get temperature in Celsius:
-data[["2t"]]=data[["2t"]]-273.15
-data.rename(columns={'2t': "t_in_Cels" },inplace=True)
-
-#Get pressure in kPa:
-data.sp=data.sp/1000
-data.rename(columns={'sp': "sp_in_kPa" },inplace=True)
-
-#Rename the wind components:
-data.rename(columns={'10u': 'wind_10m_north', 
-                    '10v':'wind_10m_east'},inplace=True)
-#------------------------------------------------------------
-
-
-#Compress by choosing right file format:
-data=compress(data)
-
-#Save to pickle:                  
-data.to_pickle(filename_new)
-
-#Reload data for control:
-reloaded_data=pd.read_pickle(filename_new)
-
-#Save:
-orig_datetime=data.datetime
-rel_datetime=reloaded_data.datetime
-
-#drop time:
-data.drop(columns=['datetime'],inplace=True)
-reloaded_data.drop(columns=['datetime'],inplace=True)
-
-#Control whether reloading changes anything:
-EPS=1e-5
-diff_sum_numeric=(data-reloaded_data).abs().sum().sum()
-time_change=(orig_datetime!=rel_datetime).any()
-
-if diff_sum_numeric>EPS or time_change:
-    sys.exit("Error when reloading file: it seems that the sum of differences is fairly large.")
-else:
-    print("Compressed data - sample:")
-    print(data.sample(10))
+def give_max_errors(df,df_decoded):
+    '''
+    Output: dictionary - maximal absolute error per numeric column
+    '''
+    return({col: float(np.abs(df[col].values.astype(np.float64)-df_decoded[col].values.astype(np.float64)).max())
+            for col in df.columns if np.issubdtype(df[col].dtype,np.number)})
+
+if __name__=='__main__':
+    filename_old=sys.argv[1]
+    filename_new=sys.argv[2]
+
+    data=pd.read_csv(filename_old,delimiter=",")
+
+    #Remove the dataTime and dataDate column if they are redundant:
+    #1.Control whether they are redundant and through error if they are not:
+    valid_time=data.validityTime.to_numpy(dtype=np.int32)
+    valid_date=data.validityDate.to_numpy(dtype=np.int32)
+    data_time=data.dataTime.to_numpy(dtype=np.int32)
+    data_date=data.dataDate.to_numpy(dtype=np.int32)
+    n_inequal=np.sum(np.logical_or(valid_time!=data_time,valid_date!=data_date))
+    if n_inequal>0:
+        print("Filename: ", filename_old)
+        sys.exit("Error: n_inequal is not zero.")
+
+    #2.Remove:
+    data.drop(columns=["dataDate"],inplace=True)
+    data.drop(columns=["dataTime"],inplace=True)
+    data.rename(columns={'validityDate': "Date", 'validityTime': "Time"},inplace=True)
+
+
+    #----------TIME COLUMN------------------------
+    #Format time column to 4-element string:
+    data['Time']=data['Time'].apply(lambda x: '{0:0>4}'.format(x)).astype(str)
+    #Format date column to string:
+    data['Date']=data['Date'].astype(str)
+    #Insert datetime column:
+    data.insert(0,"datetime",pd.to_datetime(data['Date']+data['Time'], format='%Y%m%d%H%M'))
+    #Drop time and data:
+    data.drop(columns=['Time','Date'],inplace=True)
+    #---------------------------------------------
+
+    #-----------SORT BY TIME---------------------
+    #Order via datetime:
+    data=data.sort_values("datetime").reset_index(drop=True)
+
+    #Control whether the number of data points per time is equal:
+    n_total_grid_points_control=data.groupby("datetime").count()['Latitude'][0]
+
+    any_inequal=(data.groupby("datetime").count()!=n_total_grid_points_control).any().any()
+    if any_inequal:
+        sys.exit("ERROR: The number of points per time is not equal.")
+    #---------------------------------------------
+
+    #----------FORMAT VARIABLES-----------------------
+    #Get temperature in Celsius:
+    data[["2t"]]=data[["2t"]]-273.15
+    data.rename(columns={'2t': "t_in_Cels" },inplace=True)
+
+    #Get pressure in kPa:
+    data.sp=data.sp/1000
+    data.rename(columns={'sp': "sp_in_kPa" },inplace=True)
+
+    #Rename the wind components:
+    data.rename(columns={'10u': 'wind_10m_north',
+                        '10v':'wind_10m_east'},inplace=True)
+    #------------------------------------------------------------
+
+
+    #Compress with the encodings of the precision budget:
+    compressed_data=compress(data)
+
+    #Save to pickle:
+    compressed_data.to_pickle(filename_new)
+
+    #Reload and decode data for control:
+    reloaded_data=decode(pd.read_pickle(filename_new))
+
+    #Control the maximal error per column:
+    max_errors=give_max_errors(data,reloaded_data)
+    for col,max_error in max_errors.items():
+        print("%-16s | encoding: %-8s | maximal error: %.2e"%(col,give_encoding(col),max_error))
+    exceeded=[col for col,max_error in max_errors.items() if max_error>PRECISION_BUDGET.get(col,{}).get('max_error',1e-4*max(np.abs(data[col]).max(),1.))]
+    time_change=(data.datetime!=reloaded_data.datetime).any()
+    if len(exceeded)>0 or time_change:
+        sys.exit("Error when reloading file: the maximal error exceeds the precision budget for "+", ".join(exceeded))
+    print("Compression ratio (csv/pickle): %.2f"%(os.path.getsize(filename_old)/os.path.getsize(filename_new)))
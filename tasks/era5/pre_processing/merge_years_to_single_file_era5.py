@@ -2,11 +2,17 @@ import pandas as pd
 import sys
 import numpy as np
 import xarray
-import datetime 
+import datetime
 
-location=sys.argv[1]
-filename_without_year=sys.argv[2]
-filename_merged=sys.argv[3]
+import compress_data_table_era5 as compression
+
+'''
+Merges the pickle files of single years (see compress_data_table_era5.py) to netCDF files of the training, validation
+and test years: Train_<filename_merged>.nc, Valid_<filename_merged>.nc and Test_<filename_merged>.nc.
+Usage: python merge_years_to_single_file_era5.py <location> <filename_without_year> <filename_merged> [train/valid/test]
+(without the last argument, all three splits are merged).
+The variables are packed to int16 with the precision budget of compress_data_table_era5.py (decoded by xarray on load).
+'''
 
 YEARS_TRAIN=[]
 YEARS_VALID=[]
@@ -16,15 +22,20 @@ for i in range(1986,2018,4):
     YEARS_VALID.append(i+2)
     YEARS_TEST.append(i+3)
 
-def merge_df(YEARS_LIST,filename_merged_complete):
+#Years and prefix of the file per split:
+SPLITS={'train': (YEARS_TRAIN,"Train_"),
+        'valid': (YEARS_VALID,"Valid_"),
+        'test': (YEARS_TEST,"Test_")}
+
+def merge_df(location,filename_without_year,YEARS_LIST,filename_merged_complete):
     df_list=[]
     for year in YEARS_LIST:
         #Get filename:
         filename=location+str(year)+filename_without_year
         print("Get file: ", filename)
-        #Read data from pickle file:
-        new_data=pd.read_pickle(filename)
-        
+        #Read data from pickle file and decode the compressed columns:
+        new_data=compression.decode(pd.read_pickle(filename))
+
         df_list.append(new_data)
 
     print("Start concatenating:")
@@ -38,7 +49,7 @@ def merge_df(YEARS_LIST,filename_merged_complete):
     print("Finished swap columns.")
     print("Start sort:")
     df.sort_values(by=['datetime','Longitude','Latitude'], axis=0, inplace=True)
-    df.set_index(keys=['datetime','Longitude','Latitude'], drop=True,inplace=True) 
+    df.set_index(keys=['datetime','Longitude','Latitude'], drop=True,inplace=True)
     print("Finished sort.")
     print("Convert to xarray:")
     X=df.to_xarray()
@@ -46,12 +57,18 @@ def merge_df(YEARS_LIST,filename_merged_complete):
     X=X.astype(np.float32,casting='same_kind')
     print("Finished cast to dtype.")
 
-    #Save the file:
+    #Save the file (packed with the precision budget):
     print("Convert to netCDF:")
-    X.to_netcdf(location+filename_merged_complete+".nc")
+    X.to_netcdf(location+filename_merged_complete+".nc",encoding=compression.give_netcdf_encoding(list(X.data_vars)))
+
+if __name__=='__main__':
+    location=sys.argv[1]
+    filename_without_year=sys.argv[2]
+    filename_merged=sys.argv[3]
+    splits=[sys.argv[4]] if len(sys.argv)>4 else ['train','valid','test']
 
-merge_df(YEARS_TRAIN,"Test_"+filename_merged)
-#merge_df(YEARS_VALID,"Valid_"+filename_merged)
-#merge_df(YEARS_TEST,"Test_"+filename_merged)
+    for split in splits:
+        YEARS_LIST,prefix=SPLITS[split]
+        merge_df(location,filename_without_year,YEARS_LIST,prefix+filename_merged)
 
-print("Process finished.")
+    print("Process finished.")
@@ -0,0 +1,235 @@
+#LIBRARIES:
+#Tools:
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+import argparse
+
+#Own files:
+from merge_years_to_single_file_era5 import SPLITS
+
+'''
+-------------------------------------------------------------------------
+--------------------------PREPROCESSING TASK RUNNER----------------------
+-------------------------------------------------------------------------
+Runs the preprocessing of all years (see preprocessing_era5_us.sh) in parallel and merges the years afterwards:
+    per year (in parallel):   <year><suffix>.grib --grib_get_data--> _unformatted.csv --build_value_table--> _per_measurement.csv
+                              --build_data_table--> _per_time.csv --compress_data_table--> .pickle
+    per split (in parallel):  pickles of the years of the split --merge_years--> Train_/Valid_/Test_<merged>.nc
+Years are discovered from the files in the data folder. Like a Makefile, a stage is skipped if its output is up to date.
+The output of a stage is up to date if it has a stamp (<output>.stamp) which was written with the same command (and script)
+and every input is older than the stamp or has the content hash recorded in the stamp (touching a file does not trigger a rerun).
+Inputs which do not exist anymore are ignored and intermediate files removed with -clean are only recreated if a later
+stage has to run.
+'''
+PATH=os.path.dirname(os.path.abspath(__file__))
+
+#Hash of the content of a file:
+def give_file_hash(filename,block_size=2**20):
+    hash_value=hashlib.sha1()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            hash_value.update(block)
+    return(hash_value.hexdigest())
+
+#Hash of a command (including the content of the script it runs):
+def give_command_hash(command):
+    scripts=[part for part in command if part.endswith('.py') and os.path.isfile(part)]
+    return(hashlib.sha1((json.dumps(command)+''.join(give_file_hash(script) for script in scripts)).encode()).hexdigest())
+
+def create_stage(name,inputs,output,command,stdout=None):
+    '''
+    Input: name - string - name of the stage
+           inputs - list of strings - input files
+           output - string - output file
+           command - list of strings - command to run (via subprocess)
+           stdout - string - file the standard output of the command is written to (None: printed)
+    Output: dictionary
+    '''
+    return({'name': name,'inputs': inputs,'output': output,'command': command,'stdout': stdout})
+
+def is_up_to_date(stage,allow_missing_output=False):
+    '''
+    Input: stage - dictionary (see create_stage)
+           allow_missing_output - Boolean - if True, a removed output is up to date if its stamp is (intermediate files)
+    Output: Boolean - True if the output of the stage is up to date (see above)
+    '''
+    stamp_file=stage['output']+'.stamp'
+    if not os.path.isfile(stamp_file) or (not allow_missing_output and not os.path.isfile(stage['output'])):
+        return(False)
+    with open(stamp_file,'r') as f:
+        stamp=json.load(f)
+    if stamp['command_hash']!=give_command_hash(stage['command']):
+        return(False)
+    stamp_time=os.path.getmtime(stamp_file)
+    for filename in stage['inputs']:
+        if not os.path.isfile(filename) or os.path.getmtime(filename)<=stamp_time:
+            continue
+        #Only hash if the modification time indicates a change:
+        if stamp['input_hashes'].get(filename)!=give_file_hash(filename):
+            return(False)
+    return(True)
+
+def give_needed_stages(stages):
+    '''
+    Input: stages - list of dictionaries - a chain of stages (every stage depends on the previous one)
+    Output: list of Booleans - True if the stage has to run
+    A stage has to run if it is not up to date, if the previous stage runs or if the next stage runs and its output was removed.
+    '''
+    needed=[False]*len(stages)
+    changed=True
+    while changed:
+        changed=False
+        for it,stage in enumerate(stages):
+            if needed[it]:
+                continue
+            allow_missing_output=it+1<len(stages) and not needed[it+1]
+            if (it>0 and needed[it-1]) or not is_up_to_date(stage,allow_missing_output):
+                needed[it]=True
+                changed=True
+    return(needed)
+
+def run_stage(stage):
+    '''
+    Output: dictionary - 'name','output','status' ('ran'),'time' (seconds)
+    '''
+    start=time.time()
+    missing=[filename for filename in stage['inputs'] if not os.path.isfile(filename)]
+    if len(missing)>0:
+        raise RuntimeError("Stage "+stage['name']+": missing input files "+", ".join(missing))
+    if stage['stdout'] is not None:
+        with open(stage['stdout'],'w') as f:
+            process=subprocess.run(stage['command'],stdout=f,stderr=subprocess.PIPE,universal_newlines=True)
+    else:
+        process=subprocess.run(stage['command'],stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+    if process.returncode!=0 or not os.path.isfile(stage['output']):
+        raise RuntimeError("Stage "+stage['name']+" failed for "+stage['output']+":\n"+process.stderr)
+    #Write the stamp (atomically):
+    stamp={'command_hash': give_command_hash(stage['command']),
+           'input_hashes': {filename: give_file_hash(filename) for filename in stage['inputs']}}
+    with open(stage['output']+'.stamp.tmp','w') as f:
+        json.dump(stamp,f,indent=1)
+    os.replace(stage['output']+'.stamp.tmp',stage['output']+'.stamp')
+    return({'name': stage['name'],'output': stage['output'],'status': 'ran','time': time.time()-start})
+
+def run_stages(stages,clean=False):
+    '''
+    Runs a chain of stages (every stage depends on the previous one).
+    Input: stages - list of dictionaries (see create_stage)
+           clean - Boolean - if True, the input of a stage is removed after the stage has run if it is the output
+                             of the previous stage (intermediate files, their stamps are kept)
+    Output: list of dictionaries (see run_stage) - status is 'ran', 'skipped' or 'failed' (with the error)
+    '''
+    needed=give_needed_stages(stages)
+    reports=[]
+    for it,stage in enumerate(stages):
+        if not needed[it]:
+            reports.append({'name': stage['name'],'output': stage['output'],'status': 'skipped','time': 0.})
+            continue
+        try:
+            reports.append(run_stage(stage))
+        except RuntimeError as error:
+            reports.append({'name': stage['name'],'output': stage['output'],'status': 'failed','time': 0.,'error': str(error)})
+            break
+        if clean and it>0:
+            for filename in stage['inputs']:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+    return(reports)
+
+#Stages of one year:
+def give_year_stages(location,year,suffix,python=sys.executable):
+    file=location+str(year)+suffix
+    stages=[]
+    if os.path.isfile(file+'.grib'):
+        stages.append(create_stage('grib_get_data',[file+'.grib'],file+'_unformatted.csv',
+                                   ['grib_get_data','-p','dataDate,dataTime,validityDate,validityTime,shortName',file+'.grib'],
+                                   stdout=file+'_unformatted.csv'))
+    stages.append(create_stage('value_table',[file+'_unformatted.csv'],file+'_per_measurement.csv',
+                               [python,os.path.join(PATH,'build_value_table_era5.py'),file+'_unformatted.csv',file+'_per_measurement.csv']))
+    stages.append(create_stage('data_table',[file+'_per_measurement.csv'],file+'_per_time.csv',
+                               [python,os.path.join(PATH,'build_data_table_era5.py'),file+'_per_measurement.csv',file+'_per_time.csv']))
+    stages.append(create_stage('compress',[file+'_per_time.csv'],file+'.pickle',
+                               [python,os.path.join(PATH,'compress_data_table_era5.py'),file+'_per_time.csv',file+'.pickle']))
+    return(stages)
+
+#Stage of the merge of one split:
+def give_merge_stage(location,suffix,merged,split,python=sys.executable):
+    YEARS_LIST,prefix=SPLITS[split]
+    return(create_stage('merge_'+split,[location+str(year)+suffix+'.pickle' for year in YEARS_LIST],location+prefix+merged+'.nc',
+                        [python,os.path.join(PATH,'merge_years_to_single_file_era5.py'),location,suffix+'.pickle',merged,split]))
+
+#Years for which there are input files in the folder:
+def discover_years(location,suffix,min_year=None,max_year=None):
+    pattern=re.compile(r'^(\d{4})'+re.escape(suffix)+r'(\.grib|_unformatted\.csv|_per_measurement\.csv|_per_time\.csv|\.pickle)$')
+    years=sorted(set(int(match.group(1)) for match in map(pattern.match,os.listdir(location)) if match is not None))
+    return([year for year in years if (min_year is None or year>=min_year) and (max_year is None or year<=max_year)])
+
+def _run_stages_clean(stages):
+    return(run_stages(stages,clean=True))
+
+def run_pipeline(location,suffix,merged=None,n_workers=None,clean=False,min_year=None,max_year=None,python=sys.executable):
+    '''
+    Input: location - string - data folder (e.g. 'data/')
+           suffix - string - name of the files without year (e.g. '_ERA5_US')
+           merged - string - name of the merged files without split prefix (e.g. 'Big_ERA5_US'), None: no merge
+           n_workers - int - number of processes (None: number of CPUs)
+           clean - Boolean - remove intermediate files
+    Output: list of dictionaries (see run_stage) - reports of all stages
+            float - wall time of the pipeline
+    '''
+    start=time.time()
+    years=discover_years(location,suffix,min_year,max_year)
+    if len(years)==0:
+        sys.exit("No input files found in "+location+" for the suffix "+suffix)
+    chains=[give_year_stages(location,year,suffix,python) for year in years]
+    with multiprocessing.Pool(n_workers) as pool:
+        reports=[report for chain in pool.map(_run_stages_clean if clean else run_stages,chains) for report in chain]
+    if merged is not None and all(report['status']!='failed' for report in reports):
+        merge_stages=[[give_merge_stage(location,suffix,merged,split,python)] for split in ['train','valid','test']]
+        with multiprocessing.Pool(min(n_workers or 3,3)) as pool:
+            reports+=[report for chain in pool.map(run_stages,merge_stages) for report in chain]
+    return(reports,time.time()-start)
+
+def print_report(reports,total_time):
+    print("Stage            | ran | skipped | failed | time (s, summed over processes)")
+    for name in dict.fromkeys(report['name'] for report in reports):
+        stage_reports=[report for report in reports if report['name']==name]
+        count={status: sum(report['status']==status for report in stage_reports) for status in ['ran','skipped','failed']}
+        print("%-16s | %3d | %7d | %6d | %.1f"%(name,count['ran'],count['skipped'],count['failed'],sum(report['time'] for report in stage_reports)))
+    for report in reports:
+        if report['status']=='failed':
+            print(report['error'])
+    print("Total time of the pipeline: %.1fs"%total_time)
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        LOCATION='data/',
+        SUFFIX='_ERA5_US',
+        MERGED=None,
+        N_WORKERS=None,
+        CLEAN=False,
+        MIN_YEAR=None,
+        MAX_YEAR=None)
+
+    ap.add_argument("-location", "--LOCATION", type=str, required=False,help="Data folder")
+    ap.add_argument("-suffix", "--SUFFIX", type=str, required=False,help="Name of the files without year, e.g. _ERA5_US for data/1980_ERA5_US.grib")
+    ap.add_argument("-merged", "--MERGED", type=str, required=False,help="Name of the merged files without prefix, e.g. Big_ERA5_US (default: no merge)")
+    ap.add_argument("-workers", "--N_WORKERS", type=int, required=False,help="Number of processes (default: number of CPUs)")
+    ap.add_argument("-clean", "--CLEAN", type=bool, required=False,help="Remove intermediate files")
+    ap.add_argument("-min", "--MIN_YEAR", type=int, required=False,help="First year")
+    ap.add_argument("-max", "--MAX_YEAR", type=int, required=False,help="Last year")
+    ARGS = vars(ap.parse_args())
+
+    reports,total_time=run_pipeline(ARGS['LOCATION'],ARGS['SUFFIX'],ARGS['MERGED'],n_workers=ARGS['N_WORKERS'],clean=ARGS['CLEAN'],
+                                    min_year=ARGS['MIN_YEAR'],max_year=ARGS['MAX_YEAR'])
+    print_report(reports,total_time)
+    if any(report['status']=='failed' for report in reports):
+        sys.exit("Preprocessing failed.")
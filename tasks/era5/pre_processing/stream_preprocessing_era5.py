@@ -0,0 +1,280 @@
+#LIBRARIES:
+#Tensors:
+import numpy as np
+import pandas as pd
+import netCDF4
+
+#Tools:
+import io
+import itertools
+import os
+import sys
+import time
+import psutil
+import argparse
+
+#Own files:
+import compress_data_table_era5 as compression
+
+'''
+-------------------------------------------------------------------------
+--------------------------STREAMING PREPROCESSING------------------------
+-------------------------------------------------------------------------
+A single entry point replacing the chain build_value_table -> build_data_table -> compress_data_table -> merge_years.
+The output of grib_get_data (one row per measurement, whitespace separated, with a header line per GRIB message), e.g.
+    grib_get_data -p dataDate,dataTime,validityDate,validityTime,shortName data/1980_ERA5_US.grib > data/1980_ERA5_US_unformatted.csv
+is read in chunks of lines. Every chunk is scattered into arrays of shape (n_variables,n_Longitude,n_Latitude) per time step
+(a vectorised pivot instead of pd.merge). As soon as all values of a time step are there, the units are converted and
+the time step is appended to a netCDF file with an unlimited datetime dimension. Only incomplete time steps are kept
+in memory, i.e. memory is bounded by the chunk size and not by the size of a year (the GRIB files of the Climate
+Data Store are ordered by time, the variables of one time step are consecutive messages).
+The netCDF files have the layout expected by ERA5Dataset: coordinates datetime, Longitude, Latitude and the variables
+sp_in_kPa, t_in_Cels, wind_10m_east, wind_10m_north (float32 or packed to int16 with the precision budget of
+compress_data_table_era5.py, which xarray decodes on load).
+'''
+
+#Variables: (shortName, name in the data set, scale, offset) - the value in the data set is scale*value+offset.
+#The names of the wind components follow the original pipeline ('10u' is stored as 'wind_10m_north' and '10v' as
+#'wind_10m_east') such that the files are compatible with the existing data sets and trained models.
+VARIABLES=[('sp','sp_in_kPa',1/1000,0.),
+           ('2t','t_in_Cels',1.,-273.15),
+           ('10v','wind_10m_east',1.,0.),
+           ('10u','wind_10m_north',1.,0.)]
+TIME_UNITS='hours since 1900-01-01 00:00:00'
+CALENDAR='gregorian'
+
+#Read the output of grib_get_data in chunks:
+def read_chunks(filename,chunk_size=1000000):
+    '''
+    Input: filename - string - output of grib_get_data ('-' for stdin)
+           chunk_size - int - number of lines per chunk
+    Output: generator of pd.DataFrame - columns Latitude,Longitude,Value,dataDate,dataTime,validityDate,validityTime,shortName
+    '''
+    f=sys.stdin if filename=='-' else open(filename,'r')
+    try:
+        names=next(f).replace(","," ").split()
+        while True:
+            lines=[line for line in itertools.islice(f,chunk_size) if line[:8]!="Latitude"]
+            if len(lines)==0:
+                break
+            yield(pd.read_csv(io.StringIO(''.join(lines)),sep=r'\s+',header=None,names=names))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+#Collects the values of time steps until they are complete:
+class TimeStepBuffer(object):
+    def __init__(self,Longitude,Latitude,variables=VARIABLES):
+        '''
+        Input: Longitude,Latitude - np.array - sorted grid values
+               variables - list of tuples - see VARIABLES (other short names in the input are ignored)
+        '''
+        self.Longitude=Longitude
+        self.Latitude=Latitude
+        self.shortnames=[var[0] for var in variables]
+        self.scale=np.array([var[2] for var in variables],dtype=np.float64)[:,None,None]
+        self.offset=np.array([var[3] for var in variables],dtype=np.float64)[:,None,None]
+        self.n_values_per_time=len(variables)*len(Longitude)*len(Latitude)
+        self.values={}
+        self.counts={}
+
+    def give_grid_index(self,grid,values):
+        '''
+        Output: np.array of ints - index of values in grid (exits if a value is not on the grid)
+        '''
+        index=np.clip(np.searchsorted(grid,values),0,len(grid)-1)
+        if not np.allclose(grid[index],values):
+            sys.exit("Error: Coordinates of the data are not on the grid of the first message.")
+        return(index)
+
+    def add(self,chunk):
+        '''
+        Input: chunk - pd.DataFrame - see read_chunks
+        '''
+        #The data time has to be the validity time (the original pipeline dropped dataDate and dataTime):
+        if (chunk.validityDate.values!=chunk.dataDate.values).any() or (chunk.validityTime.values!=chunk.dataTime.values).any():
+            sys.exit("Error: validity time and data time are not equal.")
+        var_index=chunk.shortName.map({name: it for it,name in enumerate(self.shortnames)}).values
+        keep=~np.isnan(var_index)
+        var_index=var_index[keep].astype(np.int64)
+        lon_index=self.give_grid_index(self.Longitude,chunk.Longitude.values[keep])
+        lat_index=self.give_grid_index(self.Latitude,chunk.Latitude.values[keep])
+        time_key=chunk.validityDate.values[keep].astype(np.int64)*10000+chunk.validityTime.values[keep].astype(np.int64)
+        values=chunk.Value.values[keep]
+
+        #Scatter the values of every time step in the chunk:
+        for key in np.unique(time_key):
+            ind=time_key==key
+            if key not in self.values:
+                self.values[key]=np.full((len(self.shortnames),len(self.Longitude),len(self.Latitude)),np.nan)
+                self.counts[key]=0
+            self.values[key][var_index[ind],lon_index[ind],lat_index[ind]]=values[ind]
+            self.counts[key]+=ind.sum()
+
+    def pop_complete(self):
+        '''
+        Output: np.array of datetime64 - shape (n_complete) - sorted completed time steps
+                np.array - shape (n_complete,n_variables,n_Longitude,n_Latitude) - values in the units of the data set
+        '''
+        keys=sorted([key for key,count in self.counts.items() if count>=self.n_values_per_time])
+        if len(keys)==0:
+            return(np.array([],dtype='datetime64[ns]'),None)
+        values=np.stack([self.values.pop(key) for key in keys],axis=0)
+        counts=[self.counts.pop(key) for key in keys]
+        if max(counts)>self.n_values_per_time or np.isnan(values).any():
+            sys.exit("Error: Some time steps have duplicated or missing values.")
+        times=pd.to_datetime([str(key).zfill(12) for key in keys],format='%Y%m%d%H%M').values
+        return(times,values*self.scale+self.offset)
+
+    def n_incomplete(self):
+        return(len(self.counts))
+
+#A netCDF file to which time steps are appended:
+class NetCDFAppender(object):
+    def __init__(self,filename,Longitude,Latitude,variables=VARIABLES,chunk_times=24,zlib=False,pack=False):
+        '''
+        Input: filename - string
+               Longitude,Latitude - np.array - grid values
+               variables - list of tuples - see VARIABLES
+               chunk_times - int - number of time steps per chunk of the netCDF file
+               zlib - Boolean - if True, the variables are compressed
+               pack - Boolean - if True, variables with an int16 encoding in the precision budget are packed (scale_factor,add_offset)
+        '''
+        self.filename=filename
+        self.dataset=netCDF4.Dataset(filename+'.tmp','w')
+        self.dataset.createDimension('datetime',None)
+        self.dataset.createDimension('Longitude',len(Longitude))
+        self.dataset.createDimension('Latitude',len(Latitude))
+        self.datetime=self.dataset.createVariable('datetime','f8',('datetime',))
+        self.datetime.units=TIME_UNITS
+        self.datetime.calendar=CALENDAR
+        self.dataset.createVariable('Longitude','f4',('Longitude',))[:]=Longitude
+        self.dataset.createVariable('Latitude','f4',('Latitude',))[:]=Latitude
+        self.variables=[]
+        self.ranges=[]
+        for var in variables:
+            packed=pack and compression.give_encoding(var[1])=='int16'
+            variable=self.dataset.createVariable(var[1],'i2' if packed else 'f4',('datetime','Longitude','Latitude'),zlib=zlib,
+                                                 chunksizes=(chunk_times,len(Longitude),len(Latitude)),
+                                                 fill_value=compression.FILL_VALUE if packed else None)
+            if packed:
+                #netCDF4 packs the values when writing:
+                scale,offset=compression.give_packing(var[1])
+                variable.scale_factor=np.float32(scale)
+                variable.add_offset=np.float32(offset)
+            self.variables.append(variable)
+            self.ranges.append(compression.PRECISION_BUDGET[var[1]]['range'] if packed else None)
+        self.n_times=0
+        self.last_time=None
+
+    def append(self,times,values):
+        '''
+        Input: times - np.array of datetime64 - shape (n_times) - sorted
+               values - np.array - shape (n_times,n_variables,n_Longitude,n_Latitude)
+        '''
+        if len(times)==0:
+            return
+        if self.last_time is not None and times[0]<=self.last_time:
+            sys.exit("Error: Time steps are not in increasing order - the input has to be ordered by time.")
+        hours=(times-np.datetime64('1900-01-01T00:00:00'))/np.timedelta64(1,'h')
+        self.datetime[self.n_times:self.n_times+len(times)]=hours
+        for it,variable in enumerate(self.variables):
+            if self.ranges[it] is not None and (values[:,it].min()<self.ranges[it][0] or values[:,it].max()>self.ranges[it][1]):
+                sys.exit("Error: values of "+variable.name+" are outside of the range of the precision budget.")
+            variable[self.n_times:self.n_times+len(times)]=values[:,it].astype(np.float32)
+        self.n_times+=len(times)
+        self.last_time=times[-1]
+
+    def close(self):
+        #The file is only moved to its final name if it is complete:
+        self.dataset.close()
+        os.replace(self.filename+'.tmp',self.filename)
+
+#Process one year of data:
+def process_year(filename_in,filename_out,chunk_size=1000000,variables=VARIABLES,zlib=False,pack=False):
+    '''
+    Input: filename_in - string - output of grib_get_data
+           filename_out - string - netCDF file
+           chunk_size - int - number of lines read per chunk
+    Output: dictionary - 'n_times', 'time' (seconds), 'peak_rss_MB' (resident set size sampled after every chunk)
+    '''
+    start=time.time()
+    process=psutil.Process(os.getpid())
+    peak_rss=process.memory_info().rss
+    buffer=None
+    appender=None
+    for chunk in read_chunks(filename_in,chunk_size):
+        if buffer is None:
+            #The grid is given by the first chunk (a chunk has to contain at least one GRIB message):
+            Longitude=np.unique(chunk.Longitude.values)
+            Latitude=np.unique(chunk.Latitude.values)
+            buffer=TimeStepBuffer(Longitude,Latitude,variables)
+            appender=NetCDFAppender(filename_out,Longitude,Latitude,variables,zlib=zlib,pack=pack)
+        buffer.add(chunk)
+        appender.append(*buffer.pop_complete())
+        peak_rss=max(peak_rss,process.memory_info().rss)
+    if buffer is None:
+        sys.exit("Error: Empty input file: "+filename_in)
+    if buffer.n_incomplete()>0:
+        sys.exit("Error: %d time steps are incomplete in "%buffer.n_incomplete()+filename_in)
+    appender.close()
+    return({'n_times': appender.n_times,'time': time.time()-start,'peak_rss_MB': peak_rss/1024**2})
+
+#Append several netCDF files (e.g. years) to one file without loading them completely:
+def merge_netcdf_files(filenames,filename_out,n_times_per_read=720,zlib=False,pack=False):
+    '''
+    Input: filenames - list of strings - netCDF files created by process_year (same grid, in increasing order of time)
+           filename_out - string
+           n_times_per_read - int - number of time steps which are copied at once
+    '''
+    appender=None
+    for filename in filenames:
+        with netCDF4.Dataset(filename,'r') as dataset:
+            dataset.set_auto_mask(False)
+            names=[name for name in dataset.variables if name not in ['datetime','Longitude','Latitude']]
+            if appender is None:
+                variables=[(None,name,1.,0.) for name in names]
+                appender=NetCDFAppender(filename_out,dataset['Longitude'][:],dataset['Latitude'][:],variables,zlib=zlib,pack=pack)
+            n_times=dataset.dimensions['datetime'].size
+            for begin in range(0,n_times,n_times_per_read):
+                end=min(begin+n_times_per_read,n_times)
+                times=netCDF4.num2date(dataset['datetime'][begin:end],TIME_UNITS,CALENDAR,only_use_cftime_datetimes=False)
+                times=np.array([np.datetime64(time_step) for time_step in times],dtype='datetime64[ns]')
+                appender.append(times,np.stack([dataset[name][begin:end] for name in names],axis=1))
+    appender.close()
+
+if __name__=='__main__':
+    # Construct the argument parse and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.set_defaults(
+        LOCATION='data/',
+        SUFFIX='_ERA5_US',
+        MIN_YEAR=1980,
+        MAX_YEAR=2018,
+        CHUNK_SIZE=1000000,
+        ZLIB=False,
+        PACK=False,
+        MERGE=None)
+
+    ap.add_argument("-location", "--LOCATION", type=str, required=False,help="Folder of the files")
+    ap.add_argument("-suffix", "--SUFFIX", type=str, required=False,help="Name of the files without year, e.g. _ERA5_US for data/1980_ERA5_US_unformatted.csv")
+    ap.add_argument("-min", "--MIN_YEAR", type=int, required=False,help="First year")
+    ap.add_argument("-max", "--MAX_YEAR", type=int, required=False,help="Last year")
+    ap.add_argument("-chunk", "--CHUNK_SIZE", type=int, required=False,help="Number of lines read per chunk")
+    ap.add_argument("-zlib", "--ZLIB", type=bool, required=False,help="Compress the netCDF files")
+    ap.add_argument("-pack", "--PACK", type=bool, required=False,help="Pack the variables to int16 with the precision budget")
+    ap.add_argument("-merge", "--MERGE", type=str, required=False,help="If given, all years are appended to one file with this name")
+    ARGS = vars(ap.parse_args())
+
+    start=time.time()
+    filenames=[]
+    for year in range(ARGS['MIN_YEAR'],ARGS['MAX_YEAR']+1):
+        filename_in=ARGS['LOCATION']+str(year)+ARGS['SUFFIX']+'_unformatted.csv'
+        filename_out=ARGS['LOCATION']+str(year)+ARGS['SUFFIX']+'.nc'
+        report=process_year(filename_in,filename_out,chunk_size=ARGS['CHUNK_SIZE'],zlib=ARGS['ZLIB'],pack=ARGS['PACK'])
+        print("Year: %d | time steps: %d | time: %.1fs | peak RSS: %.1f MB"%(year,report['n_times'],report['time'],report['peak_rss_MB']))
+        filenames.append(filename_out)
+    if ARGS['MERGE'] is not None:
+        merge_netcdf_files(filenames,ARGS['LOCATION']+ARGS['MERGE']+'.nc',zlib=ARGS['ZLIB'],pack=ARGS['PACK'])
+        print("Merged years to: ", ARGS['LOCATION']+ARGS['MERGE']+'.nc')
+    print("Total time: %.1fs"%(time.time()-start))
@@ -5,9 +5,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as utils
+import sys
 from datetime import datetime
 from datetime import timedelta
 
+import my_utils
+
 '''
 A data set class to deal with the GP data.
 '''
@@ -59,53 +62,78 @@ class GPdataset(utils.IterableDataset):
             
     def __len__(self):
             return len(self.X_data)
+
+    def give_n_points_per_sample(self):
+        '''
+        Output: int - number of points (context+target) per sample returned by get_batch
+        '''
+        return(self.n_total)
         
+    def rand_orthog_mats(self,batch_size):
+        '''
+        Input: batch_size - int
+        Output: torch.Tensor - shape (batch_size,2,2) - independent random orthogonal matrices (rotations and roto-reflections)
+        '''
+        alpha=2*math.pi*torch.rand(batch_size)
+        s=2*torch.randint(low=0,high=2,size=[batch_size])-1
+        cos,sin=torch.cos(alpha),torch.sin(alpha)
+        R=torch.stack([torch.stack([cos,-s*sin],dim=1),torch.stack([sin,s*cos],dim=1)],dim=1)
+        return(R.to(torch.get_default_dtype()))
+
     def rand_orthog_mat(self):
         '''
         Output: torch.Tensor - shape (2,2) - a random orthogonal matrix
         '''
-        alpha=2*math.pi*np.random.uniform()
-        s=np.random.choice([-1,1])
-        R=torch.tensor([[math.cos(alpha),-s*math.sin(alpha)],[math.sin(alpha),s*math.cos(alpha)]],dtype=torch.get_default_dtype())
-        return(R)
+        return(self.rand_orthog_mats(1)[0])
 
     def rand_transform(self,X,Y):
         '''
         Input: X,Y - torch.Tensor - shape (batch_size,n,2)
-        Output: X,Y - torch.Tensor - shape (batch_size,n,2) - randomly roto-reflected X and roto-reflected Y 
+        Output: X,Y - torch.Tensor - shape (batch_size,n,2) - every element of the batch is randomly roto-reflected 
+                                                             (X and Y with the same matrix)
         '''
-        #Sample a random rotation matrix:
-        R=self.rand_orthog_mat()
+        #Sample a random orthogonal matrix per element:
+        R=self.rand_orthog_mats(X.size(0)).to(X.dtype)
         
-        #Return rotated versions:
-        return(torch.matmul(X,R.t()),torch.matmul(Y,R.t()))
+        #Return transformed versions (one batched matrix multiplication for X and Y):
+        XY=torch.bmm(torch.cat([X,Y],dim=1),R.transpose(1,2))
+        return(XY[:,:X.size(1)],XY[:,X.size(1):])
     
-    def get_batch(self,inds,n_context_points=None,cont_in_target=False):
+    def get_batch(self,inds,n_context_points=None,cont_in_target=False,variable_context=False):
         '''
         Input: inds - list of ints - gives indices of which observations to choose for minibatch
-               n_context_points - int - gives number of context points
+               n_context_points - int - gives number of context points 
+                                  (if variable_context: torch.Tensor of ints of shape (len(inds)) - number per element)
                cont_in_target -Boolean - if True, the target set includes the context set
+               variable_context - Boolean - if True, every element of the batch has its own number of context points
+                                            (sets are padded, see my_utils.padded_target_context_splitter)
         Ouput: X_context,Y_context - torch.Tensor - shape (len(inds),n_context_points,self.dim_2_X/self.dim_2_Y)
                X_target, Y_target - torch.Tensor - shape (len(inds),n_total-n_context_points,self.dim_2_X/self.dim_2_Y)
+               if variable_context: additionally Mask_context,Mask_target - torch.Tensor - shape (len(inds),n_context_points/n_target_points)
         '''
         if n_context_points is None:
-            n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[1])
+            if variable_context:
+                n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[len(inds)])
+            else:
+                n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[1])
         shuffle=torch.randperm(self.dim_1)
         X=self.X_data[inds][:,shuffle[:self.n_total]]
         Y=self.Y_data[inds][:,shuffle[:self.n_total]]
         if self.transform:
             X,Y=self.rand_transform(X,Y)
+        if variable_context:
+            return(my_utils.padded_target_context_splitter(X,Y,n_context_points,cont_in_target=cont_in_target))
         if cont_in_target:
             return(X[:,:n_context_points],Y[:,:n_context_points],X,Y)
         else:
             return(X[:,:n_context_points],Y[:,:n_context_points],X[:,n_context_points:],Y[:,n_context_points:])
     
-    def get_rand_batch(self,batch_size,n_context_points=None,cont_in_target=False):
+    def get_rand_batch(self,batch_size,n_context_points=None,cont_in_target=False,variable_context=False):
         '''
         Returns self.get_batch with random number of indices with length=batch_size and random number of context points
         in range [self.Min_n_cont,high=self.Max_n_cont]
         If n_context_points is None, it is randomly sampled.
         '''
         inds=torch.randperm(self.n_obs)[:batch_size]
-        return(self.get_batch(inds,n_context_points,cont_in_target=cont_in_target))
+        return(self.get_batch(inds,n_context_points,cont_in_target=cont_in_target,variable_context=variable_context))
 
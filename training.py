@@ -26,20 +26,100 @@ import matplotlib.cm as cm
 
 #Tools:
 import datetime
+import math
+import time
+import glob
+import os
 import sys
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 #Own files:
 import my_utils
+import profiling
 
 
 #HYPERPARAMETERS:
 torch.set_default_dtype(torch.float)
 
 
+'''
+-------------------------------------------Tools for batches -------------------------------------------------
+'''
+#Send a batch to the device - a batch without masks (4 tensors) is completed with masks None:
+def send_batch_to_device(batch,device):
+    '''
+    Input: batch - tuple of torch.Tensor - (X_c,Y_c,X_t,Y_t) or (X_c,Y_c,X_t,Y_t,Mask_c,Mask_t) (see dataset.get_batch)
+    Output: list of 6 torch.Tensors/None - X_c,Y_c,X_t,Y_t,Mask_c,Mask_t on device
+    '''
+    batch=list(batch)+(6-len(batch))*[None]
+    return([tensor.to(device) if tensor is not None else None for tensor in batch])
+
+'''
+-------------------------------------------Tools for checkpointing -------------------------------------------------
+'''
+#Give the state of all random number generators used during training:
+def give_rng_state():
+    '''
+    Output: dictionary - states of the torch (CPU and, if available, CUDA) and numpy random number generators
+    '''
+    rng_state={'torch': torch.get_rng_state(),
+               'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+               'numpy': np.random.get_state()}
+    return(rng_state)
+
+#Set the state of all random number generators (inverse of give_rng_state):
+def set_rng_state(rng_state):
+    '''
+    Input: rng_state - dictionary - as returned by give_rng_state
+    '''
+    torch.set_rng_state(rng_state['torch'])
+    if rng_state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+    np.random.set_state(rng_state['numpy'])
+
+#Save a dictionary atomically: it is first written to a temporary file which is then renamed.
+#Like this, a crash during saving never leaves a corrupted file behind.
+def save_atomic(dictionary,filename):
+    '''
+    Input: dictionary - dict - object to save with torch.save
+           filename - string - name of the file
+    '''
+    tmp_filename=filename+'.tmp'
+    torch.save(dictionary,tmp_filename)
+    os.replace(tmp_filename,filename)
+
+#Give the filename of the checkpoint at a given epoch and iteration:
+def give_checkpoint_filename(checkpoint_file,epoch,it):
+    return(checkpoint_file+'_ckpt_epoch_%d_it_%d'%(epoch,it))
+
+#Give a list of all checkpoints with prefix checkpoint_file (sorted from oldest to newest):
+def give_checkpoint_list(checkpoint_file):
+    '''
+    Input: checkpoint_file - string - prefix of checkpoint files
+    Output: list of strings - filenames of checkpoints sorted by (epoch,iteration)
+    '''
+    def give_position(filename):
+        parts=filename.split('_ckpt_epoch_')[-1].split('_it_')
+        return(int(parts[0]),int(parts[1]))
+    filenames=[f for f in glob.glob(checkpoint_file+'_ckpt_epoch_*_it_*') if not f.endswith('.tmp')]
+    return(sorted(filenames,key=give_position))
+
+#Give the newest checkpoint (None if there is none):
+def find_latest_checkpoint(checkpoint_file):
+    checkpoint_list=give_checkpoint_list(checkpoint_file)
+    return(checkpoint_list[-1] if len(checkpoint_list)>0 else None)
+
+#Retention policy: only keep the newest n_keep checkpoints:
+def remove_old_checkpoints(checkpoint_file,n_keep):
+    checkpoint_list=give_checkpoint_list(checkpoint_file)
+    for filename in checkpoint_list[:max(len(checkpoint_list)-n_keep,0)]:
+        os.remove(filename)
+
 def train_cnp(CNP, train_dataset,val_dataset, data_identifier,device,minibatch_size=1,n_epochs=3, n_iterat_per_epoch=1,
-                 learning_rate=1e-3, weight_decay=0.,shape_reg=None,n_plots=None,n_val_samples=None,filename=None,print_progress=True,G_act=None,feature_in=None,n_equiv_samples=None):
+                 learning_rate=1e-3, weight_decay=0.,shape_reg=None,n_plots=None,n_val_samples=None,filename=None,print_progress=True,G_act=None,feature_in=None,n_equiv_samples=None,
+                 checkpoint_file=None,checkpoint_every_epochs=None,checkpoint_every_minutes=None,n_checkpoints_kept=2,resume_from=None,
+                 profile=False,trace_file=None,n_trace_iterat=5,variable_context=False):
         '''
         Input: 
           CNP: Module of a CNP type accepting context and target sets
@@ -59,6 +139,19 @@ def train_cnp(CNP, train_dataset,val_dataset, data_identifier,device,minibatch_s
           print_progress - Boolean - indicates whether progress is printed
           G_act - gspaces.gspaces - gspace to track equivariance loss 
           feature_in - g_cnn.FieldType - feature type of input to track equivariance loss 
+          checkpoint_file - string/None - if not None, prefix of the periodic checkpoints (model, optimizer, trackers and RNG states)
+          checkpoint_every_epochs - int/None - if int, a checkpoint is saved every checkpoint_every_epochs epochs
+          checkpoint_every_minutes - float/None - if float, a checkpoint is saved (after the current iteration) 
+                                                  as soon as checkpoint_every_minutes minutes passed since the last one
+          n_checkpoints_kept - int - number of newest checkpoints which are kept (older ones are removed)
+          resume_from - string/None - filename of a checkpoint to resume training from exactly where it stopped
+                                      or 'latest' to resume from the newest checkpoint with prefix checkpoint_file (if any)
+          profile - Boolean - if True, wall time and peak memory of the stages of a training step (encoder, decoder, 
+                              smoothers, loss, backward pass) are recorded and saved per epoch (see profiling.StageProfiler)
+          trace_file - string/None - if not None, a torch.autograd.profiler trace of the first n_trace_iterat iterations
+                                     is exported to trace_file (chrome trace format)
+          variable_context - Boolean - if True, every element of a minibatch has its own number of context points
+                                       (padded batches with masks, see my_utils.padded_target_context_splitter)
         '''
         '''
         Input: filename - string - name of file - if given, there the model is saved
@@ -83,61 +176,145 @@ def train_cnp(CNP, train_dataset,val_dataset, data_identifier,device,minibatch_s
         train_log_ll_tracker=[]
         #2.Track validation loss:
         val_log_ll_tracker=[]
-        if G_act is not None and feature_in is not None and n_equiv_samples is not None:
-          equiv_loss_mean_tr=[]
-          equiv_loss_mean_norm_tr=[]
-          equiv_loss_cov_tr=[]
-          equiv_loss_cov_norm_tr=[]
-          equiv_loss_mean_val=[]
-          equiv_loss_mean_norm_val=[]
-          equiv_loss_cov_val=[]
-          equiv_loss_cov_norm_val=[]
+        #3.Track equivariance loss (only filled if G_act, feature_in and n_equiv_samples are given):
+        equiv_loss_mean_tr=[]
+        equiv_loss_mean_norm_tr=[]
+        equiv_loss_cov_tr=[]
+        equiv_loss_cov_norm_tr=[]
+        equiv_loss_mean_val=[]
+        equiv_loss_mean_norm_val=[]
+        equiv_loss_cov_val=[]
+        equiv_loss_cov_norm_val=[]
+        #4.Track per-epoch profiling aggregates (only filled if profile is True):
+        profile_tracker=[]
+        #Collect all trackers in one dictionary (needed for checkpoints):
+        trackers={'profile': profile_tracker,'train_loss': train_loss_tracker,'train_log_ll': train_log_ll_tracker,'val_log_ll': val_log_ll_tracker,
+                  'equiv_loss_mean_tr': equiv_loss_mean_tr,'equiv_loss_mean_norm_tr': equiv_loss_mean_norm_tr,
+                  'equiv_loss_cov_tr': equiv_loss_cov_tr,'equiv_loss_cov_norm_tr': equiv_loss_cov_norm_tr,
+                  'equiv_loss_mean_val': equiv_loss_mean_val,'equiv_loss_mean_norm_val': equiv_loss_mean_norm_val,
+                  'equiv_loss_cov_val': equiv_loss_cov_val,'equiv_loss_cov_norm_val': equiv_loss_cov_norm_val}
         #------------------------------------------------------------------------
 
         #Define the optimizer and add a weight decay term:
         optimizer=torch.optim.Adam(CNP.parameters(),lr=learning_rate,weight_decay=weight_decay)        
 
+        #Track the loss over the epoch:
+        loss_epoch=my_utils.AverageMeter()
+        log_ll_epoch=my_utils.AverageMeter()
+
+        #-------------------CHECKPOINTING ------------------------------------------
+        #Function to save the full training state:
+        def save_training_checkpoint(epoch,it):
+            checkpoint={'CNP_dict': CNP.give_dict(),
+                        'model_state': CNP.state_dict(),
+                        'optimizer': optimizer.state_dict(),
+                        'epoch': epoch,
+                        'iteration': it,
+                        'loss_epoch': loss_epoch.__dict__.copy(),
+                        'log_ll_epoch': log_ll_epoch.__dict__.copy(),
+                        'trackers': trackers,
+                        'rng_state': give_rng_state(),
+                        'data_identifier': data_identifier}
+            save_atomic(checkpoint,give_checkpoint_filename(checkpoint_file,epoch,it))
+            remove_old_checkpoints(checkpoint_file,n_checkpoints_kept)
+
+        if checkpoint_file is None and (checkpoint_every_epochs is not None or checkpoint_every_minutes is not None):
+            sys.exit("To save checkpoints, a checkpoint file has to be given.")
+
+        #Resume from a checkpoint (the next iteration to perform is (start_epoch,start_it)):
+        start_epoch=0
+        start_it=0
+        if resume_from=='latest':
+            resume_from=find_latest_checkpoint(checkpoint_file) if checkpoint_file is not None else None
+        if resume_from is not None:
+            checkpoint=torch.load(resume_from,map_location=device)
+            CNP.load_state_dict(checkpoint['model_state'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            for key in trackers.keys():
+                trackers[key].extend(checkpoint['trackers'].get(key,[]))
+            loss_epoch.__dict__.update(checkpoint['loss_epoch'])
+            log_ll_epoch.__dict__.update(checkpoint['log_ll_epoch'])
+            start_epoch=checkpoint['epoch']
+            start_it=checkpoint['iteration']
+            set_rng_state(checkpoint['rng_state'])
+            if print_progress:
+                print("Resumed training from checkpoint %s at epoch %d and iteration %d."%(resume_from,start_epoch,start_it))
+        
+        time_last_checkpoint=time.time()
+        #---------------------------------------------------------------------------
+
+        #-------------------PROFILING ------------------------------------------
+        profiler=profiling.StageProfiler(device) if profile else None
+        if hasattr(CNP,'profiler'):
+            CNP.profiler=profiler
+        trace=None
+        n_traced=0
+        #---------------------------------------------------------------------------
+
         #-------------------EPOCH LOOP ------------------------------------------
-        for epoch in range(n_epochs):
-            #Track the loss over the epoch:
-            loss_epoch=my_utils.AverageMeter()
-            log_ll_epoch=my_utils.AverageMeter()
+        for epoch in range(start_epoch,n_epochs):
             #-------------------------ITERATION IN ONE EPOCH ---------------------
-            for it in range(n_iterat_per_epoch):
+            for it in range(start_it if epoch==start_epoch else 0,n_iterat_per_epoch):
+                #Start tracing if wanted:
+                if trace_file is not None and n_traced==0:
+                    trace=torch.autograd.profiler.profile(**({'use_cuda': True} if torch.device(device).type=='cuda' else {}))
+                    trace.__enter__()
                 #Set the loss to zero:
                 loss=torch.tensor(0.0,device=device)
-                x_context,y_context,x_target,y_target=train_dataset.get_rand_batch(batch_size=minibatch_size,cont_in_target=True)
+                batch=train_dataset.get_rand_batch(batch_size=minibatch_size,cont_in_target=True,variable_context=variable_context)
                 #Load data to device:
-                x_context=x_context.to(device)
-                y_context=y_context.to(device)
-                x_target=x_target.to(device)
-                y_target=y_target.to(device)
+                x_context,y_context,x_target,y_target,mask_context,mask_target=send_batch_to_device(batch,device)
                 
                 #DEBUG:
                 #The target set includes the context set here:
-                Means,Sigmas=CNP(x_context,y_context,x_target) 
+                Means,Sigmas=CNP(x_context,y_context,x_target,mask_context=mask_context) 
                 #print("Means sample: ", Means.flatten()[:100])
                 #print("Sigmas samples: ", Sigmas.flatten()[:100])
-                loss,log_ll=CNP.loss(y_target,Means,Sigmas,shape_reg=shape_reg)
+                with profiling.profile_stage(profiler,'loss'):
+                    loss,log_ll=CNP.loss(y_target,Means,Sigmas,shape_reg=shape_reg,mask=mask_target)
 
                 #Set gradients to zero:
                 optimizer.zero_grad()
                 #Compute gradients:
-                loss.backward()
+                with profiling.profile_stage(profiler,'backward'):
+                    loss.backward()
                 #Perform optimization step:
                 optimizer.step()
 
+                #Stop tracing and export the trace:
+                if trace is not None:
+                    n_traced+=1
+                    if n_traced==n_trace_iterat:
+                        trace.__exit__(None,None,None)
+                        trace.export_chrome_trace(trace_file)
+                        trace=None
+
                 #Update trackers (n=1 since we have already averaged over the minibatch in the loss):
                 loss_epoch.update(val=loss.detach().item(),n=1)
                 log_ll_epoch.update(val=log_ll.detach().item(),n=1)
 
+                #Save a checkpoint if the time since the last one is exceeded (unless the epoch is finished anyway):
+                if checkpoint_every_minutes is not None and it<n_iterat_per_epoch-1 and (time.time()-time_last_checkpoint)>60*checkpoint_every_minutes:
+                    save_training_checkpoint(epoch,it+1)
+                    time_last_checkpoint=time.time()
+
+            #Save the profiling aggregates of the training iterations of this epoch
+            #(validation and equivariance tests are not profiled):
+            if profiler is not None:
+                profile_tracker.append(profiler.summary())
+                if print_progress:
+                    profiler.print_summary()
+                profiler.reset()
+                if hasattr(CNP,'profiler'):
+                    CNP.profiler=None
+
             #Save the loss and log ll on the training set:
             train_loss_tracker.append(loss_epoch.avg)
             train_log_ll_tracker.append(log_ll_epoch.avg)
 
             if print_progress:
               if n_val_samples is not None:
-                val_log_ll=test_cnp(CNP,val_dataset,device,n_val_samples,batch_size=minibatch_size)
+                val_log_ll=test_cnp(CNP,val_dataset,device,n_val_samples,batch_size=minibatch_size,variable_context=variable_context)
                 val_log_ll_tracker.append(val_log_ll)
                 print("Epoch: %d | train loss: %.5f | train log ll:  %.5f | val log ll: %.5f"%(epoch,loss_epoch.avg,log_ll_epoch.avg,val_log_ll))
 
@@ -155,6 +332,21 @@ def train_cnp(CNP, train_dataset,val_dataset, data_identifier,device,minibatch_s
               equiv_loss_mean_norm_val.append(val_equiv_loss_it['loss_mean_normalized'])
               equiv_loss_cov_val.append(val_equiv_loss_it['loss_sigma'])
               equiv_loss_cov_norm_val.append(val_equiv_loss_it['loss_sigma_normalized'])
+
+            #Reset the trackers for the next epoch:
+            loss_epoch.reset()
+            log_ll_epoch.reset()
+
+            #Switch profiling of the model on again for the next epoch:
+            if hasattr(CNP,'profiler'):
+                CNP.profiler=profiler
+
+            #Save a checkpoint at the end of the epoch if wanted:
+            epoch_due=checkpoint_every_epochs is not None and (epoch+1)%checkpoint_every_epochs==0
+            time_due=checkpoint_every_minutes is not None and (time.time()-time_last_checkpoint)>60*checkpoint_every_minutes
+            if epoch_due or time_due:
+                save_training_checkpoint(epoch+1,0)
+                time_last_checkpoint=time.time()
         
         #If a filename is given: save the model and add the date and time to the filename:
         if filename is not None:
@@ -177,14 +369,22 @@ def train_cnp(CNP, train_dataset,val_dataset, data_identifier,device,minibatch_s
                     'Min_n_context_points': train_dataset.Min_n_cont,
                     'Max_n_context_points': train_dataset.Max_n_cont,
                     'shape_reg': shape_reg,
+                    'profile_history': profile_tracker,
                     'n_parameters:': my_utils.count_parameters(CNP)}
-            torch.save(Report,complete_filename)
+            save_atomic(Report,complete_filename)
         else:
           complete_filename=None
+
+        #Export an unfinished trace and remove the profiler from the model:
+        if trace is not None:
+            trace.__exit__(None,None,None)
+            trace.export_chrome_trace(trace_file)
+        if hasattr(CNP,'profiler'):
+            CNP.profiler=None
         #Return the model and the loss memory:
         return(CNP,train_loss_tracker,complete_filename)
 
-def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,send_to_device=False):
+def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,send_to_device=False,variable_context=False):
         if send_to_device:
             CNP=CNP.to(device)
         with torch.no_grad():
@@ -199,17 +399,119 @@ def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,s
 
                 for it in range(n_iterat):
                     #Get random minibatch:
-                    x_context,y_context,x_target,y_target=val_dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False)
+                    batch=val_dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False,variable_context=variable_context)
                     
                     #Load data to device:
-                    x_context=x_context.to(device)
-                    y_context=y_context.to(device)
-                    x_target=x_target.to(device)
-                    y_target=y_target.to(device)
+                    x_context,y_context,x_target,y_target,mask_context,mask_target=send_batch_to_device(batch,device)
 
                     #The target set includes the context set here:
-                    Means,Sigmas=CNP(x_context,y_context,x_target) 
-                    _, log_ll_it=CNP.loss(y_target,Means,Sigmas)
+                    Means,Sigmas=CNP(x_context,y_context,x_target,mask_context=mask_context) 
+                    _, log_ll_it=CNP.loss(y_target,Means,Sigmas,mask=mask_target)
                     log_ll+=log_ll_it/n_iterat
                     
         return(log_ll.item()/n_data_passes)
+
+'''
+-------------------------------------------Bucketed evaluation -------------------------------------------------
+'''
+#Pack tasks (sorted by decreasing number of context points) into batches whose padded size 
+#(context points x target points summed over the batch) stays below a token budget:
+def pack_tasks_to_budget(task_list,n_points,token_budget):
+    '''
+    Input: task_list - list of tuples (ind,n_context) - sorted by decreasing n_context
+           n_points - int - number of points (context+target) per sample
+           token_budget - int - maximal number of padded (context point,target point) pairs per batch
+    Output: list of lists of tuples (ind,n_context) - batches (every batch contains at least one task)
+    '''
+    batch_list=[]
+    batch=[]
+    for task in task_list:
+        #The first task of a batch has the largest and the new task the smallest number of context points: 
+        n_max=batch[0][1] if len(batch)>0 else task[1]
+        if len(batch)>0 and (len(batch)+1)*n_max*(n_points-task[1])>token_budget:
+            batch_list.append(batch)
+            batch=[]
+        batch.append(task)
+    if len(batch)>0:
+        batch_list.append(batch)
+    return(batch_list)
+
+#Evaluation scheduler: the tasks of all data passes are drawn in advance, sorted into buckets of context sizes 
+#and packed into padded batches to a token budget. The buckets are run largest-first.
+def test_cnp_bucketed(CNP,val_dataset,device,n_samples=400,n_data_passes=1,token_budget=100000,n_buckets=5,send_to_device=False,print_progress=True):
+    '''
+    Input: CNP - model accepting masks (see SteerCNP.forward/ConditionalNeuralProcess.forward)
+           val_dataset - dataset with get_batch(inds,n_context_points,cont_in_target,variable_context) and give_n_points_per_sample
+           n_samples - int - number of samples per data pass
+           n_data_passes - int - number of data passes
+           token_budget - int - maximal number of padded (context point,target point) pairs per batch
+           n_buckets - int - number of buckets of context sizes in [val_dataset.Min_n_cont,val_dataset.Max_n_cont)
+    Output: dictionary - 'log_ll': mean log-likelihood over all tasks
+                         'tasks_per_second': throughput over all buckets
+                         'buckets': list of dictionaries (per bucket: range of context sizes, number of tasks and batches, 
+                                    wall time, tasks and target points per second, mean log-likelihood)
+    '''
+    if send_to_device:
+        CNP=CNP.to(device)
+    n_obs=val_dataset.n_obs
+    n_samples_max=min(n_samples,n_obs)
+    n_points=val_dataset.give_n_points_per_sample()
+
+    #Pre-draw the tasks of all data passes:
+    task_list=[]
+    for j in range(n_data_passes):
+        ind_list=torch.randperm(n_obs)[:n_samples_max]
+        n_context_list=torch.randint(low=val_dataset.Min_n_cont,high=val_dataset.Max_n_cont,size=[n_samples_max])
+        task_list+=list(zip(ind_list.tolist(),n_context_list.tolist()))
+    #Sort the tasks by decreasing context size:
+    task_list.sort(key=lambda task: -task[1])
+
+    #Split into buckets of context sizes:
+    bucket_width=max(int(math.ceil((val_dataset.Max_n_cont-val_dataset.Min_n_cont)/n_buckets)),1)
+    bucket_dict={}
+    for task in task_list:
+        bucket_dict.setdefault((task[1]-val_dataset.Min_n_cont)//bucket_width,[]).append(task)
+
+    bucket_reports=[]
+    log_ll_sum=0.
+    total_time=0.
+    with torch.no_grad():
+        #Run largest-first:
+        for key in sorted(bucket_dict.keys(),reverse=True):
+            bucket=bucket_dict[key]
+            batch_list=pack_tasks_to_budget(bucket,n_points,token_budget)
+            bucket_log_ll=0.
+            n_target_points=0
+            start=time.perf_counter()
+            for batch_tasks in batch_list:
+                inds=torch.tensor([task[0] for task in batch_tasks])
+                n_context_points=torch.tensor([task[1] for task in batch_tasks])
+                batch=val_dataset.get_batch(inds=inds,n_context_points=n_context_points,cont_in_target=False,variable_context=True)
+                x_context,y_context,x_target,y_target,mask_context,mask_target=send_batch_to_device(batch,device)
+                Means,Sigmas=CNP(x_context,y_context,x_target,mask_context=mask_context)
+                #Mean log-likelihood per task:
+                log_ll_vec=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target)
+                bucket_log_ll+=((log_ll_vec*mask_target).sum(dim=1)/mask_target.sum(dim=1)).sum().item()
+                n_target_points+=mask_target.sum().item()
+            if torch.device(device).type=='cuda':
+                torch.cuda.synchronize(device)
+            bucket_time=time.perf_counter()-start
+            total_time+=bucket_time
+            log_ll_sum+=bucket_log_ll
+            bucket_reports.append({'min_n_context': bucket[-1][1],
+                                   'max_n_context': bucket[0][1],
+                                   'n_tasks': len(bucket),
+                                   'n_batches': len(batch_list),
+                                   'time': bucket_time,
+                                   'tasks_per_second': len(bucket)/bucket_time,
+                                   'target_points_per_second': n_target_points/bucket_time,
+                                   'log_ll': bucket_log_ll/len(bucket)})
+            if print_progress:
+                report=bucket_reports[-1]
+                print("Context sizes: %d-%d | tasks: %d | batches: %d | tasks/s: %.1f | target points/s: %.1f | log ll: %.5f"\
+                    %(report['min_n_context'],report['max_n_context'],report['n_tasks'],report['n_batches'],
+                      report['tasks_per_second'],report['target_points_per_second'],report['log_ll']))
+
+    return({'log_ll': log_ll_sum/len(task_list),
+            'tasks_per_second': len(task_list)/total_time,
+            'buckets': bucket_reports})